@@ -0,0 +1,37 @@
+"""Run the application against the fake Google clients
+
+    Usage:
+        python -m benchmarks.app [--port 8000]
+
+    The datastore and the rest of the configuration come from the environment,
+    as for uvicorn main:app; benchmarks.load sets them up.
+"""
+
+import argparse
+import os
+import sys
+
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import fakes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Application with fake Google clients")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    fakes.install()
+    # The application mounts ./static and writes under ./data
+    os.chdir(ROOT)
+    os.makedirs("static", exist_ok=True)
+
+    import main as application
+    uvicorn.run(application.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
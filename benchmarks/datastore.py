@@ -0,0 +1,114 @@
+"""Stand-in for the user datastore (DB_ENDPOINT) with configurable latency
+
+    Serves GET/POST/PUT/DELETE on /users like the remote datastore, with
+    synthetic users whose password is "password".
+
+    Usage:
+        python -m benchmarks.datastore [--port 8765] [--users 1000] [--latency 0.02] [--payments 24]
+"""
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
+
+import argparse
+import asyncio
+import json
+
+import bcrypt
+import uvicorn
+
+
+PASSWORD = "password"
+
+
+def users(count : int, payments : int, rounds : int) -> dict[int, dict]:
+    """Build the synthetic users
+
+    Args:
+        count (int): number of users
+        payments (int): entries of the payment history of each user
+        rounds (int): bcrypt rounds of the password hash
+
+    Returns:
+        dict[int, dict]: users by id
+    """
+    hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds)).decode()
+    return {i: {
+        "id": i,
+        "createdAt": "2024-01-01T00:00:00Z",
+        "name": f"Name {i}",
+        "userName": f"user{i}",
+        "birthdate": "1990-01-01T00:00:00Z",
+        "documentID": 10000000 + i,
+        "email": f"user{i}@example.com",
+        "phone": "(794) 8297 -3702",
+        "password": hash,
+        "debt": 1000.8 + i,
+        "debtMaturityDate": "2027-01-01T00:00:00Z",
+        "state": i % 2 == 0,
+        "paymentHistory": [{"amount": 120.5, "date": f"{2020 + month // 12}-{month % 12 + 1:02d}-05T00:00:00Z",
+                            "dueDate": f"{2020 + month // 12}-{month % 12 + 1:02d}-01T00:00:00Z"} for month in range(payments)]
+    } for i in range(1, count + 1)}
+
+
+def application(data : dict[int, dict], latency : float) -> FastAPI:
+    app = FastAPI()
+
+    async def wait():
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    @app.get("/users")
+    async def all():
+        await wait()
+        return Response(json.dumps(list(data.values())), media_type="application/json")
+
+    @app.get("/users/{id}")
+    async def get(id: int):
+        await wait()
+        if id not in data:
+            raise HTTPException(status_code=404)
+        return data[id]
+
+    @app.post("/users", status_code=201)
+    async def post(request: Request):
+        await wait()
+        user = await request.json()
+        if user["id"] in data:
+            raise HTTPException(status_code=409)
+        data[user["id"]] = user
+        return user
+
+    @app.put("/users/{id}")
+    async def put(id: int, request: Request):
+        await wait()
+        if id not in data:
+            raise HTTPException(status_code=404)
+        data[id] = await request.json()
+        return data[id]
+
+    @app.delete("/users/{id}", status_code=204)
+    async def delete(id: int):
+        await wait()
+        if id not in data:
+            raise HTTPException(status_code=404)
+        del data[id]
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake user datastore")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--payments", type=int, default=24)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every request")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt rounds of the passwords")
+    args = parser.parse_args()
+
+    app = application(users(args.users, args.payments, args.rounds), args.latency)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
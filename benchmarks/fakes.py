@@ -0,0 +1,233 @@
+"""Stand-ins for Vertex AI, Text-to-Speech and Speech-to-Text
+
+    install() replaces the Google clients before the application is imported,
+    so the controllers run unchanged against local fakes whose latency is
+    read from the environment:
+
+        FAKE_MODEL_LATENCY_SECONDS       time to the first token (0.3)
+        FAKE_MODEL_TOKENS_PER_SECOND     generation rate (50)
+        FAKE_MODEL_TOKENS                tokens of each answer (60)
+        FAKE_TTS_LATENCY_SECONDS         latency of a synthesis (0.15)
+        FAKE_TTS_SECONDS_PER_CHAR        extra latency by character (0.001)
+        FAKE_STT_LATENCY_SECONDS         latency of a recognition (0.2)
+        FAKE_STT_REALTIME_FACTOR         extra latency by second of audio (0.05)
+"""
+
+import io
+import os
+import time
+import wave
+from typing import Iterable, Iterator
+
+
+def setting(name : str, default : float) -> float:
+    return float(os.getenv(name, default))
+
+
+WORDS = ("su", "deuda", "vence", "pronto", "le", "recomiendo", "pagar", "una", "cuota", "mensual",
+         "para", "evitar", "intereses.", "podemos", "acordar", "un", "plan", "de", "pagos.")
+
+
+def wav(seconds : float, rate : int = 24000) -> bytes:
+    """Build a silent LINEAR16 WAV
+
+    Args:
+        seconds (float): duration
+        rate (int): sample rate
+
+    Returns:
+        bytes: audio
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(rate)
+        file.writeframes(b"\0\0" * int(rate * seconds))
+    return buffer.getvalue()
+
+
+def seconds(content : bytes) -> float:
+    # Duration of LINEAR16 mono audio at 24 kHz, the header is negligible
+    return len(content or b"") / (2 * 24000)
+
+
+class Part:
+
+    def __init__(self, text : str):
+        self.text = text
+
+
+class Content:
+
+    def __init__(self, role : str, text : str):
+        self.role = role
+        self.parts = [Part(text)]
+
+
+class Response:
+
+    def __init__(self, text : str):
+        self.text = text
+
+
+class FakeChatSession:
+    """Chat session answering after a first token latency, at a token rate
+    """
+
+    def __init__(self, history : list = None):
+        self.history = list(history or [])
+
+    def send_message(self, prompt, stream : bool = False, **kwargs):
+        tokens = int(setting("FAKE_MODEL_TOKENS", 60))
+        words = [WORDS[i % len(WORDS)] for i in range(tokens)]
+        self.history.append(Content("user", str(prompt)))
+        self.history.append(Content("model", " ".join(words)))
+
+        if stream:
+            return self.stream(words)
+
+        time.sleep(setting("FAKE_MODEL_LATENCY_SECONDS", 0.3) + tokens / setting("FAKE_MODEL_TOKENS_PER_SECOND", 50))
+        return Response(" ".join(words))
+
+    def stream(self, words : list[str]) -> Iterator[Response]:
+        time.sleep(setting("FAKE_MODEL_LATENCY_SECONDS", 0.3))
+        rate = setting("FAKE_MODEL_TOKENS_PER_SECOND", 50)
+        # Chunks of about eight tokens, as the model streams them
+        for start in range(0, len(words), 8):
+            chunk = words[start:start + 8]
+            time.sleep(len(chunk) / rate)
+            yield Response(" ".join(chunk) + " ")
+
+
+class FakeGenerativeModel:
+
+    def __init__(self, model_name : str = None, **kwargs):
+        self.model_name = model_name
+
+    def start_chat(self, history : list = None, **kwargs) -> FakeChatSession:
+        return FakeChatSession(history)
+
+
+class Alternative:
+
+    def __init__(self, transcript : str):
+        self.transcript = transcript
+        self.confidence = 0.9
+
+
+class Result:
+
+    def __init__(self, transcript : str, final : bool = True):
+        self.alternatives = [Alternative(transcript)]
+        self.is_final = final
+        self.stability = 0.9 if final else 0.5
+
+
+class Recognition:
+
+    def __init__(self, results : list[Result]):
+        self.results = results
+
+
+class OperationName:
+
+    def __init__(self, name : str):
+        self.name = name
+
+
+class Operation:
+    """Long running recognition ending after the latency of its audio
+    """
+    OPERATIONS : dict[str, "Operation"] = {}
+
+    def __init__(self, seconds : float):
+        self.latency = setting("FAKE_STT_LATENCY_SECONDS", 0.2) + seconds * setting("FAKE_STT_REALTIME_FACTOR", 0.05)
+        self.startedAt = time.monotonic()
+        self.operation = OperationName(f"operations/{len(Operation.OPERATIONS)}")
+        Operation.OPERATIONS[self.operation.name] = self
+
+    def done(self) -> bool:
+        return time.monotonic() - self.startedAt >= self.latency
+
+    def result(self, timeout : float = None) -> Recognition:
+        time.sleep(max(self.latency - (time.monotonic() - self.startedAt), 0))
+        return Recognition([Result("cuanto debo este mes")])
+
+    def cancel(self) -> None:
+        pass
+
+
+class FakeOperationsClient:
+
+    def get_operation(self, name : str, **kwargs) -> Operation:
+        return Operation.OPERATIONS[name]
+
+
+class FakeTransport:
+
+    operations_client = FakeOperationsClient()
+
+    def close(self) -> None:
+        pass
+
+
+class FakeSpeechClient:
+    """Speech-to-Text client transcribing every audio to the same question
+    """
+
+    transport = FakeTransport()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def recognize(self, config = None, audio = None, **kwargs) -> Recognition:
+        time.sleep(setting("FAKE_STT_LATENCY_SECONDS", 0.2) + seconds(audio.content) * setting("FAKE_STT_REALTIME_FACTOR", 0.05))
+        return Recognition([Result("cuanto debo este mes")])
+
+    def long_running_recognize(self, config = None, audio = None, **kwargs) -> Operation:
+        return Operation(seconds(audio.content))
+
+    def streaming_recognize(self, config = None, requests : Iterable = (), **kwargs) -> Iterator[Recognition]:
+        for request in requests:
+            time.sleep(seconds(request.audio_content) * setting("FAKE_STT_REALTIME_FACTOR", 0.05))
+            yield Recognition([Result("cuanto debo", final=False)])
+        time.sleep(setting("FAKE_STT_LATENCY_SECONDS", 0.2))
+        yield Recognition([Result("cuanto debo este mes")])
+
+
+class Synthesis:
+
+    def __init__(self, content : bytes):
+        self.audio_content = content
+
+
+class FakeTextToSpeechClient:
+    """Text-to-Speech client answering silence as long as the text
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def synthesize_speech(self, request = None, **kwargs):
+        text = request["input"].text if request else ""
+        time.sleep(setting("FAKE_TTS_LATENCY_SECONDS", 0.15) + len(text) * setting("FAKE_TTS_SECONDS_PER_CHAR", 0.001))
+        return Synthesis(wav(max(len(text) * 0.06, 0.1)))
+
+
+def install() -> None:
+    """Replace the Google clients, before the application is imported
+    """
+    import vertexai
+    import vertexai.generative_models
+    from google.api_core import operation
+    from google.cloud import speech, texttospeech
+    from google.oauth2 import service_account
+
+    vertexai.init = lambda *args, **kwargs: None
+    vertexai.generative_models.GenerativeModel = FakeGenerativeModel
+    speech.SpeechClient = FakeSpeechClient
+    # The fake operations are resumed by name as they are
+    operation.from_gapic = lambda operation, *args, **kwargs: operation
+    texttospeech.TextToSpeechClient = FakeTextToSpeechClient
+    service_account.Credentials.from_service_account_file = classmethod(lambda cls, *args, **kwargs: None)
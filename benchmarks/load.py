@@ -0,0 +1,220 @@
+"""Load scenarios against the application with local stand-ins for every dependency
+
+    Starts the fake datastore (benchmarks.datastore) and the application with
+    the fake Google clients (benchmarks.app), runs each scenario with a fixed
+    number of concurrent clients for a duration, and reports the throughput
+    and the p50/p95/p99 latencies. --target measures a server already running.
+
+    Usage:
+        python -m benchmarks.load [--scenarios login,users,user,talk,audio,transcribe,voice]
+                                  [--concurrency 16] [--duration 10] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import fakes
+from benchmarks.datastore import PASSWORD
+
+
+QUESTIONS = ("¿Cuánto debo?", "¿Cuándo vence mi deuda?", "¿Puedo pagar en cuotas?", "¿Qué pasa si me atraso?")
+
+
+class Scenario:
+    """Class to represent a request repeated by the clients of a load test
+    """
+
+    def __init__(self, name : str, request : Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]):
+        self.name = name
+        self.request = request
+
+
+def message(user : int, text : str) -> dict:
+    return {"id": 1, "createdAt": "2024-01-01T00:00:00Z", "userId": user, "message": text}
+
+
+def scenarios(users : int, audio : str) -> dict[str, Scenario]:
+    pick = lambda: random.randint(1, users)
+    return {scenario.name: scenario for scenario in (
+        Scenario("login", lambda client, i: client.post("/login/", data={"username": f"user{pick()}", "password": PASSWORD})),
+        Scenario("users", lambda client, i: client.get("/users/", params={"limit": 100, "cursor": random.randint(0, max(users - 100, 0))})),
+        Scenario("user", lambda client, i: client.get(f"/user/{pick()}")),
+        Scenario("talk", lambda client, i: client.post("/chatbot/talk", json=message(pick(), random.choice(QUESTIONS)))),
+        # One text in four is new, the rest repeat
+        Scenario("audio", lambda client, i: client.post("/audio/", json=message(pick(), f"Recordatorio de pago {i if i % 4 == 0 else i % 16}"))),
+        Scenario("transcribe", lambda client, i: client.post("/audio/transcribe", json={**message(pick(), ""), "audioPath": audio})),
+        Scenario("voice", lambda client, i: client.post("/voice/turn", json={**message(pick(), ""), "audioPath": audio}))
+    )}
+
+
+def percentile(values : list[float], percent : float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+async def run(target : str, scenario : Scenario, concurrency : int, duration : float) -> dict:
+    """Run a scenario with concurrent clients, each one sending its next request when the last one ends
+
+    Args:
+        target (str): base url of the application
+        scenario (Scenario): request to repeat
+        concurrency (int): concurrent clients
+        duration (float): seconds of load
+
+    Returns:
+        dict: requests, errors, throughput and latency percentiles
+    """
+    latencies : list[float] = []
+    statuses : dict[int, int] = {}
+    counter = iter(range(sys.maxsize))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=target, timeout=120, limits=limits) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    status = (await scenario.request(client, next(counter))).status_code
+                except httpx.HTTPError:
+                    status = 0
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "scenario": scenario.name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if not 200 <= status < 300),
+        "statuses": statuses,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99)
+    }
+
+
+def wait(url : str, process : subprocess.Popen, timeout : float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start")
+
+
+def start(args, directory : str) -> list[subprocess.Popen]:
+    """Start the fake datastore and the application
+
+    Args:
+        args (argparse.Namespace): options of the benchmark
+        directory (str): directory for the files written by the application
+
+    Returns:
+        list[subprocess.Popen]: processes to stop at the end
+    """
+    datastore = subprocess.Popen([sys.executable, "-m", "benchmarks.datastore", "--port", str(args.datastore_port),
+                                  "--users", str(args.users), "--latency", str(args.datastore_latency),
+                                  "--rounds", str(args.bcrypt_rounds)], cwd=ROOT)
+    wait(f"http://127.0.0.1:{args.datastore_port}/users/1", datastore)
+
+    environment = {
+        **os.environ,
+        "DB_ENDPOINT": f"http://127.0.0.1:{args.datastore_port}",
+        "DB_USER_ENDPOINT": "/users",
+        "SECRET": "benchmark",
+        "ALGORITHM": "HS256",
+        "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+        "BCRYPT_ROUNDS": str(args.bcrypt_rounds),
+        "GOOGLE_APPLICATION_VERTEX_AI_CREDENTIALS": "benchmark.json",
+        "GOOGLE_PROJECT_ID": "benchmark",
+        "GOOGLE_LOCATION": "us-central1",
+        "GOOGLE_MODEL_ID": "benchmark",
+        "USER_SQLITE_PATH": f"{directory}/users.sqlite3",
+        "CAMPAIGN_SQLITE_PATH": f"{directory}/campaigns.sqlite3",
+        "TRANSCRIPTION_SQLITE_PATH": f"{directory}/transcriptions.sqlite3",
+        "CONVERSATION_SQLITE_PATH": f"{directory}/conversations.sqlite3",
+        "AUDIO_STORE_DIR": f"{directory}/audio",
+        "TTS_CACHE_DIR": f"{directory}/cache",
+        # The load comes from a few clients, the limits by user would shed most of it
+        "ADMISSION_ENABLED": "true" if args.admission else "false"
+    }
+    application = subprocess.Popen([sys.executable, "-m", "benchmarks.app", "--port", str(args.port)], cwd=ROOT, env=environment)
+    try:
+        wait(f"http://127.0.0.1:{args.port}/", application)
+    except RuntimeError:
+        datastore.terminate()
+        raise
+
+    return [application, datastore]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the application against local fakes")
+    parser.add_argument("--scenarios", default="login,users,user,talk,audio,transcribe")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--target", default=None, help="url of a running application, nothing is started")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--datastore-port", type=int, default=8765)
+    parser.add_argument("--datastore-latency", type=float, default=0.02)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--admission", action="store_true", help="keep the admission control of the application")
+    parser.add_argument("--json", default=None, help="file to write the results to")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    audio = f"{directory}/question.wav"
+    with open(audio, "wb") as file:
+        file.write(fakes.wav(4))
+
+    available = scenarios(args.users, audio)
+    selected = [available[name] for name in args.scenarios.split(",")]
+    processes = [] if args.target else start(args, directory)
+    target = args.target or f"http://127.0.0.1:{args.port}"
+
+    results = []
+    try:
+        print(f"{'scenario':<12} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for scenario in selected:
+            result = asyncio.run(run(target, scenario, args.concurrency, args.duration))
+            results.append(result)
+            print(f"{result['scenario']:<12} {result['requests']:>9} {result['errors']:>7} {result['throughput']:>9.1f} "
+                  f"{result['p50'] * 1000:>9.1f} {result['p95'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f}")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
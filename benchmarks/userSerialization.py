@@ -0,0 +1,108 @@
+"""Benchmark of the user (de)serialization of the datastore responses
+
+    Compares the previous path (response.json() to dicts, datetimes sliced by
+    hand and a json.dumps/json.loads round trip before each write) with the
+    pydantic TypeAdapter path of UserUtils, over synthetic users.
+
+    Usage:
+        python -m benchmarks.userSerialization [records ...] [--repeat N]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import User, UserUtils
+
+
+def records(count : int) -> bytes:
+    """Build a datastore response with count users
+
+    Args:
+        count (int): number of users
+
+    Returns:
+        bytes: json array document
+    """
+    return json.dumps([{
+        "id": i,
+        "createdAt": "2024-01-01T00:00:00Z",
+        "name": f"Name {i}",
+        "userName": f"user{i}",
+        "birthdate": "1990-01-01T00:00:00Z",
+        "documentID": 10000000 + i,
+        "email": f"user{i}@example.com",
+        "phone": "(794) 8297 -3702",
+        "password": "$2b$12$" + "x" * 53,
+        "debt": 1000.8 + i,
+        "debtMaturityDate": "2027-01-01T00:00:00Z",
+        "state": i % 2 == 0,
+        "paymentHistory": [{"amount": 120.5, "date": f"2024-{month:02d}-01T00:00:00Z"} for month in range(1, 7)]
+    } for i in range(count)]).encode()
+
+
+def legacyDecode(content : bytes) -> list[User]:
+    users = []
+    for data in json.loads(content):
+        users.append(User(id = data["id"],
+                          createdAt = datetime.datetime.fromisoformat(data["createdAt"][:-1]),
+                          name = data["name"],
+                          userName = data["userName"],
+                          birthdate = datetime.date.fromisoformat(data["birthdate"][:10]),
+                          documentID = data["documentID"],
+                          email = data["email"],
+                          phone = data["phone"],
+                          password = data["password"],
+                          debt = data["debt"],
+                          debtMaturityDate = datetime.date.fromisoformat(data["debtMaturityDate"][:10]),
+                          state = data["state"],
+                          paymentHistory = data["paymentHistory"]))
+    return users
+
+
+def legacyEncode(users : list[User]) -> list[bytes]:
+    # json.loads of the string and the json= of httpx encoding it again
+    return [json.dumps(json.loads(json.dumps(user.__dict__, default=str))).encode() for user in users]
+
+
+def decode(content : bytes) -> list[User]:
+    return UserUtils.list_from_bytes(content)
+
+
+def encode(users : list[User]) -> list[bytes]:
+    return [UserUtils.to_bytes(user) for user in users]
+
+
+def measure(fn, argument, repeat : int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn(argument)
+        times.append(perf_counter() - start)
+    return median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the user (de)serialization")
+    parser.add_argument("records", nargs="*", type=int, default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'records':>8} {'path':>7} {'decode ms':>10} {'encode ms':>10} {'users/s':>11}")
+    for count in args.records:
+        content = records(count)
+        users = decode(content)
+        for name, decoder, encoder in (("legacy", legacyDecode, legacyEncode), ("adapter", decode, encode)):
+            decoding = measure(decoder, content, args.repeat)
+            encoding = measure(encoder, users, args.repeat)
+            print(f"{count:>8} {name:>7} {decoding * 1000:>10.1f} {encoding * 1000:>10.1f} {count / decoding:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
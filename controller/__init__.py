@@ -1,4 +1,7 @@
 from controller.userController import Controller as UserController
 from controller.audioController import Controller as AudioController
 from controller.authController import Controller as AuthController
-from controller.chatBotController import Controller as ChatBotController
\ No newline at end of file
+from controller.chatBotController import Controller as ChatBotController
+from controller.voiceController import Controller as VoiceController
+from controller.campaignController import Controller as CampaignController
+from controller.transcriptionController import Controller as TranscriptionController
\ No newline at end of file
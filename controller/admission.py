@@ -0,0 +1,370 @@
+"""Module to admit the requests by class of route before they reach the endpoints
+
+    Each request is classified by its path (model, speech, tts, auth or
+    default). A class has a limit of requests in progress and a queue of
+    the requests waiting for one of them, in order of arrival; a request that
+    finds the queue full is shed with 503 and one that waits longer than the
+    deadline of its class too. A token bucket by class and user, keyed by the
+    subject of the JWT or else by the client address, answers 429 to the
+    users over their rate. The classes are set from the environment:
+
+        ADMISSION_<CLASS>_CONCURRENCY    requests in progress, 0 for no limit
+        ADMISSION_<CLASS>_MAX_QUEUE      requests waiting for a slot
+        ADMISSION_<CLASS>_DEADLINE_SECONDS  longest wait for a slot
+        ADMISSION_<CLASS>_RATE           requests per second of each user, 0 for no limit
+        ADMISSION_<CLASS>_BURST          requests a user can send at once
+
+    Cheap routes (default class) are not limited unless configured, so they
+    are never queued behind a burst of transcriptions or model calls. A
+    websocket only takes a token when it connects; its handler takes a slot
+    for each message it serves (Admission.slot), so idle sockets hold none.
+"""
+
+from cachetools import TTLCache
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import json
+import math
+import os
+import re
+from time import monotonic
+from typing import Optional
+from dotenv import load_dotenv
+
+from controller.authController import Controller as AuthController
+from controller.metrics import Metrics, ADMISSION_SECONDS, ADMISSION_REJECTED
+
+
+load_dotenv()
+
+
+class Rejected(Exception):
+    """Exception raised when a request is not admitted
+    """
+
+    def __init__(self, status : int, reason : str, retryAfter : float):
+        self.status = status
+        self.reason = reason
+        self.retryAfter = retryAfter
+
+    @property
+    def detail(self) -> str:
+        return "Too many requests" if self.status == 429 else "Service busy"
+
+
+class Gate:
+    """Class to represent the slots and the queue of a class of routes
+    """
+
+    def __init__(self, name : str, concurrency : int, maxQueue : int, deadline : float, rate : float, burst : int):
+        """Create a gate
+
+        Args:
+            name (str): name of the class
+            concurrency (int): requests in progress, 0 for no limit
+            maxQueue (int): requests waiting for a slot
+            deadline (float): longest wait for a slot in seconds
+            rate (float): requests per second of each user, 0 for no limit
+            burst (int): requests a user can send at once
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.maxQueue = maxQueue
+        self.deadline = deadline
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.active = 0
+        self.waiters : deque[asyncio.Future] = deque()
+        # Tokens and time of the last refill of each user
+        self.buckets = TTLCache(maxsize=Admission.MAX_USERS, ttl=max(self.burst / rate, 1) if rate > 0 else 1, timer=monotonic)
+        self.admitted = 0
+        self.rejected : dict[str, int] = {}
+        self.waitSeconds = 0.0
+
+    def take(self, user : str) -> None:
+        """Take a token of the bucket of a user
+
+        Args:
+            user (str): subject of the token or client address
+
+        Raises:
+            Rejected: 429 if the bucket is empty
+        """
+        if self.rate <= 0:
+            return
+
+        now = monotonic()
+        tokens, updatedAt = self.buckets.get(user, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updatedAt) * self.rate)
+        if tokens < 1:
+            self.buckets[user] = (tokens, now)
+            raise Rejected(429, "rate", (1 - tokens) / self.rate)
+        self.buckets[user] = (tokens - 1, now)
+
+    async def acquire(self) -> float:
+        """Wait for a slot
+
+        Raises:
+            Rejected: 503 if the queue is full or the deadline passes
+
+        Returns:
+            float: seconds waited
+        """
+        if self.concurrency <= 0:
+            return 0.0
+
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            return 0.0
+
+        if len(self.waiters) >= self.maxQueue:
+            raise Rejected(503, "queue", self.deadline)
+
+        start = monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            await asyncio.wait_for(future, self.deadline)
+        except BaseException as error:
+            if future.done() and not future.cancelled():
+                # The slot was handed over as the wait ended
+                self.release()
+            else:
+                future.cancel()
+                self.waiters.remove(future)
+            if isinstance(error, asyncio.TimeoutError):
+                raise Rejected(503, "deadline", self.deadline)
+            raise
+        return monotonic() - start
+
+    def count(self, rejection : Rejected) -> None:
+        self.rejected[rejection.reason] = self.rejected.get(rejection.reason, 0) + 1
+        ADMISSION_REJECTED.inc(self.name, rejection.reason)
+
+    def limit(self, user : str) -> None:
+        """Take a token of a user, counting the rejection
+
+        Args:
+            user (str): subject of the token or client address
+
+        Raises:
+            Rejected: 429 if the bucket is empty
+        """
+        try:
+            self.take(user)
+        except Rejected as rejection:
+            self.count(rejection)
+            raise
+
+    async def admit(self, user : Optional[str] = None) -> float:
+        """Take a token of a user if given and wait for a slot, counting the outcome
+
+        Args:
+            user (Optional[str]): subject of the token or client address
+
+        Raises:
+            Rejected: 429 over the rate, 503 if the queue is full or the deadline passes
+
+        Returns:
+            float: seconds waited
+        """
+        if user is not None:
+            self.limit(user)
+        try:
+            wait = await self.acquire()
+        except Rejected as rejection:
+            self.count(rejection)
+            raise
+
+        self.admitted += 1
+        self.waitSeconds += wait
+        ADMISSION_SECONDS.observe(self.name, value=wait)
+        timings = Metrics.TIMINGS.get()
+        if timings is not None:
+            timings.append(("queue", wait))
+        return wait
+
+    def release(self) -> None:
+        """Hand the slot over to the first request waiting, or free it
+        """
+        if self.concurrency <= 0:
+            return
+
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "maxQueue": self.maxQueue,
+            "rate": self.rate,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "waitSeconds": self.waitSeconds
+        }
+
+
+class Admission:
+    """Class to hold the gates of the classes of routes
+
+    """
+    ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+    MAX_USERS = int(os.getenv("ADMISSION_MAX_USERS", 100000))
+
+    # concurrency, max queue, deadline, rate and burst of each class
+    DEFAULTS = {
+        "model": (32, 128, 15.0, 1.0, 10),
+        "speech": (8, 32, 15.0, 0.5, 5),
+        "tts": (32, 128, 10.0, 2.0, 20),
+        "auth": (32, 256, 5.0, 1.0, 10),
+        "default": (0, 0, 0.0, 0.0, 0)
+    }
+
+    # Method (None for any) and path of each class, the first match wins
+    ROUTES = [
+        # Reads the conversation log, not the model
+        ("GET", re.compile(r"/chatbot/history"), "default"),
+        (None, re.compile(r"/chatbot/"), "model"),
+        (None, re.compile(r"/voice/"), "model"),
+        (None, re.compile(r"/audio/transcribe"), "speech"),
+        ("POST", re.compile(r"/audio/?$"), "tts"),
+        ("POST", re.compile(r"/login/?$"), "auth")
+    ]
+
+    GATES : dict[str, Gate] = {}
+
+    @classmethod
+    def gate(cls, name : str) -> Gate:
+        """Get the gate of a class, creating it on first use
+
+        Args:
+            name (str): name of the class
+
+        Returns:
+            Gate: gate of the class
+        """
+        gate = cls.GATES.get(name)
+        if gate is None:
+            concurrency, maxQueue, deadline, rate, burst = cls.DEFAULTS.get(name, cls.DEFAULTS["default"])
+            prefix = f"ADMISSION_{name.upper()}"
+            gate = cls.GATES[name] = Gate(
+                name,
+                int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)),
+                int(os.getenv(f"{prefix}_MAX_QUEUE", maxQueue)),
+                float(os.getenv(f"{prefix}_DEADLINE_SECONDS", deadline)),
+                float(os.getenv(f"{prefix}_RATE", rate)),
+                int(os.getenv(f"{prefix}_BURST", burst))
+            )
+        return gate
+
+    @classmethod
+    def classify(cls, method : str, path : str) -> str:
+        for routeMethod, pattern, name in cls.ROUTES:
+            if (routeMethod is None or routeMethod == method) and pattern.match(path):
+                return name
+        return "default"
+
+    def user(scope : dict) -> str:
+        """Get the key of the rate limit of a request
+
+        Args:
+            scope (dict): ASGI scope of the request
+
+        Returns:
+            str: subject of a valid bearer token, or else the client address
+        """
+        for name, value in scope.get("headers", []):
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer" and token:
+                    try:
+                        return f"sub:{AuthController.decode(token).get('sub')}"
+                    except Exception:
+                        pass
+                break
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'unknown'}"
+
+    @classmethod
+    @asynccontextmanager
+    async def slot(cls, name : str):
+        """Hold a slot of a class while a message of a websocket is served,
+        the token of the user was taken when the websocket connected
+
+        Args:
+            name (str): name of the class
+
+        Raises:
+            Rejected: 503 if the queue is full or the deadline passes
+        """
+        if not cls.ENABLED:
+            yield
+            return
+
+        gate = cls.gate(name)
+        await gate.admit()
+        try:
+            yield
+        finally:
+            gate.release()
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {name: gate.stats() for name, gate in cls.GATES.items()}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware admitting the requests by class of route
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or not Admission.ENABLED:
+            return await self.app(scope, receive, send)
+
+        method = scope.get("method", "WEBSOCKET")
+        gate = Admission.gate(Admission.classify(method, scope["path"]))
+        if gate.concurrency <= 0 and gate.rate <= 0:
+            return await self.app(scope, receive, send)
+
+        websocket = scope["type"] == "websocket"
+        try:
+            if websocket:
+                gate.limit(Admission.user(scope))
+            else:
+                await gate.admit(Admission.user(scope))
+        except Rejected as rejection:
+            return await self.reject(scope, send, rejection)
+
+        if websocket:
+            # The handler takes a slot by message, an idle socket must not hold one
+            return await self.app(scope, receive, send)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release()
+
+    async def reject(self, scope, send, rejection : Rejected) -> None:
+        if scope["type"] == "websocket":
+            # Try again later
+            return await send({"type": "websocket.close", "code": 1013})
+
+        body = json.dumps({"detail": rejection.detail}).encode()
+        await send({"type": "http.response.start", "status": rejection.status, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(math.ceil(rejection.retryAfter), 1)).encode())
+        ]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,182 @@
+"""Module to cache the synthesized speech by its content
+
+    The key of an audio is a hash of the text and every parameter of the
+    synthesis, so the same phrase with the same voice is only sent once to
+    Text-to-Speech. The cache keeps only the content id of each key: the
+    audios themselves live in the audio store, whose retention by age and
+    size applies to them like to any other audio. A key whose audio was
+    removed by the store is a miss. The keys are bounded in number by a least
+    recently used index (TTS_CACHE_MAX_ITEMS).
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from threading import RLock, get_ident
+import json
+import os
+from typing import Optional
+from dotenv import load_dotenv
+
+from controller.audioStore import AudioStore
+
+
+load_dotenv()
+
+
+class AudioCache:
+    """Class to find the synthesized audios of the audio store by key
+
+    """
+    DIRECTORY = os.getenv("TTS_CACHE_DIR", "./data/tts-cache")
+    MAX_ITEMS = int(os.getenv("TTS_CACHE_MAX_ITEMS", 100000))
+
+    LOCK = RLock()
+    INDEX : Optional[OrderedDict[str, str]] = None
+    HITS = 0
+    MISSES = 0
+
+    def enabled() -> bool:
+        return AudioCache.MAX_ITEMS > 0
+
+    def key(text : str, voice : str, language : str, speakingRate : float, encoding : str) -> str:
+        """Get the key of a synthesis
+
+        Args:
+            text (str): text to synthesize
+            voice (str): name of the voice
+            language (str): language code
+            speakingRate (float): speaking rate
+            encoding (str): audio encoding
+
+        Returns:
+            str: hex digest of the synthesis parameters
+        """
+        data = json.dumps([text, voice, language, float(speakingRate), encoding], ensure_ascii=False)
+        return sha256(data.encode()).hexdigest()
+
+    def path(key : str) -> str:
+        """Get the path of the content id of a key, sharded by the first byte of the hash
+
+        Args:
+            key (str): key of the audio
+
+        Returns:
+            str: path of the file
+        """
+        return f"{AudioCache.DIRECTORY}/{key[:2]}/{key}"
+
+    @classmethod
+    def index(cls) -> OrderedDict[str, str]:
+        """Get the index, scanning the directory on first use
+
+        Returns:
+            OrderedDict[str, str]: content id of each key from the least to the most recently used
+        """
+        with cls.LOCK:
+            if cls.INDEX is None:
+                entries = []
+                if os.path.isdir(cls.DIRECTORY):
+                    for shard in os.scandir(cls.DIRECTORY):
+                        if not shard.is_dir():
+                            continue
+                        for file in os.scandir(shard.path):
+                            if file.is_file() and not file.name.endswith(".tmp"):
+                                with open(file.path) as content:
+                                    id = content.read().strip()
+                                if AudioStore.ID.match(id):
+                                    entries.append((file.stat().st_mtime, file.name, id))
+                entries.sort()
+                cls.INDEX = OrderedDict((key, id) for _, key, id in entries)
+            return cls.INDEX
+
+    @classmethod
+    def lookup(cls, key : str) -> Optional[tuple[str, str]]:
+        """Get the audio of a key before synthesizing it
+
+        Args:
+            key (str): key of the audio
+
+        Returns:
+            Optional[tuple[str, str]]: content id and path of the audio if cached and still stored
+        """
+        with cls.LOCK:
+            index = cls.index()
+            id = index.get(key)
+            path = AudioStore.find(id) if id is not None else None
+
+            if path is None:
+                cls.MISSES += 1
+                if id is not None:
+                    cls.discard(key)
+                return None
+
+            index.move_to_end(key)
+            cls.HITS += 1
+
+        # Served again, so it is as recent as a new one for the retention of the store
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return id, path
+
+    @classmethod
+    def store(cls, key : str, content : bytes) -> tuple[str, str]:
+        """Store an audio in the audio store and remember its content id by key,
+        forgetting the least recently used keys over the limit
+
+        Args:
+            key (str): key of the audio
+            content (bytes): audio
+
+        Returns:
+            tuple[str, str]: content id and path of the audio
+        """
+        id, stored = AudioStore.put(content)
+
+        path = cls.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+
+        with open(temporary, "w") as out:
+            out.write(id)
+        os.replace(temporary, path)
+
+        with cls.LOCK:
+            index = cls.index()
+            index.pop(key, None)
+            index[key] = id
+
+            while len(index) > cls.MAX_ITEMS:
+                old, _ = index.popitem(last=False)
+                cls.discard(old)
+
+        return id, stored
+
+    @classmethod
+    def discard(cls, key : str) -> None:
+        """Forget the content id of a key, the audio stays in the store
+
+        Args:
+            key (str): key of the audio
+        """
+        with cls.LOCK:
+            cls.index().pop(key, None)
+            try:
+                os.remove(cls.path(key))
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Get the counters of the cache
+
+        Returns:
+            dict: hits, misses and keys
+        """
+        with cls.LOCK:
+            return {
+                "hits": cls.HITS,
+                "misses": cls.MISSES,
+                "items": len(cls.index())
+            }
@@ -1,36 +1,53 @@
 """Synthesizes speech from the input string of text."""
+from google.api_core import operation as operations
 from google.cloud import texttospeech, speech
-from google.oauth2 import service_account
 
-from fastapi import HTTPException
+from fastapi import HTTPException, WebSocketDisconnect
+from starlette.requests import ClientDisconnect
 
 from datetime import datetime
+import asyncio
+import io
+import logging
 import os
+import wave
 from dotenv import load_dotenv
+from queue import Queue
 from random import randint
+from typing import AsyncIterator, Iterable, Iterator, Optional, Union
 
 from model import Audio, Message
+from controller.executor import Executor
+from controller.audioCache import AudioCache
+from controller.audioStore import AudioStore
+from controller.googleClients import GoogleClients
+from controller.singleFlight import SingleFlight
+from controller.metrics import AUDIO_BYTES
 
 load_dotenv()
 
-path = os.getenv("GOOGLE_APPLICATION_VERTEX_AI_CREDENTIALS")
-
-credentials = service_account.Credentials.from_service_account_file(path)
+logger = logging.getLogger(__name__)
 
 
 class Controller:
     
-    CLIENT_TEXT = texttospeech.TextToSpeechClient()
-    CLIENT_SPEECH = speech.SpeechClient()
     LANGUAGE_CODE = "es-US"
     LANGUAGE_CODE2 = "es-419"
     DEFAULT_VOICE = "es-US-Studio-B"
     SPEAKING_RATE = 1
+    AUDIO_ENCODING = texttospeech.AudioEncoding.LINEAR16
     AUDIO_CHANNEL_COUNT = 1
+    SAMPLE_RATE_HERTZ = 24000
     MODEL = "default"
+    SYNC_MAX_SECONDS = float(os.getenv("STT_SYNC_MAX_SECONDS", 55))
+    STREAM_MAX_SECONDS = float(os.getenv("STT_STREAM_MAX_SECONDS", 290))
+    STREAM_CHUNK_BYTES = int(os.getenv("STT_STREAM_CHUNK_BYTES", 16000))
+    LONG_TIMEOUT_SECONDS = float(os.getenv("STT_LONG_TIMEOUT_SECONDS", 90))
+    # Identical texts in flight share one synthesis
+    SYNTHESES = SingleFlight("tts")
     
     def saveAudio(bytes_ : bytes, message : str, userId : int) -> Audio:
-        """Save audio from text
+        """Save audio from text in the audio store
 
         Args:
             bytes (bytes): audio to save
@@ -44,34 +61,44 @@ class Controller:
             Audio: audio object
         """
         
-        now = datetime.now().date()
-        os.makedirs(f"./static/media/audio/{userId}", exist_ok=True)
-        path = f"./static/media/audio/{userId}/{now}-{randint(1,9999)}.mp3"
-        audio = Audio(id=randint(1,9999),
-            createdAt=now,
+        try:
+            id, path = AudioStore.put(bytes_)
+        except OSError as e:
+            raise HTTPException(status_code=500, detail=f"{e}")
+        
+        return Controller.audio(id, path, message, userId)
+    
+    def audio(id : str, path : str, message : str, userId : int) -> Audio:
+        """Get the audio object of a stored audio
+
+        Args:
+            id (str): content id of the audio
+            path (str): path of the audio
+            message (str): text of the audio
+            userId (int): user id
+
+        Returns:
+            Audio: audio object, its id is the first 48 bits of the content id
+        """
+        return Audio(id=int(id[:12], 16),
+            createdAt=datetime.now(),
             message=message,
             userId=userId,
-            audioPath=path
+            audioPath=path,
+            url=f"/audio/files/{id}"
         )
-        try:
-            with open(path, "wb") as out:
-                out.write(bytes_)
-        except Exception as e:
-            return HTTPException(status_code=500, detail=f"{e}")
-        
-        return audio
     
-    def getAudio(message : Message) -> Audio:
-        """Get audio from text
+    def synthesize(text : str) -> bytes:
+        """Synthesize speech, blocking until the audio is ready
 
         Args:
-            message (Message): message to get audio
+            text (str): text to synthesize
 
         Returns:
-            Audio: audio
+            bytes: audio
         """
         
-        input_text = texttospeech.SynthesisInput(text=message.message)
+        input_text = texttospeech.SynthesisInput(text=text)
 
         voice = texttospeech.VoiceSelectionParams(
             language_code=Controller.LANGUAGE_CODE,
@@ -79,34 +106,116 @@ class Controller:
         )
 
         audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.LINEAR16,
+            audio_encoding=Controller.AUDIO_ENCODING,
             speaking_rate=Controller.SPEAKING_RATE
         )
 
-        response = Controller.CLIENT_TEXT.synthesize_speech(
+        response = GoogleClients.get("textToSpeech").synthesize_speech(
             request={"input": input_text, "voice": voice, "audio_config": audio_config}
         )
+        AUDIO_BYTES.inc("synthesized", amount=len(response.audio_content))
+        
+        return response.audio_content
+    
+    def synthesizeCached(key : str, text : str) -> tuple[str, str]:
+        """Synthesize speech and store it in the audio store, cached by key
 
-        return Controller.saveAudio(response.audio_content, message.message, message.userId)
+        Args:
+            key (str): key of the audio in the cache
+            text (str): text to synthesize
 
-    def getMessage(audio : Audio) -> Message:
-        """Get message from audio
+        Returns:
+            tuple[str, str]: content id and path of the audio
+        """
+        return AudioCache.store(key, Controller.synthesize(text))
+    
+    async def getAudio(message : Message) -> Audio:
+        """Get audio from text
+
+        The audio is served from the cache when the same text was already
+        synthesized with the same voice and configuration. Cached or not, the
+        audio lives in the audio store and follows its retention.
 
         Args:
-            audio (Audio): audio to get message
+            message (Message): message to get audio
 
         Returns:
-            Message: message
+            Audio: audio
         """
+        
+        if not AudioCache.enabled():
+            content = await Executor.run("tts", Controller.synthesize, message.message)
+            return await Executor.run("store", Controller.saveAudio, content, message.message, message.userId)
+        
+        key = AudioCache.key(message.message, Controller.DEFAULT_VOICE, Controller.LANGUAGE_CODE,
+                             Controller.SPEAKING_RATE, texttospeech.AudioEncoding(Controller.AUDIO_ENCODING).name)
+        cached = AudioCache.lookup(key)
+        
+        if cached is None:
+            try:
+                cached = await Controller.SYNTHESES.do(key, lambda: Executor.run("tts", Controller.synthesizeCached, key, message.message))
+            except OSError as e:
+                raise HTTPException(status_code=500, detail=f"{e}")
+        
+        id, path = cached
+        return Controller.audio(id, path, message.message, message.userId)
 
-        with open(audio.audioPath, "rb") as audio_file:
-            content = audio_file.read()
+    def audioInfo(content : bytes) -> tuple[float, int]:
+        """Get the duration and sample rate of a LINEAR16 audio
 
-        audio_ = speech.RecognitionAudio(content=content)
+        Args:
+            content (bytes): WAV file or raw LINEAR16 samples
 
-        config = speech.RecognitionConfig(
+        Returns:
+            tuple[float, int]: duration in seconds and sample rate
+        """
+        if content[:4] == b"RIFF":
+            try:
+                with wave.open(io.BytesIO(content)) as file:
+                    return file.getnframes() / file.getframerate(), file.getframerate()
+            except (wave.Error, EOFError):
+                pass
+        
+        rate = Controller.SAMPLE_RATE_HERTZ
+        return len(content) / (2 * rate * Controller.AUDIO_CHANNEL_COUNT), rate
+
+    def samples(content : bytes) -> bytes:
+        """Get the LINEAR16 samples of an audio, without the header of a WAV file
+
+        Args:
+            content (bytes): WAV file or raw LINEAR16 samples
+
+        Returns:
+            bytes: raw LINEAR16 samples
+        """
+        if content[:4] == b"RIFF":
+            try:
+                with wave.open(io.BytesIO(content)) as file:
+                    return file.readframes(file.getnframes())
+            except (wave.Error, EOFError):
+                pass
+
+        return content
+
+    def recognitionMode(seconds : float) -> str:
+        """Choose how to transcribe an audio by its duration
+
+        Args:
+            seconds (float): duration of the audio
+
+        Returns:
+            str: sync, streaming or long
+        """
+        if seconds <= Controller.SYNC_MAX_SECONDS:
+            return "sync"
+        elif seconds <= Controller.STREAM_MAX_SECONDS:
+            return "streaming"
+        return "long"
+
+    def recognitionConfig(sampleRate : int) -> speech.RecognitionConfig:
+        return speech.RecognitionConfig(
             encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=24000,
+            sample_rate_hertz=sampleRate,
             language_code=Controller.LANGUAGE_CODE2,
             model=Controller.MODEL,
             audio_channel_count=Controller.AUDIO_CHANNEL_COUNT,
@@ -114,10 +223,153 @@ class Controller:
             enable_word_time_offsets=True
             )
 
-        operation = Controller.CLIENT_SPEECH.long_running_recognize(config=config, audio=audio_)
+    def split(content : bytes) -> Iterator[bytes]:
+        for start in range(0, len(content), Controller.STREAM_CHUNK_BYTES):
+            yield content[start:start + Controller.STREAM_CHUNK_BYTES]
+
+    def streamingRecognize(chunks : Iterable[bytes], sampleRate : int) -> Iterator:
+        """Open a streaming recognition with interim results
+
+        Args:
+            chunks (Iterable[bytes]): blocking iterator of audio chunks
+            sampleRate (int): sample rate of the audio
+
+        Returns:
+            Iterator: blocking iterator of StreamingRecognizeResponse
+        """
+        config = speech.StreamingRecognitionConfig(
+            config=Controller.recognitionConfig(sampleRate),
+            interim_results=True
+        )
+        requests = (speech.StreamingRecognizeRequest(audio_content=chunk) for chunk in chunks)
+        
+        return GoogleClients.get("speech").streaming_recognize(config=config, requests=requests)
+
+    def begin(path : str) -> tuple[Optional[str], Optional[str]]:
+        """Start the transcription of an audio file
+
+        Short clips use a synchronous recognition and longer ones a streaming
+        recognition, both ended on return; only the longest start a long
+        running operation, left to the caller to wait for.
+
+        Args:
+            path (str): path of the audio
+
+        Returns:
+            tuple[Optional[str], Optional[str]]: transcript, or the name of the long running operation
+        """
+
+        with open(path, "rb") as audio_file:
+            content = audio_file.read()
+
+        AUDIO_BYTES.inc("transcribed", amount=len(content))
+        seconds, sampleRate = Controller.audioInfo(content)
+        mode = Controller.recognitionMode(seconds)
+
+        if mode == "streaming":
+            # A streaming recognition takes only samples, the header would be read as audio
+            responses = Controller.streamingRecognize(Controller.split(Controller.samples(content)), sampleRate)
+            results = (result for response in responses for result in response.results if result.is_final)
+            return " ".join(result.alternatives[0].transcript for result in results if result.alternatives), None
+
+        audio_ = speech.RecognitionAudio(content=content)
+        config = Controller.recognitionConfig(sampleRate)
+
+        if mode == "sync":
+            return Controller.transcript(GoogleClients.get("speech").recognize(config=config, audio=audio_)), None
+
+        operation = GoogleClients.get("speech").long_running_recognize(config=config, audio=audio_)
+        return None, operation.operation.name
+
+    def operation(name : str) -> operations.Operation:
+        """Get a long running recognition started before, by this or by another process
+
+        Args:
+            name (str): name of the operation
+
+        Returns:
+            operations.Operation: operation, its result is the LongRunningRecognizeResponse
+        """
+        client = GoogleClients.get("speech").transport.operations_client
+        return operations.from_gapic(client.get_operation(name), client, speech.LongRunningRecognizeResponse,
+                                     metadata_type=speech.LongRunningRecognizeMetadata)
 
-        response = operation.result(timeout=90)
+    def transcript(response) -> str:
+        return " ".join(result.alternatives[0].transcript for result in response.results if result.alternatives)
+
+    def recognize(path : str) -> str:
+        """Transcribe an audio file, blocking until the transcription ends
+
+        Args:
+            path (str): path of the audio
+
+        Returns:
+            str: transcript
+        """
+        transcript, name = Controller.begin(path)
+        if name is None:
+            return transcript
         
-        message =" ".join(result.alternatives[0].transcript for result in response.results)
+        return Controller.transcript(Controller.operation(name).result(timeout=Controller.LONG_TIMEOUT_SECONDS))
+
+    async def getMessage(audio : Audio) -> Message:
+        """Get message from audio
+
+        Args:
+            audio (Audio): audio to get message
+
+        Returns:
+            Message: message
+        """
+        message = await Executor.run("speech", Controller.recognize, audio.audioPath)
+
+        return Message(id=randint(1,99999), createdAt=datetime.now(), message=message, userId=audio.userId)
+
+    async def streamMessage(chunks : AsyncIterator[bytes], userId : int, sampleRate : int = SAMPLE_RATE_HERTZ) -> AsyncIterator[Union[dict, Message]]:
+        """Transcribe live audio, returning the transcripts as they are recognized
+
+        Args:
+            chunks (AsyncIterator[bytes]): raw LINEAR16 audio as it arrives
+            userId (int): user id
+            sampleRate (int): sample rate of the audio
+
+        Yields:
+            dict: each interim or final transcript
+            Message: the whole final transcript, as the last item
+        """
+        queue_ : Queue = Queue()
+
+        def requests() -> Iterator[bytes]:
+            while (chunk := queue_.get()) is not None:
+                yield from Controller.split(chunk)
+
+        async def feed():
+            try:
+                async for chunk in chunks:
+                    if chunk:
+                        AUDIO_BYTES.inc("transcribed", amount=len(chunk))
+                        queue_.put(chunk)
+            except (ClientDisconnect, WebSocketDisconnect):
+                # A client gone mid upload ends the audio
+                pass
+            except Exception:
+                logger.exception("Reading the audio of a streaming recognition failed")
+            finally:
+                queue_.put(None)
+
+        feeder = asyncio.create_task(feed())
+        finals = []
+
+        try:
+            responses = Controller.streamingRecognize(requests(), sampleRate)
+            async for response in Executor.iterate("speech", responses):
+                for result in response.results:
+                    transcript = result.alternatives[0].transcript if result.alternatives else ""
+                    if result.is_final:
+                        finals.append(transcript)
+                    yield {"type": "final" if result.is_final else "interim", "transcript": transcript, "stability": result.stability}
+        finally:
+            feeder.cancel()
+            queue_.put(None)
 
-        return Message(id=randint(1,99999), createdAt=datetime.now(), message=message, userId=audio.userId)
\ No newline at end of file
+        yield Message(id=randint(1,99999), createdAt=datetime.now(), message=" ".join(finals), userId=userId)
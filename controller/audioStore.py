@@ -0,0 +1,219 @@
+"""Module to store the audios delivered to the clients
+
+    An audio is identified by the sha256 of its content, so two writes never
+    collide and the same audio is only kept once. The files are sharded by
+    the first two bytes of the id (ab/cd/abcd....wav) and removed by age
+    (AUDIO_STORE_MAX_AGE_SECONDS) and then by size, oldest first
+    (AUDIO_STORE_MAX_BYTES), by a periodic garbage collection.
+"""
+
+from hashlib import sha256
+from threading import RLock, get_ident
+from time import time
+import asyncio
+import os
+import re
+import shutil
+import subprocess
+from typing import Optional
+from dotenv import load_dotenv
+
+from controller.executor import Executor
+
+
+load_dotenv()
+
+
+class AudioStore:
+    """Class to store the audios by content id
+
+    """
+    DIRECTORY = os.getenv("AUDIO_STORE_DIR", "./data/audio")
+    MAX_BYTES = int(os.getenv("AUDIO_STORE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+    MAX_AGE_SECONDS = float(os.getenv("AUDIO_STORE_MAX_AGE_SECONDS", 30 * 24 * 3600))
+    GC_INTERVAL_SECONDS = float(os.getenv("AUDIO_STORE_GC_INTERVAL_SECONDS", 3600))
+    TRANSCODE = os.getenv("AUDIO_TRANSCODE", "true").lower() == "true"
+
+    ID = re.compile(r"^[0-9a-f]{64}$")
+    CONTENT_TYPES = {"wav": "audio/wav", "mp3": "audio/mpeg", "ogg": "audio/ogg", "bin": "application/octet-stream"}
+    # Arguments of ffmpeg by format asked by the client
+    FORMATS = {
+        "mp3": ("mp3", ["-codec:a", "libmp3lame", "-b:a", "64k", "-f", "mp3"]),
+        "opus": ("ogg", ["-codec:a", "libopus", "-b:a", "32k", "-f", "ogg"])
+    }
+
+    LOCK = RLock()
+    REMOVED = 0
+    REMOVED_BYTES = 0
+
+    def extension(content : bytes) -> str:
+        """Get the extension of an audio by its header
+
+        Args:
+            content (bytes): audio
+
+        Returns:
+            str: wav, mp3, ogg or bin
+        """
+        if content[:4] == b"RIFF" and content[8:12] == b"WAVE":
+            return "wav"
+        if content[:3] == b"ID3" or content[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+            return "mp3"
+        if content[:4] == b"OggS":
+            return "ogg"
+        return "bin"
+
+    def path(id : str, extension : str) -> str:
+        """Get the path of an audio
+
+        Args:
+            id (str): id of the audio
+            extension (str): extension of the file
+
+        Returns:
+            str: path of the file
+        """
+        return f"{AudioStore.DIRECTORY}/{id[:2]}/{id[2:4]}/{id}.{extension}"
+
+    @classmethod
+    def put(cls, content : bytes) -> tuple[str, str]:
+        """Store an audio, once by content
+
+        Args:
+            content (bytes): audio
+
+        Returns:
+            tuple[str, str]: id and path of the audio
+        """
+        id = sha256(content).hexdigest()
+        path = cls.path(id, cls.extension(content))
+
+        if os.path.exists(path):
+            # Written again, so it is as recent as a new one for the retention
+            os.utime(path)
+            return id, path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(temporary, "wb") as out:
+            out.write(content)
+        os.replace(temporary, path)
+
+        return id, path
+
+    @classmethod
+    def find(cls, id : str) -> Optional[str]:
+        """Get the path of a stored audio
+
+        Args:
+            id (str): id of the audio
+
+        Returns:
+            Optional[str]: path of the file if stored
+        """
+        if not cls.ID.match(id):
+            return None
+        for extension in cls.CONTENT_TYPES:
+            path = cls.path(id, extension)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def contentType(path : str) -> str:
+        return AudioStore.CONTENT_TYPES.get(path.rsplit(".", 1)[-1], "application/octet-stream")
+
+    def transcodable() -> bool:
+        return AudioStore.TRANSCODE and shutil.which("ffmpeg") is not None
+
+    @classmethod
+    def transcode(cls, path : str, format : str) -> str:
+        """Compress an audio with ffmpeg, keeping the result next to the original
+
+        Args:
+            path (str): path of the audio
+            format (str): mp3 or opus
+
+        Raises:
+            subprocess.CalledProcessError: if ffmpeg fails
+
+        Returns:
+            str: path of the compressed audio
+        """
+        extension, arguments = cls.FORMATS[format]
+        target = f"{path.rsplit('.', 1)[0]}.{format}.{extension}"
+
+        if not os.path.exists(target):
+            temporary = f"{target}.{os.getpid()}.{get_ident()}.tmp"
+            subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", path, *arguments, temporary],
+                           check=True, capture_output=True)
+            os.replace(temporary, target)
+
+        return target
+
+    @classmethod
+    def gc(cls, now : Optional[float] = None) -> dict:
+        """Remove the audios older than the maximum age, then the oldest ones over the maximum size
+
+        Args:
+            now (Optional[float]): current time, time() by default
+
+        Returns:
+            dict: files and bytes removed and kept
+        """
+        now = now or time()
+        files = []
+
+        with cls.LOCK:
+            for root, _, names in os.walk(cls.DIRECTORY):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+            files.sort()
+            size = sum(size for _, size, _ in files)
+            removed = removedBytes = 0
+
+            for mtime, fileSize, path in files:
+                # Temporary files of an interrupted write are removed after an hour
+                if path.endswith(".tmp"):
+                    if now - mtime <= 3600:
+                        continue
+                elif now - mtime <= cls.MAX_AGE_SECONDS and size <= cls.MAX_BYTES:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= fileSize
+                removed += 1
+                removedBytes += fileSize
+
+            cls.REMOVED += removed
+            cls.REMOVED_BYTES += removedBytes
+
+        return {"removed": removed, "removedBytes": removedBytes, "files": len(files) - removed, "bytes": size}
+
+    @classmethod
+    async def collect(cls) -> None:
+        """Run the garbage collection every AUDIO_STORE_GC_INTERVAL_SECONDS, until cancelled
+        """
+        while True:
+            try:
+                await Executor.run("store", cls.gc)
+            except OSError:
+                pass
+            await asyncio.sleep(cls.GC_INTERVAL_SECONDS)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Get the counters of the store
+
+        Returns:
+            dict: files and bytes removed by the garbage collection
+        """
+        with cls.LOCK:
+            return {"removed": cls.REMOVED, "removedBytes": cls.REMOVED_BYTES}
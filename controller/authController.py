@@ -1,30 +1,71 @@
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi import HTTPException, Depends
 
-from passlib.context import CryptContext
 from jose import jwt, JWTError
+from cachetools import TLRUCache, TTLCache
 
+import asyncio
 import os
+from itertools import count
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from threading import Lock
+from time import monotonic, time
 
 from controller import UserController
+from controller.crypt import Crypt
 from model import User
 
 
 load_dotenv()
 
+class Generations(TTLCache):
+    """Class to keep the generation of the users written recently
+
+    A user missing from the map is at the floor generation, raised by every
+    entry evicted for room, so the caches written before an eviction never
+    take the floor for a match. The expired entries outlive every cached
+    claim and principal, so they need no floor.
+    """
+
+    def __init__(self, maxsize : int, ttl : float):
+        super().__init__(maxsize=maxsize, ttl=ttl, timer=monotonic)
+        self.floor = 0
+
+    def popitem(self):
+        key, generation = super().popitem()
+        self.floor = max(self.floor, generation)
+        return key, generation
+
+    def of(self, id : int) -> int:
+        return self.get(id, self.floor)
+
 class Controller:
 
     ALGORITHM = os.getenv("ALGORITHM")
-    BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS"))
+    BCRYPT_ROUNDS = Crypt.BCRYPT_ROUNDS
     ACCESS_TOKEN_EXPIRE_MINUTES = float(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
     SECRET = os.getenv("SECRET")
+    TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", 10000))
+    PRINCIPAL_CACHE_SIZE = int(os.getenv("AUTH_PRINCIPAL_CACHE_SIZE", 10000))
+    PRINCIPAL_TTL_SECONDS = float(os.getenv("AUTH_PRINCIPAL_TTL_SECONDS", 30))
     
     OAUTH2 = OAuth2PasswordBearer(tokenUrl="login")
-    CRYPT = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS)
+    CRYPT = Crypt.CONTEXT
     
-    def authentication(data : OAuth2PasswordRequestForm) -> dict:
+    # Verified claims by token hash with the generation of their user, each one expiring with the token
+    TOKENS = TLRUCache(maxsize=TOKEN_CACHE_SIZE, ttu=lambda key, entry, now: now + entry[0]["exp"] - time(), timer=monotonic)
+    # Resolved users by id with their generation
+    PRINCIPALS = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_TTL_SECONDS, timer=monotonic)
+    # A write of a user gives it a new generation, so the cached entries of an older one are not served,
+    # kept as long as any token or principal lives
+    GENERATIONS = Generations(maxsize=max(TOKEN_CACHE_SIZE, PRINCIPAL_CACHE_SIZE), ttl=max(ACCESS_TOKEN_EXPIRE_MINUTES * 60, PRINCIPAL_TTL_SECONDS))
+    WRITES = count(1)
+    LOCK = Lock()
+    REHASHES : set[asyncio.Task] = set()
+
+    async def authentication(data : OAuth2PasswordRequestForm) -> dict:
         """Authenticate user
 
         Args:
@@ -32,27 +73,92 @@ class Controller:
             
         Raises:
             HTTPException: 400 if user not found or password is incorrect
+            HTTPException: 429 if too many logins are waiting for bcrypt
 
         Returns:
             dict: access token and token type
         """
-        user = UserController.getUserByEmail(data.username)
-        user = UserController.getUserByUserName(data.username) if not user else user
+        user = await UserController.getUserByEmail(data.username)
+        user = await UserController.getUserByUserName(data.username) if not user else user
         
         if not user:
             raise HTTPException(status_code=400, detail="User not found")
-        elif not Controller.CRYPT.verify(data.password, user.password):
+
+        verified, hash = await Crypt.verify(data.password, user.password)
+
+        if not verified:
             raise HTTPException(status_code=400, detail="Incorrect password")
+        elif hash is not None:
+            Controller.rehash(user, hash)
         
         access_token = {
-            "sub": user.id,
+            "sub": str(user.id),
             "userName": user.userName,
             "exp": datetime.now(timezone.utc) + timedelta(minutes=Controller.ACCESS_TOKEN_EXPIRE_MINUTES)
         }
         
         return {"access_token": jwt.encode(access_token, key = Controller.SECRET,algorithm = Controller.ALGORITHM), "token_type": "bearer"}
     
-    def authUser(token : str = Depends(OAUTH2)) -> User:
+    def rehash(user : User, hash : str) -> None:
+        """Store the hash of a password verified with outdated rounds, without delaying the login
+
+        Args:
+            user (User): user that logged in
+            hash (str): hash with the configured rounds
+        """
+
+        async def update():
+            try:
+                await UserController.putUser(user.model_copy(update={"password": hash}))
+            except HTTPException:
+                pass
+
+        task = asyncio.create_task(update())
+        Controller.REHASHES.add(task)
+        task.add_done_callback(Controller.REHASHES.discard)
+
+    def decode(token : str) -> dict:
+        """Verify a token, reusing the claims of a token already verified
+
+        Args:
+            token (str): token from header
+
+        Raises:
+            HTTPException: 401 if token is invalid
+
+        Returns:
+            dict: claims of the token
+        """
+        key = sha256(token.encode()).digest()
+
+        with Controller.LOCK:
+            entry = Controller.TOKENS.get(key)
+            if entry is not None and entry[1] == Controller.GENERATIONS.of(entry[0].get("sub")):
+                return entry[0]
+
+        try:
+            claims = jwt.decode(token, key=Controller.SECRET, algorithms=[Controller.ALGORITHM])
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Invalid token")
+
+        if isinstance(claims.get("exp"), (int, float)):
+            with Controller.LOCK:
+                Controller.TOKENS[key] = (claims, Controller.GENERATIONS.of(claims.get("sub")))
+
+        return claims
+
+    def invalidateUser(id : int) -> None:
+        """Give a user a new generation after a write, so its cached principal
+        and tokens are not served again
+
+        Args:
+            id (int): id of the user
+        """
+        with Controller.LOCK:
+            Controller.GENERATIONS[str(id)] = next(Controller.WRITES)
+            Controller.PRINCIPALS.pop(id, None)
+
+    async def authUser(token : str = Depends(OAUTH2)) -> User:
         """Authenticate user
         
         Args:
@@ -72,17 +178,31 @@ class Controller:
 
         #print(token)
         
-        try:            
-            userData = jwt.decode(token, key=Controller.SECRET, algorithms=[Controller.ALGORITHM])
-        
-            user = UserController.getUserById(userData.get("sub"))
-            user = UserController.getUserByUserName(userData.get("userName")) if not user else user 
-        
-            if not user:
-                raise HTTPException(status_code=400, detail="User not found")
-        
-        
-        except JWTError:
+        userData = Controller.decode(token)
+
+        try:
+            id = int(userData.get("sub"))
+        except (TypeError, ValueError):
             raise HTTPException(status_code=401, detail="Invalid token")
-    
-        return user
\ No newline at end of file
+
+        with Controller.LOCK:
+            entry = Controller.PRINCIPALS.get(id)
+            generation = Controller.GENERATIONS.of(str(id))
+
+        if entry is not None and entry[1] == generation:
+            return entry[0]
+
+        user = await UserController.getUserById(id)
+        user = await UserController.getUserByUserName(userData.get("userName")) if not user else user
+
+        if not user:
+            raise HTTPException(status_code=400, detail="User not found")
+
+        with Controller.LOCK:
+            if Controller.GENERATIONS.of(str(id)) == generation:
+                Controller.PRINCIPALS[id] = (user, generation)
+
+        return user
+
+
+UserController.subscribe(Controller.invalidateUser)
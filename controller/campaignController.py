@@ -0,0 +1,343 @@
+"""Module to pre-render the audio reminders of a collection campaign
+
+    A campaign is a list of (userId, template) pairs. The templates are filled
+    with the financial profile of each user, the identical texts are
+    synthesized once, and the audios are written to the audio store. The
+    synthesis runs in its own pool (CAMPAIGN_WORKERS) paced under the
+    Text-to-Speech quota (CAMPAIGN_REQUESTS_PER_MINUTE), so a campaign never
+    takes the threads of the interactive endpoints.
+
+    The campaigns and the result of each item are kept in SQLite, so the
+    campaigns interrupted by a restart are resumed from their pending items.
+    An error of an item is recorded on the item; a campaign that fails as a
+    whole is marked failed and is not resumed.
+"""
+
+from fastapi import HTTPException
+from google.api_core import exceptions
+
+import asyncio
+import logging
+import os
+import re
+from time import monotonic
+from typing import Optional
+from uuid import uuid4
+from dotenv import load_dotenv
+
+from controller import AudioController
+from controller.audioStore import AudioStore
+from controller.executor import Executor
+from controller.profileCache import ProfileCache
+from controller.sqliteStore import SQLiteStore
+from model import Campaign, CampaignItemResult, CampaignJob, FinancialProfile
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class CampaignStore(SQLiteStore):
+    """Class to persist the campaigns and their items
+
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            createdAt TEXT NOT NULL,
+            updatedAt TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS campaign_items (
+            campaignId TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            userId INTEGER NOT NULL,
+            template TEXT NOT NULL,
+            text TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            audioPath TEXT,
+            url TEXT,
+            error TEXT,
+            PRIMARY KEY (campaignId, idx)
+        );
+        CREATE INDEX IF NOT EXISTS campaign_items_text ON campaign_items (campaignId, text);
+        CREATE INDEX IF NOT EXISTS campaign_items_status ON campaign_items (campaignId, status);
+    """
+
+    def __init__(self, path : str = None):
+        super().__init__(path or os.getenv("CAMPAIGN_SQLITE_PATH", "./data/campaigns.sqlite3"))
+        self.connection().executescript(CampaignStore.SCHEMA)
+
+    def create(self, id : str, campaign : Campaign) -> None:
+        connection = self.connection()
+        now = CampaignStore.now()
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute("INSERT INTO campaigns VALUES (?, 'pending', ?, ?)", (id, now, now))
+            connection.executemany("INSERT INTO campaign_items (campaignId, idx, userId, template) VALUES (?, ?, ?, ?)",
+                                   [(id, index, item.userId, item.template) for index, item in enumerate(campaign.items)])
+
+    def setStatus(self, id : str, status : str) -> None:
+        self.connection().execute("UPDATE campaigns SET status = ?, updatedAt = ? WHERE id = ?", (status, CampaignStore.now(), id))
+
+    def unfinished(self) -> list[str]:
+        rows = self.connection().execute("SELECT id FROM campaigns WHERE status IN ('pending', 'running') ORDER BY createdAt").fetchall()
+        return [id for (id,) in rows]
+
+    def job(self, id : str) -> Optional[CampaignJob]:
+        """Get a campaign with the count of its items by status
+
+        Args:
+            id (str): id of the campaign
+
+        Returns:
+            Optional[CampaignJob]: campaign, None if it does not exist
+        """
+        connection = self.connection()
+        row = connection.execute("SELECT status, createdAt, updatedAt FROM campaigns WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        counts = dict(connection.execute("SELECT status, COUNT(*) FROM campaign_items WHERE campaignId = ? GROUP BY status", (id,)).fetchall())
+        return CampaignJob(id=id, status=row[0], createdAt=row[1], updatedAt=row[2], total=sum(counts.values()),
+                           pending=counts.get("pending", 0), done=counts.get("done", 0), failed=counts.get("failed", 0))
+
+    def items(self, id : str, offset : int, limit : int) -> list[CampaignItemResult]:
+        rows = self.connection().execute(
+            "SELECT idx, userId, status, text, audioPath, url, error FROM campaign_items WHERE campaignId = ? ORDER BY idx LIMIT ? OFFSET ?",
+            (id, limit, offset)).fetchall()
+        fields = ("index", "userId", "status", "text", "audioPath", "url", "error")
+        return [CampaignItemResult(**dict(zip(fields, row))) for row in rows]
+
+    def unrendered(self, id : str) -> list[tuple[int, int, str]]:
+        return self.connection().execute(
+            "SELECT idx, userId, template FROM campaign_items WHERE campaignId = ? AND status = 'pending' AND text IS NULL", (id,)).fetchall()
+
+    def render(self, id : str, texts : list[tuple[int, Optional[str], Optional[str]]]) -> None:
+        """Store the texts of the items, or fail the items that could not be rendered
+
+        Args:
+            id (str): id of the campaign
+            texts (list[tuple[int, Optional[str], Optional[str]]]): index, text and error of each item
+        """
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany("UPDATE campaign_items SET text = ?, error = ?, status = CASE WHEN ? IS NULL THEN 'pending' ELSE 'failed' END WHERE campaignId = ? AND idx = ?",
+                                   [(text, error, error, id, index) for index, text, error in texts])
+
+    def pendingTexts(self, id : str) -> list[str]:
+        rows = self.connection().execute(
+            "SELECT DISTINCT text FROM campaign_items WHERE campaignId = ? AND status = 'pending' AND text IS NOT NULL", (id,)).fetchall()
+        return [text for (text,) in rows]
+
+    def rendered(self, id : str, text : str) -> Optional[tuple[str, str]]:
+        # An item with the same text done before an interruption
+        return self.connection().execute(
+            "SELECT audioPath, url FROM campaign_items WHERE campaignId = ? AND text = ? AND status = 'done' LIMIT 1", (id, text)).fetchone()
+
+    def complete(self, id : str, text : str, audioPath : Optional[str], url : Optional[str], error : Optional[str]) -> None:
+        self.connection().execute(
+            "UPDATE campaign_items SET status = ?, audioPath = ?, url = ?, error = ? WHERE campaignId = ? AND text = ? AND status = 'pending'",
+            ("failed" if error else "done", audioPath, url, error, id, text))
+
+
+class Controller:
+
+    WORKERS = int(os.getenv("CAMPAIGN_WORKERS", 4))
+    REQUESTS_PER_MINUTE = float(os.getenv("CAMPAIGN_REQUESTS_PER_MINUTE", 300))
+    RETRIES = int(os.getenv("CAMPAIGN_RETRIES", 3))
+    RETRY_BACKOFF_SECONDS = float(os.getenv("CAMPAIGN_RETRY_BACKOFF_SECONDS", 2))
+    # Errors of Text-to-Speech worth waiting for
+    TRANSIENT = (exceptions.ResourceExhausted, exceptions.TooManyRequests, exceptions.ServiceUnavailable, exceptions.DeadlineExceeded)
+    PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+    STORE : Optional[CampaignStore] = None
+    TASKS : dict[str, asyncio.Task] = {}
+    # Time of the next synthesis allowed by the quota, shared by every campaign
+    NEXT_REQUEST_AT = 0.0
+
+    Executor.configure("campaign", workers=WORKERS)
+
+    def store() -> CampaignStore:
+        if Controller.STORE is None:
+            Controller.STORE = CampaignStore()
+        return Controller.STORE
+
+    async def call(function, *args):
+        return await Executor.run("sqlite", function, *args)
+
+    def render(template : str, profile : FinancialProfile) -> str:
+        """Fill the placeholders of a template with the fields of a profile
+
+        Args:
+            template (str): text with {field} placeholders
+            profile (FinancialProfile): profile of the user
+
+        Raises:
+            KeyError: if a placeholder is not a field of the profile
+
+        Returns:
+            str: text of the reminder
+        """
+        values = profile.model_dump(mode="json")
+        return Controller.PLACEHOLDER.sub(lambda match: str(values[match.group(1)]), template)
+
+    async def pace() -> None:
+        """Wait for the turn of the next synthesis under CAMPAIGN_REQUESTS_PER_MINUTE,
+        0 or less leaves the syntheses unthrottled
+        """
+        if Controller.REQUESTS_PER_MINUTE <= 0:
+            return
+        now = monotonic()
+        wait = Controller.NEXT_REQUEST_AT - now
+        Controller.NEXT_REQUEST_AT = max(now, Controller.NEXT_REQUEST_AT) + 60 / Controller.REQUESTS_PER_MINUTE
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def synthesize(text : str) -> tuple[str, str]:
+        """Synthesize a text into the audio store, retrying the quota errors
+
+        Args:
+            text (str): text to synthesize
+
+        Returns:
+            tuple[str, str]: path and url of the audio
+        """
+        for attempt in range(Controller.RETRIES + 1):
+            await Controller.pace()
+            try:
+                content = await Executor.run("campaign", AudioController.synthesize, text)
+                break
+            # A full campaign pool answers like a busy service
+            except (*Controller.TRANSIENT, HTTPException):
+                if attempt == Controller.RETRIES:
+                    raise
+                await asyncio.sleep(Controller.RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+        id, path = await Executor.run("store", AudioStore.put, content)
+        return path, f"/audio/files/{id}"
+
+    async def process(id : str) -> None:
+        """Render the pending items of a campaign, marking it failed on an
+        unexpected error
+
+        Args:
+            id (str): id of the campaign
+        """
+        try:
+            await Controller.run(id)
+        except Exception:
+            logger.exception("Campaign %s failed", id)
+            await Controller.call(Controller.store().setStatus, id, "failed")
+
+    async def run(id : str) -> None:
+        """Render the pending items of a campaign
+
+        Args:
+            id (str): id of the campaign
+        """
+        store = Controller.store()
+        await Controller.call(store.setStatus, id, "running")
+
+        async def fill(index : int, userId : int, template : str) -> tuple[int, Optional[str], Optional[str]]:
+            try:
+                return index, Controller.render(template, await ProfileCache.get(userId)), None
+            except HTTPException as e:
+                return index, None, f"{e.detail}"
+            except KeyError as e:
+                return index, None, f"Unknown field {e}"
+            except Exception as e:
+                return index, None, f"{e}"
+
+        unrendered = await Controller.call(store.unrendered, id)
+        for start in range(0, len(unrendered), 1000):
+            texts = await asyncio.gather(*(fill(*item) for item in unrendered[start:start + 1000]))
+            await Controller.call(store.render, id, texts)
+
+        queue = asyncio.Queue()
+        for text in await Controller.call(store.pendingTexts, id):
+            queue.put_nowait(text)
+
+        async def work():
+            while not queue.empty():
+                text = queue.get_nowait()
+                done = await Controller.call(store.rendered, id, text)
+                try:
+                    path, url = done if done is not None else await Controller.synthesize(text)
+                    await Controller.call(store.complete, id, text, path, url, None)
+                # The error of an item must not stop the other items
+                except Exception as e:
+                    await Controller.call(store.complete, id, text, None, None, f"{e}")
+
+        await asyncio.gather(*(work() for _ in range(Controller.WORKERS)))
+        await Controller.call(store.setStatus, id, "done")
+
+    def start(id : str) -> None:
+        task = asyncio.create_task(Controller.process(id))
+        Controller.TASKS[id] = task
+        task.add_done_callback(lambda _: Controller.TASKS.pop(id, None))
+
+    async def create(campaign : Campaign) -> CampaignJob:
+        """Store a campaign and start rendering it
+
+        Args:
+            campaign (Campaign): reminders to render
+
+        Returns:
+            CampaignJob: progress of the campaign
+        """
+        id = uuid4().hex
+        store = Controller.store()
+        await Controller.call(store.create, id, campaign)
+        Controller.start(id)
+        return await Controller.call(store.job, id)
+
+    async def getJob(id : str) -> CampaignJob:
+        """Get the progress of a campaign
+
+        Args:
+            id (str): id of the campaign
+
+        Raises:
+            HTTPException: 404 Campaign not found
+
+        Returns:
+            CampaignJob: progress of the campaign
+        """
+        job = await Controller.call(Controller.store().job, id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Campaign not found")
+        return job
+
+    async def getItems(id : str, offset : int = 0, limit : int = 100) -> list[CampaignItemResult]:
+        """Get the results of the items of a campaign
+
+        Args:
+            id (str): id of the campaign
+            offset (int): items to skip
+            limit (int): maximum items to return
+
+        Raises:
+            HTTPException: 404 Campaign not found
+
+        Returns:
+            list[CampaignItemResult]: results in the order of the campaign
+        """
+        await Controller.getJob(id)
+        return await Controller.call(Controller.store().items, id, offset, limit)
+
+    async def resume() -> None:
+        """Start again the campaigns interrupted by a shutdown
+        """
+        for id in await Controller.call(Controller.store().unfinished):
+            if id not in Controller.TASKS:
+                Controller.start(id)
+
+    async def stop() -> None:
+        """Stop the running campaigns, they are resumed on the next start
+        """
+        tasks = list(Controller.TASKS.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,13 +1,16 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel
-from vertexai.generative_models import ChatSession 
-
-from model import Message, MessageBot
-from controller import UserController
-from model import UserUtils
+from model import Message, MessageBot, FinancialProfile
+from controller.chatSessions import SessionManager
+from controller.conversationLog import ConversationLog
+from controller.executor import Executor
+from controller.googleClients import GoogleClients
+from controller.profileCache import ProfileCache
+from controller.responseCache import ResponseCache
+from controller.singleFlight import SingleFlight
 
 from random import randint
+from datetime import datetime
 from dotenv import load_dotenv
+from typing import AsyncIterator, Optional, Union
 import os
 
 load_dotenv()
@@ -18,16 +21,53 @@ class Controller:
     LOCATION = os.getenv("GOOGLE_LOCATION")
     MODEL_ID = os.getenv("GOOGLE_MODEL_ID")
     
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
-    
     TEMPLATE = "Eres un asesor financiero que deseas que tu cliente salde sus cuentas con la empresa. Tienes que ser pasivo pero firme. Limitate a conversar con el cliente sobre su vida crediticia, nada fuera de lo común. Antes de cada consulta del cliente se te compartira información sobre el, esta vendra en formato json. Apartir de la siguiente consulta hablaras con el cliente."
     
-    MODEL = GenerativeModel(MODEL_ID, system_instruction=TEMPLATE)
+    # The model is built by GoogleClients on the first message, see getResponse
+    SESSIONS = SessionManager(lambda history: GoogleClients.get("model").start_chat(history=history), lambda userId: Controller.restore(userId))
+    
+    # Identical questions in flight (same user, profile and question) share one call to the model
+    ANSWERS = SingleFlight("model")
+    
+    @classmethod
+    async def getPrompt(cls, message : Message, profile : Optional[FinancialProfile] = None) -> str:
+        """Build the prompt of a message with the financial profile of the client
+
+        Args:
+            message (Message): Message of the client
+            profile (Optional[FinancialProfile]): profile of the client, fetched if not given
+
+        Returns:
+            str: prompt for the model
+        """
+        profile = profile or await ProfileCache.get(message.userId)
+        client = profile.model_dump_json(exclude_none=True)
+        return f"Información del cliente:\n{client}\nMensaje del cliente\n{message.message}"
     
-    CHAT = MODEL.start_chat()
+    @classmethod
+    async def restore(cls, userId : int) -> Optional[list]:
+        """Build the history of a chat session from the last turns of the conversation log
+
+        The questions are restored without the profile sent with them, it is
+        sent again with the next question.
+
+        Args:
+            userId (int): id of the user
+
+        Returns:
+            Optional[list]: contents of the history, None if the user has no turns
+        """
+        turns = await ConversationLog.last(userId, SessionManager.MAX_TURNS)
+        if not turns:
+            return None
+        
+        # Already imported by the model built before the session
+        from vertexai.generative_models import Content, Part
+        return [content for message, response in turns
+                for content in (Content(role="user", parts=[Part.from_text(message)]), Content(role="model", parts=[Part.from_text(response)]))]
     
     @classmethod
-    def getResponse(cls, message : Message) -> MessageBot:
+    async def getResponse(cls, message : Message) -> MessageBot:
         """Get the response from the chat bot
 
         Args:
@@ -36,13 +76,103 @@ class Controller:
         Returns:
             MessageBot: Response from the bot
         """
-        client = UserUtils.to_json(UserController.getUserById(message.userId))
-        message =f"Información del cliente:\n{client}\nMensaje del cliente\n{message.message}"
-        response = cls.CHAT.send_message()
-        return MessageBot(id = randint(1,99999), createdAt = response.timestamp, userId = message.userId, response = response.text)
-    
-    
+        profile = await ProfileCache.get(message.userId)
+        key = ResponseCache.key(profile, message.message)
+        answer = ResponseCache.get(key)
+        
+        if answer is None:
+            answer = await cls.ANSWERS.do(key, lambda: cls.ask(message, profile, key))
+        else:
+            await cls.remember(message, answer)
+        
+        response = MessageBot(id = randint(1,99999), createdAt = datetime.now(), userId = message.userId, response = answer)
+        ConversationLog.append(message.userId, message.id, message.message, response.id, answer)
+        return response
     
+    @classmethod
+    async def ask(cls, message : Message, profile : FinancialProfile, key : tuple[int, str, str]) -> str:
+        """Send a question to the model in the session of the client and cache the answer
+
+        Args:
+            message (Message): Message of the client
+            profile (FinancialProfile): profile of the client
+            key (tuple[int, str, str]): key of the question in the response cache
+
+        Returns:
+            str: answer of the model
+        """
+        prompt = await cls.getPrompt(message, profile)
+        await GoogleClients.load("model")
+        session = await cls.SESSIONS.open(message.userId)
+        
+        async with session.lock:
+            response = await Executor.run("vertex", session.chat.send_message, prompt)
+            cls.SESSIONS.trim(session)
+        
+        ResponseCache.put(key, response.text)
+        return response.text
     
+    @classmethod
+    async def remember(cls, message : Message, answer : str) -> None:
+        """Add a cached answer to the session of the client, so the next questions keep it in context
+
+        A session not in memory is rehydrated from the conversation log, which
+        already has the turn.
+
+        Args:
+            message (Message): Message of the client
+            answer (str): cached answer
+        """
+        session = cls.SESSIONS.find(message.userId)
+        if session is None:
+            return
+        
+        # Already imported by the model built before the session
+        from vertexai.generative_models import Content, Part
+        async with session.lock:
+            history = list(session.chat.history)
+            history += [Content(role="user", parts=[Part.from_text(message.message)]), Content(role="model", parts=[Part.from_text(answer)])]
+            session.chat = cls.SESSIONS.factory(history)
+            cls.SESSIONS.trim(session)
     
-    
\ No newline at end of file
+    @classmethod
+    async def streamResponse(cls, message : Message) -> AsyncIterator[Union[str, MessageBot]]:
+        """Stream the response from the chat bot as the model produces it
+
+        Args:
+            message (Message): Message to send to the bot
+
+        Yields:
+            str: each chunk of text of the response
+            MessageBot: the whole response, as the last item
+        """
+        profile = await ProfileCache.get(message.userId)
+        key = ResponseCache.key(profile, message.message)
+        answer = ResponseCache.get(key)
+        
+        if answer is not None:
+            await cls.remember(message, answer)
+        elif key in cls.ANSWERS:
+            # The same question is in flight without streaming, its answer is sent whole
+            answer = await cls.ANSWERS.do(key, lambda: cls.ask(message, profile, key))
+        
+        if answer is None:
+            prompt = await cls.getPrompt(message, profile)
+            await GoogleClients.load("model")
+            session = await cls.SESSIONS.open(message.userId)
+            chunks = []
+            
+            async with session.lock:
+                async for chunk in Executor.iterate("vertex", session.chat.send_message(prompt, stream=True)):
+                    chunks.append(chunk.text)
+                    yield chunk.text
+                cls.SESSIONS.trim(session)
+            
+            answer = "".join(chunks)
+            ResponseCache.put(key, answer)
+        else:
+            yield answer
+        
+        response = MessageBot(id = randint(1,99999), createdAt = datetime.now(), userId = message.userId, response = answer)
+        ConversationLog.append(message.userId, message.id, message.message, response.id, answer)
+        yield response
@@ -0,0 +1,167 @@
+"""Module to keep one bounded conversation per user with the chat bot
+
+    Sessions are evicted by LRU and TTL, and the history of each session is
+    truncated to the last turns so the prompt sent to the model and the
+    memory of the process stay bounded. A session created again after an
+    eviction or a restart is rehydrated from the last turns kept by a loader.
+"""
+
+from asyncio import Lock
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+import os
+from typing import TYPE_CHECKING, Awaitable, Callable, Hashable, Optional
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    # Importing Vertex AI takes seconds, it is only needed by the type checker
+    from vertexai.generative_models import ChatSession
+
+
+load_dotenv()
+
+
+class Session:
+    """Class to represent the conversation of a user with the chat bot
+    """
+
+    def __init__(self, key : Hashable, chat : "ChatSession"):
+        self.key = key
+        self.chat = chat
+        self.lock = Lock()
+        self.usedAt = monotonic()
+
+
+class SessionManager:
+    """Class to store the chat sessions by user
+
+    """
+    MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", 1000))
+    TTL_SECONDS = float(os.getenv("CHAT_SESSION_TTL_SECONDS", 1800))
+    MAX_TURNS = int(os.getenv("CHAT_MAX_TURNS", 10))
+    MAX_HISTORY_CHARS = int(os.getenv("CHAT_MAX_HISTORY_CHARS", 24000))
+
+    def __init__(self, factory : Callable[[Optional[list]], "ChatSession"], loader : Optional[Callable[[Hashable], Awaitable[Optional[list]]]] = None):
+        """Create a session manager
+
+        Args:
+            factory (Callable[[Optional[list]], ChatSession]): creates a chat session from a history
+            loader (Optional[Callable[[Hashable], Awaitable[Optional[list]]]]): reads the history of a key not in memory
+        """
+        self.factory = factory
+        self.loader = loader
+        self.sessions : OrderedDict[Hashable, Session] = OrderedDict()
+        self.lock = RLock()
+
+    def get(self, key : Hashable, history : Optional[list] = None) -> Session:
+        """Get the session of a key, creating it if needed
+
+        Args:
+            key (Hashable): user id or conversation id
+            history (Optional[list]): history of the session if it is created
+
+        Returns:
+            Session: session of the key
+        """
+        with self.lock:
+            self.evict()
+            session = self.sessions.get(key)
+
+            if session is None:
+                session = Session(key, self.factory(history or None))
+                self.sessions[key] = session
+                if len(self.sessions) > self.MAX_SESSIONS:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(key)
+
+            session.usedAt = monotonic()
+            return session
+
+    async def open(self, key : Hashable) -> Session:
+        """Get the session of a key, rehydrating it from the loader if it is not in memory
+
+        Args:
+            key (Hashable): user id or conversation id
+
+        Returns:
+            Session: session of the key
+        """
+        with self.lock:
+            self.evict()
+            missing = key not in self.sessions
+
+        history = await self.loader(key) if missing and self.loader is not None else None
+        return self.get(key, history)
+
+    def find(self, key : Hashable) -> Optional[Session]:
+        """Get the session of a key if it is in memory
+
+        Args:
+            key (Hashable): user id or conversation id
+
+        Returns:
+            Optional[Session]: session of the key
+        """
+        with self.lock:
+            self.evict()
+            session = self.sessions.get(key)
+            if session is not None:
+                self.sessions.move_to_end(key)
+                session.usedAt = monotonic()
+            return session
+
+    def drop(self, key : Hashable) -> None:
+        """Forget the session of a key
+
+        Args:
+            key (Hashable): user id or conversation id
+        """
+        with self.lock:
+            self.sessions.pop(key, None)
+
+    def evict(self) -> None:
+        """Remove the sessions not used for longer than the TTL
+        """
+        limit = monotonic() - self.TTL_SECONDS
+        with self.lock:
+            while self.sessions:
+                key, session = next(iter(self.sessions.items()))
+                if session.usedAt >= limit:
+                    break
+                del self.sessions[key]
+
+    def trim(self, session : Session) -> None:
+        """Truncate the oldest turns of a session
+
+        A turn is a user content followed by a model content, so the history is
+        always cut on a user content. The last turn is always kept.
+
+        Args:
+            session (Session): session to trim
+        """
+        history = list(session.chat.history)
+        start = max(0, len(history) - 2 * self.MAX_TURNS)
+        size = sum(SessionManager.length(content) for content in history[start:])
+
+        while start < len(history) - 2 and size > self.MAX_HISTORY_CHARS:
+            size -= SessionManager.length(history[start]) + SessionManager.length(history[start + 1])
+            start += 2
+
+        if start > 0:
+            session.chat = self.factory(history[start:])
+
+    def length(content) -> int:
+        """Get the number of characters of a history content
+
+        Args:
+            content (Content): content of the history
+
+        Returns:
+            int: characters of the text parts
+        """
+        return sum(len(getattr(part, "text", "") or "") for part in content.parts)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
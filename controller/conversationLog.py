@@ -0,0 +1,302 @@
+"""Module to keep the conversations of the users with the chat bot
+
+    Each answered question is appended to a buffer in memory and written to
+    SQLite (WAL) in batches by a background task, so the chat endpoints never
+    wait for the disk. The turns are indexed by user and id, which grows with
+    time, so a page of the history or the last turns of a user are read
+    without scanning the log. They serve the /chatbot/history endpoint, the
+    audit of the conversations and the rehydration of the chat sessions
+    evicted from memory or lost in a restart.
+
+    The compaction deletes the turns older than CONVERSATION_RETENTION_SECONDS
+    and beyond the last CONVERSATION_MAX_TURNS_PER_USER of each user, and
+    gives the free pages back to the file system.
+"""
+
+import asyncio
+import logging
+import os
+from collections import deque
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Optional
+from dotenv import load_dotenv
+
+from model import ConversationTurn, HistoryQuery
+from controller.executor import Executor
+from controller.sqliteStore import SQLiteStore
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStore(SQLiteStore):
+    """Class to persist the turns of the conversations
+
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversation_turns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            userId INTEGER NOT NULL,
+            createdAt TEXT NOT NULL,
+            messageId INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            responseId INTEGER NOT NULL,
+            response TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversation_turns_user ON conversation_turns (userId, id);
+        CREATE INDEX IF NOT EXISTS conversation_turns_time ON conversation_turns (createdAt);
+    """
+    FIELDS = ("id", "userId", "createdAt", "messageId", "message", "responseId", "response")
+    TIMEOUT_SECONDS = 30
+    # Ignored once the file is in WAL mode, so it goes first for a new file
+    PRAGMAS = ("PRAGMA auto_vacuum=INCREMENTAL",)
+
+    def __init__(self, path : str = None):
+        super().__init__(path or os.getenv("CONVERSATION_SQLITE_PATH", "./data/conversations.sqlite3"))
+        connection = self.connection()
+        if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # A file created without it, rebuilt once so the compaction can free pages
+            connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.execute("VACUUM")
+        connection.executescript(ConversationStore.SCHEMA)
+
+    def append(self, turns : list[tuple]) -> None:
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT INTO conversation_turns (userId, createdAt, messageId, message, responseId, response) VALUES (?, ?, ?, ?, ?, ?)", turns)
+
+    def page(self, query : HistoryQuery) -> list[ConversationTurn]:
+        """Get the turns of a user, the newest first
+
+        Args:
+            query (HistoryQuery): user, cursor, size and period of the page
+
+        Returns:
+            list[ConversationTurn]: turns of the page
+        """
+        conditions, values = ["userId = ?"], [query.userId]
+        if query.cursor is not None:
+            conditions.append("id < ?")
+            values.append(query.cursor)
+        if query.since is not None:
+            conditions.append("createdAt >= ?")
+            values.append(ConversationStore.timestamp(query.since))
+        if query.until is not None:
+            conditions.append("createdAt < ?")
+            values.append(ConversationStore.timestamp(query.until))
+
+        rows = self.connection().execute(
+            f"SELECT {', '.join(ConversationStore.FIELDS)} FROM conversation_turns WHERE {' AND '.join(conditions)} ORDER BY id DESC LIMIT ?",
+            (*values, query.limit)).fetchall()
+        return [ConversationTurn(**dict(zip(ConversationStore.FIELDS, row))) for row in rows]
+
+    def last(self, userId : int, turns : int) -> list[tuple[str, str]]:
+        # The oldest first, as the history of a chat session
+        rows = self.connection().execute(
+            "SELECT message, response FROM conversation_turns WHERE userId = ? ORDER BY id DESC LIMIT ?", (userId, turns)).fetchall()
+        return rows[::-1]
+
+    def compact(self, maxAgeSeconds : float, maxTurns : int) -> int:
+        """Delete the old turns and free their pages
+
+        Args:
+            maxAgeSeconds (float): age of the turns to keep, 0 keeps every age
+            maxTurns (int): last turns kept by user, 0 keeps every turn
+
+        Returns:
+            int: turns deleted
+        """
+        connection = self.connection()
+        deleted = 0
+        if maxAgeSeconds > 0:
+            cutoff = ConversationStore.timestamp(datetime.fromtimestamp(datetime.now(timezone.utc).timestamp() - maxAgeSeconds, timezone.utc))
+            deleted += connection.execute("DELETE FROM conversation_turns WHERE createdAt < ?", (cutoff,)).rowcount
+        if maxTurns > 0:
+            deleted += connection.execute(
+                """DELETE FROM conversation_turns WHERE id IN (
+                       SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY userId ORDER BY id DESC) AS position FROM conversation_turns)
+                       WHERE position > ?)""", (maxTurns,)).rowcount
+        if deleted:
+            # Frees one page by step, executescript steps it to the end
+            connection.executescript("PRAGMA incremental_vacuum;")
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+    def timestamp(value : datetime) -> str:
+        """Format a datetime as stored, naive values are taken as UTC
+
+        Args:
+            value (datetime): datetime to format
+
+        Returns:
+            str: ISO 8601 UTC text that sorts as the time
+        """
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+class ConversationLog:
+    """Class to buffer the turns and write them in the background
+
+    """
+    ENABLED = os.getenv("CONVERSATION_LOG_ENABLED", "true").lower() == "true"
+    BATCH_SIZE = int(os.getenv("CONVERSATION_BATCH_SIZE", 500))
+    FLUSH_SECONDS = float(os.getenv("CONVERSATION_FLUSH_SECONDS", 1))
+    MAX_BUFFER = int(os.getenv("CONVERSATION_MAX_BUFFER", 100000))
+    RETENTION_SECONDS = float(os.getenv("CONVERSATION_RETENTION_SECONDS", 365 * 24 * 3600))
+    MAX_TURNS_PER_USER = int(os.getenv("CONVERSATION_MAX_TURNS_PER_USER", 0))
+    COMPACT_INTERVAL_SECONDS = float(os.getenv("CONVERSATION_COMPACT_INTERVAL_SECONDS", 3600))
+
+    STORE : Optional[ConversationStore] = None
+    BUFFER : deque = deque()
+    TASK : Optional[asyncio.Task] = None
+    WAKEUP : Optional[asyncio.Event] = None
+    # One flush at a time, so the ids follow the order of the turns
+    LOCK = asyncio.Lock()
+    WRITTEN = 0
+    DROPPED = 0
+    COMPACTED = 0
+    COMPACTED_AT = monotonic()
+
+    @classmethod
+    def store(cls) -> ConversationStore:
+        if cls.STORE is None:
+            cls.STORE = ConversationStore()
+        return cls.STORE
+
+    @classmethod
+    def append(cls, userId : int, messageId : int, message : str, responseId : int, response : str) -> None:
+        """Buffer a turn, it is written by the background task
+
+        Args:
+            userId (int): id of the user
+            messageId (int): id of the message of the user
+            message (str): question of the user
+            responseId (int): id of the answer
+            response (str): answer of the chat bot
+        """
+        if not cls.ENABLED:
+            return
+
+        if len(cls.BUFFER) >= cls.MAX_BUFFER:
+            # The store is failing for too long, the oldest turns are lost
+            cls.BUFFER.popleft()
+            cls.DROPPED += 1
+        cls.BUFFER.append((userId, ConversationStore.timestamp(datetime.now(timezone.utc)), messageId, message, responseId, response))
+
+        cls.start()
+        if len(cls.BUFFER) >= cls.BATCH_SIZE:
+            cls.WAKEUP.set()
+
+    @classmethod
+    async def flush(cls) -> None:
+        """Write the buffered turns, they are kept in the buffer if the write fails
+        """
+        async with cls.LOCK:
+            while cls.BUFFER:
+                batch = [cls.BUFFER.popleft() for _ in range(min(cls.BATCH_SIZE, len(cls.BUFFER)))]
+                write = asyncio.ensure_future(Executor.run("sqlite", cls.store().append, batch))
+                try:
+                    await asyncio.shield(write)
+                except BaseException:
+                    # A write already running ends even when the flush is cancelled, so the batch is neither lost nor written twice
+                    if not write.done():
+                        await asyncio.wait([write])
+                    if write.cancelled() or write.exception() is not None:
+                        cls.BUFFER.extendleft(reversed(batch))
+                    else:
+                        cls.WRITTEN += len(batch)
+                    raise
+                cls.WRITTEN += len(batch)
+
+    @classmethod
+    async def run(cls) -> None:
+        """Flush the buffer every FLUSH_SECONDS or once a batch is full, and compact the log
+        """
+        while True:
+            cls.WAKEUP.clear()
+            try:
+                await asyncio.wait_for(cls.WAKEUP.wait(), cls.FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await cls.flush()
+                if monotonic() - cls.COMPACTED_AT > cls.COMPACT_INTERVAL_SECONDS:
+                    await cls.compact()
+            except Exception:
+                # Retried on the next flush
+                logger.exception("Conversation log flush failed")
+
+    @classmethod
+    async def compact(cls) -> int:
+        cls.COMPACTED_AT = monotonic()
+        deleted = await Executor.run("sqlite", cls.store().compact, cls.RETENTION_SECONDS, cls.MAX_TURNS_PER_USER)
+        cls.COMPACTED += deleted
+        return deleted
+
+    @classmethod
+    def start(cls) -> None:
+        if cls.TASK is None or cls.TASK.done():
+            cls.WAKEUP = asyncio.Event()
+            cls.TASK = asyncio.create_task(cls.run())
+
+    @classmethod
+    async def stop(cls) -> None:
+        """Stop the background task and write the buffered turns
+        """
+        if cls.TASK is not None:
+            cls.TASK.cancel()
+            await asyncio.gather(cls.TASK, return_exceptions=True)
+            cls.TASK = None
+        try:
+            await cls.flush()
+        except Exception:
+            logger.exception("Conversation log lost %d turns at shutdown", len(cls.BUFFER))
+
+    @classmethod
+    async def history(cls, query : HistoryQuery) -> tuple[list[ConversationTurn], Optional[int]]:
+        """Get a page of the conversation of a user, the newest turns first
+
+        The turns still in the buffer are written first, so a turn is listed
+        as soon as it was answered.
+
+        Args:
+            query (HistoryQuery): user, cursor, size and period of the page
+
+        Returns:
+            tuple[list[ConversationTurn], Optional[int]]: turns, and the cursor of the next page if any
+        """
+        if any(turn[0] == query.userId for turn in cls.BUFFER):
+            await cls.flush()
+        turns = await Executor.run("sqlite", cls.store().page, query)
+        cursor = turns[-1].id if len(turns) == query.limit else None
+        return turns, cursor
+
+    @classmethod
+    async def last(cls, userId : int, turns : int) -> list[tuple[str, str]]:
+        """Get the last questions and answers of a user, the oldest first
+
+        Args:
+            userId (int): id of the user
+            turns (int): maximum turns
+
+        Returns:
+            list[tuple[str, str]]: question and answer of each turn
+        """
+        if not cls.ENABLED:
+            return []
+        buffered = [(turn[3], turn[5]) for turn in cls.BUFFER if turn[0] == userId]
+        if len(buffered) >= turns:
+            return buffered[-turns:]
+        stored = await Executor.run("sqlite", cls.store().last, userId, turns - len(buffered))
+        return stored + buffered
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {"enabled": cls.ENABLED, "buffered": len(cls.BUFFER), "written": cls.WRITTEN, "dropped": cls.DROPPED, "compacted": cls.COMPACTED}
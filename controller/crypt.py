@@ -0,0 +1,89 @@
+"""Module to hash and verify passwords out of the event loop
+
+    bcrypt is CPU bound for tens to hundreds of milliseconds per call, so the
+    calls run in the crypt backend of the Executor, a bounded pool of threads
+    (or processes with EXECUTOR_CRYPT_KIND=process) that answers 429 when its
+    queue is full.
+"""
+
+from passlib.context import CryptContext
+
+import os
+from dotenv import load_dotenv
+from typing import Optional
+
+from controller.executor import Executor
+
+
+load_dotenv()
+
+
+class Crypt:
+    """Class to hash and verify the passwords of the users
+
+    """
+    BACKEND = "crypt"
+    BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS"))
+
+    # Hashes with other rounds than the configured ones need an update
+    CONTEXT = CryptContext(
+        schemes=["bcrypt"],
+        bcrypt__rounds=BCRYPT_ROUNDS,
+        bcrypt__min_rounds=BCRYPT_ROUNDS,
+        bcrypt__max_rounds=BCRYPT_ROUNDS
+    )
+
+    def verifyAndUpdate(password : str, hash : str) -> tuple[bool, Optional[str]]:
+        """Verify a password, blocking until bcrypt ends
+
+        Args:
+            password (str): password to verify
+            hash (str): stored hash
+
+        Returns:
+            tuple[bool, Optional[str]]: if the password matches, and a new hash if the stored one is outdated
+        """
+        return Crypt.CONTEXT.verify_and_update(password, hash)
+
+    def hashPassword(password : str) -> str:
+        """Hash a password, blocking until bcrypt ends
+
+        Args:
+            password (str): password to hash
+
+        Returns:
+            str: hash
+        """
+        return Crypt.CONTEXT.hash(password)
+
+    async def verify(password : str, hash : str) -> tuple[bool, Optional[str]]:
+        """Verify a password in the crypt backend
+
+        Args:
+            password (str): password to verify
+            hash (str): stored hash
+
+        Raises:
+            HTTPException: 429 if too many passwords are waiting to be verified
+
+        Returns:
+            tuple[bool, Optional[str]]: if the password matches, and a new hash if the stored one is outdated
+        """
+        return await Executor.run(Crypt.BACKEND, Crypt.verifyAndUpdate, password, hash)
+
+    async def hash(password : str) -> str:
+        """Hash a password in the crypt backend
+
+        Args:
+            password (str): password to hash
+
+        Raises:
+            HTTPException: 429 if too many passwords are waiting to be hashed
+
+        Returns:
+            str: hash
+        """
+        return await Executor.run(Crypt.BACKEND, Crypt.hashPassword, password)
+
+
+Executor.configure(Crypt.BACKEND, workers=os.cpu_count(), status=429)
@@ -0,0 +1,119 @@
+"""Module to talk with the user datastore through a shared async HTTP client
+
+    Every request reuses a keep-alive connection pool, is bounded by a timeout
+    and is retried with exponential backoff on transport errors and on
+    transient gateway responses.
+"""
+
+from fastapi import HTTPException
+
+import asyncio
+import httpx
+import os
+from time import perf_counter
+from typing import Optional
+from dotenv import load_dotenv
+
+from controller.metrics import Metrics
+
+
+load_dotenv()
+
+
+class DBClient:
+    """Class to hold the pooled HTTP client of the datastore
+
+    """
+    POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 100))
+    KEEPALIVE_SIZE = int(os.getenv("DB_POOL_KEEPALIVE", 20))
+    KEEPALIVE_SECONDS = float(os.getenv("DB_POOL_KEEPALIVE_SECONDS", 30))
+    TIMEOUT_SECONDS = float(os.getenv("DB_TIMEOUT_SECONDS", 10))
+    CONNECT_TIMEOUT_SECONDS = float(os.getenv("DB_CONNECT_TIMEOUT_SECONDS", 3))
+    RETRIES = int(os.getenv("DB_RETRIES", 2))
+    RETRY_BACKOFF_SECONDS = float(os.getenv("DB_RETRY_BACKOFF_SECONDS", 0.1))
+    RETRY_STATUS = {502, 503, 504}
+    IDEMPOTENT = {"GET", "PUT", "DELETE"}
+
+    CLIENT : Optional[httpx.AsyncClient] = None
+
+    @classmethod
+    def client(cls) -> httpx.AsyncClient:
+        """Get the shared client, creating it on first use
+
+        Returns:
+            httpx.AsyncClient: pooled client
+        """
+        if cls.CLIENT is None or cls.CLIENT.is_closed:
+            cls.CLIENT = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=cls.POOL_SIZE,
+                    max_keepalive_connections=cls.KEEPALIVE_SIZE,
+                    keepalive_expiry=cls.KEEPALIVE_SECONDS
+                ),
+                timeout=httpx.Timeout(cls.TIMEOUT_SECONDS, connect=cls.CONNECT_TIMEOUT_SECONDS)
+            )
+        return cls.CLIENT
+
+    @classmethod
+    async def close(cls) -> None:
+        """Close the pooled connections
+        """
+        if cls.CLIENT is not None:
+            await cls.CLIENT.aclose()
+            cls.CLIENT = None
+
+    @classmethod
+    async def request(cls, method : str, url : str, **kwargs) -> httpx.Response:
+        """Send a request to the datastore
+
+        Non idempotent requests are only retried when the connection could not
+        be established, so a POST is never sent twice.
+
+        Args:
+            method (str): HTTP method
+            url (str): absolute url
+            **kwargs: arguments for httpx.AsyncClient.request
+
+        Raises:
+            HTTPException: 503 if the datastore can not be reached
+
+        Returns:
+            httpx.Response: response of the datastore
+        """
+        retryable = method.upper() in cls.IDEMPOTENT
+        attempt = 0
+
+        while True:
+            start = perf_counter()
+            try:
+                response = await cls.client().request(method, url, **kwargs)
+                Metrics.observe("datastore", perf_counter() - start, response.status_code >= 500)
+                if not (retryable and response.status_code in cls.RETRY_STATUS and attempt < cls.RETRIES):
+                    return response
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                Metrics.observe("datastore", perf_counter() - start, True)
+                if attempt >= cls.RETRIES:
+                    raise HTTPException(status_code=503, detail="Datastore unavailable")
+            except httpx.TransportError:
+                Metrics.observe("datastore", perf_counter() - start, True)
+                if not retryable or attempt >= cls.RETRIES:
+                    raise HTTPException(status_code=503, detail="Datastore unavailable")
+
+            await asyncio.sleep(cls.RETRY_BACKOFF_SECONDS * 2 ** attempt)
+            attempt += 1
+
+    @classmethod
+    async def get(cls, url : str, **kwargs) -> httpx.Response:
+        return await cls.request("GET", url, **kwargs)
+
+    @classmethod
+    async def post(cls, url : str, **kwargs) -> httpx.Response:
+        return await cls.request("POST", url, **kwargs)
+
+    @classmethod
+    async def put(cls, url : str, **kwargs) -> httpx.Response:
+        return await cls.request("PUT", url, **kwargs)
+
+    @classmethod
+    async def delete(cls, url : str, **kwargs) -> httpx.Response:
+        return await cls.request("DELETE", url, **kwargs)
@@ -0,0 +1,296 @@
+"""Module to run the blocking calls of the external services out of the event loop
+
+    Each backend (vertex, speech, tts, ...) owns a bounded thread pool, so a
+    slow model or transcription call only queues behind calls of the same
+    backend and never stalls the rest of the endpoints of the worker.
+
+    The size of a backend is read from EXECUTOR_<NAME>_WORKERS, the
+    maximum number of calls waiting for a thread from EXECUTOR_<NAME>_MAX_QUEUE
+    and EXECUTOR_<NAME>_KIND=process runs a CPU bound backend in processes.
+"""
+
+from fastapi import HTTPException
+
+import asyncio
+from contextlib import nullcontext
+import contextvars
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+import os
+from typing import Any, AsyncIterator, Callable, Iterator
+from dotenv import load_dotenv
+
+from controller.metrics import Metrics, QUEUE_SECONDS
+
+
+load_dotenv()
+
+
+class Backend:
+    """Class to represent a bounded pool of threads for an external service
+    """
+
+    def __init__(self, name : str, workers : int, maxQueue : int, status : int = 503, processes : bool = False):
+        """Create a backend
+
+        Args:
+            name (str): name of the backend
+            workers (int): maximum concurrent calls
+            maxQueue (int): maximum calls waiting for a worker
+            status (int): status code raised when the queue is full
+            processes (bool): run the calls in processes instead of threads
+        """
+        self.name = name
+        self.workers = workers
+        self.maxQueue = maxQueue
+        self.status = status
+        self.processes = processes
+        if processes:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"executor-{name}")
+        self.lock = Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.waitSeconds = 0.0
+        self.maxWaitSeconds = 0.0
+
+    def stats(self) -> dict:
+        """Get the counters of the backend
+
+        Returns:
+            dict: queue depth, running calls and totals
+        """
+        with self.lock:
+            return {
+                "kind": "process" if self.processes else "thread",
+                "workers": self.workers,
+                "maxQueue": self.maxQueue,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "waitSeconds": self.waitSeconds,
+                "maxWaitSeconds": self.maxWaitSeconds
+            }
+
+
+class Executor:
+    """Class to dispatch blocking calls to the backends
+
+    """
+    DEFAULT_WORKERS = int(os.getenv("EXECUTOR_DEFAULT_WORKERS", 8))
+    DEFAULT_MAX_QUEUE = int(os.getenv("EXECUTOR_DEFAULT_MAX_QUEUE", 64))
+
+    BACKENDS : dict[str, Backend] = {}
+    DEFAULTS : dict[str, dict] = {}
+    LOCK = Lock()
+
+    @classmethod
+    def configure(cls, name : str, workers : int = None, status : int = 503) -> None:
+        """Set the defaults of a backend, the environment still overrides its size
+
+        Args:
+            name (str): name of the backend
+            workers (int): default maximum concurrent calls
+            status (int): status code raised when the queue is full
+        """
+        cls.DEFAULTS[name] = {"workers": workers, "status": status}
+
+    @classmethod
+    def backend(cls, name : str) -> Backend:
+        """Get a backend, creating it on first use
+
+        Args:
+            name (str): name of the backend
+
+        Returns:
+            Backend: backend of the name
+        """
+        backend = cls.BACKENDS.get(name)
+        if backend is not None:
+            return backend
+
+        with cls.LOCK:
+            if name not in cls.BACKENDS:
+                prefix = f"EXECUTOR_{name.upper()}"
+                defaults = cls.DEFAULTS.get(name, {})
+                cls.BACKENDS[name] = Backend(
+                    name,
+                    int(os.getenv(f"{prefix}_WORKERS", defaults.get("workers") or cls.DEFAULT_WORKERS)),
+                    int(os.getenv(f"{prefix}_MAX_QUEUE", cls.DEFAULT_MAX_QUEUE)),
+                    defaults.get("status", 503),
+                    os.getenv(f"{prefix}_KIND", "thread").lower() == "process"
+                )
+            return cls.BACKENDS[name]
+
+    @classmethod
+    async def run(cls, name : str, function : Callable, *args, **kwargs) -> Any:
+        """Run a blocking function in the pool of a backend
+
+        The function and its arguments must be picklable on a process backend.
+
+        Args:
+            name (str): name of the backend
+            function (Callable): blocking function
+            *args: positional arguments of the function
+            **kwargs: keyword arguments of the function
+
+        Raises:
+            HTTPException: 503 (or the status of the backend) if the queue is full
+
+        Returns:
+            Any: result of the function
+        """
+        return await cls.submit(name, True, function, *args, **kwargs)
+
+    @classmethod
+    async def submit(cls, name : str, observe : bool, function : Callable, *args, **kwargs) -> Any:
+        """Run a blocking function in the pool of a backend, see run
+
+        Args:
+            name (str): name of the backend
+            observe (bool): record the call as a call to the dependency
+            function (Callable): blocking function
+            *args: positional arguments of the function
+            **kwargs: keyword arguments of the function
+
+        Returns:
+            Any: result of the function
+        """
+        backend = cls.backend(name)
+
+        with backend.lock:
+            if backend.queued >= backend.maxQueue:
+                backend.rejected += 1
+                raise HTTPException(status_code=backend.status, detail=f"Service {name} busy")
+            backend.queued += 1
+
+        if backend.processes:
+            with Metrics.timer(name) if observe else nullcontext():
+                return await cls.runProcess(backend, function, *args, **kwargs)
+
+        submittedAt = monotonic()
+
+        def call():
+            wait = monotonic() - submittedAt
+            with backend.lock:
+                backend.queued -= 1
+                backend.running += 1
+                backend.waitSeconds += wait
+                backend.maxWaitSeconds = max(backend.maxWaitSeconds, wait)
+            QUEUE_SECONDS.observe(name, value=wait)
+            start = monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                with backend.lock:
+                    backend.failed += 1
+                if observe:
+                    Metrics.observe(name, monotonic() - start, True)
+                raise
+            finally:
+                with backend.lock:
+                    backend.running -= 1
+            with backend.lock:
+                backend.completed += 1
+            if observe:
+                Metrics.observe(name, monotonic() - start)
+            return result
+
+        context = contextvars.copy_context()
+        future = backend.pool.submit(context.run, call)
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The call is dropped if it did not start yet
+            if future.cancel():
+                with backend.lock:
+                    backend.queued -= 1
+            raise
+
+    @classmethod
+    async def runProcess(cls, backend : Backend, function : Callable, *args, **kwargs) -> Any:
+        """Run a function in a process backend
+
+        A process can not report when a call starts, so the call counts as
+        queued until it ends.
+        """
+
+        def done(future : Future):
+            with backend.lock:
+                backend.queued -= 1
+                if future.cancelled():
+                    return
+                if future.exception() is None:
+                    backend.completed += 1
+                else:
+                    backend.failed += 1
+
+        future = backend.pool.submit(function, *args, **kwargs)
+        future.add_done_callback(done)
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    @classmethod
+    async def iterate(cls, name : str, iterator : Iterator) -> AsyncIterator:
+        """Consume a blocking iterator in the pool of a backend
+
+        The whole stream is recorded as one call to the dependency, taking the
+        time spent waiting for its items.
+
+        Args:
+            name (str): name of the backend
+            iterator (Iterator): blocking iterator
+
+        Yields:
+            Any: each item of the iterator
+        """
+        iterator = iter(iterator)
+        done = object()
+        seconds = 0.0
+        error = False
+
+        try:
+            while True:
+                start = monotonic()
+                try:
+                    item = await cls.submit(name, False, next, iterator, done)
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    seconds += monotonic() - start
+                if item is done:
+                    return
+                yield item
+        finally:
+            Metrics.observe(name, seconds, error)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Get the counters of every backend
+
+        Returns:
+            dict: counters by backend name
+        """
+        return {name: backend.stats() for name, backend in list(cls.BACKENDS.items())}
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """Stop the threads of every backend
+        """
+        with cls.LOCK:
+            for backend in cls.BACKENDS.values():
+                backend.pool.shutdown(wait=False, cancel_futures=True)
+            cls.BACKENDS.clear()
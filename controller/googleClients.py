@@ -0,0 +1,153 @@
+"""Module to create the clients of the Google services on first use
+
+    Loading the service account, building the Text-to-Speech and Speech-to-Text
+    clients and importing and initializing Vertex AI take seconds, so none of
+    them happens when the application is imported. Each client is built once
+    per process by the first caller that needs it, under a lock of its own, and
+    shared by every thread afterwards. GOOGLE_WARMUP=true builds them in the
+    background when the application starts, and the readiness endpoint waits
+    for it.
+"""
+
+from threading import Lock
+import os
+from typing import Any, Callable
+from dotenv import load_dotenv
+
+from controller.executor import Executor
+
+
+load_dotenv()
+
+
+def credentials() -> Any:
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_file(os.getenv("GOOGLE_APPLICATION_VERTEX_AI_CREDENTIALS"))
+
+
+def textToSpeech() -> Any:
+    from google.cloud import texttospeech
+    return texttospeech.TextToSpeechClient(credentials=GoogleClients.get("credentials"))
+
+
+def speech() -> Any:
+    from google.cloud import speech
+    return speech.SpeechClient(credentials=GoogleClients.get("credentials"))
+
+
+def model() -> Any:
+    import vertexai
+    from vertexai.generative_models import GenerativeModel
+    from controller.chatBotController import Controller
+    vertexai.init(project=Controller.PROJECT_ID, location=Controller.LOCATION, credentials=GoogleClients.get("credentials"))
+    return GenerativeModel(Controller.MODEL_ID, system_instruction=Controller.TEMPLATE)
+
+
+class GoogleClients:
+    """Class to hold the shared clients of the Google services
+
+    """
+    WARMUP = os.getenv("GOOGLE_WARMUP", "false").lower() == "true"
+
+    # Factory and executor backend of each client
+    FACTORIES : dict[str, tuple[Callable[[], Any], str]] = {
+        "credentials": (credentials, "vertex"),
+        "textToSpeech": (textToSpeech, "tts"),
+        "speech": (speech, "speech"),
+        "model": (model, "vertex")
+    }
+
+    CLIENTS : dict[str, Any] = {}
+    ERRORS : dict[str, str] = {}
+    LOCKS : dict[str, Lock] = {name: Lock() for name in FACTORIES}
+    WARMED = False
+
+    @classmethod
+    def get(cls, name : str) -> Any:
+        """Get a client, building it if it is the first call of the process
+
+        Blocks while the client is built, so it is called from the executor
+        threads or through load.
+
+        Args:
+            name (str): credentials, textToSpeech, speech or model
+
+        Returns:
+            Any: shared client
+        """
+        client = cls.CLIENTS.get(name)
+        if client is not None:
+            return client
+
+        with cls.LOCKS[name]:
+            if name not in cls.CLIENTS:
+                factory, _ = cls.FACTORIES[name]
+                try:
+                    cls.CLIENTS[name] = factory()
+                except Exception as error:
+                    cls.ERRORS[name] = repr(error)
+                    raise
+                cls.ERRORS.pop(name, None)
+            return cls.CLIENTS[name]
+
+    @classmethod
+    async def load(cls, name : str) -> Any:
+        """Get a client without blocking the event loop while it is built
+
+        Args:
+            name (str): credentials, textToSpeech, speech or model
+
+        Returns:
+            Any: shared client
+        """
+        client = cls.CLIENTS.get(name)
+        if client is not None:
+            return client
+
+        _, backend = cls.FACTORIES[name]
+        return await Executor.run(backend, cls.get, name)
+
+    @classmethod
+    async def warmup(cls) -> None:
+        """Build every client, the failures are kept for the readiness endpoint
+        """
+        for name in cls.FACTORIES:
+            try:
+                await cls.load(name)
+            except Exception:
+                pass
+        cls.WARMED = True
+
+    @classmethod
+    def close(cls) -> None:
+        """Close the channels of the clients, they are built again if needed
+        """
+        for name in ("textToSpeech", "speech"):
+            client = cls.CLIENTS.pop(name, None)
+            transport = getattr(client, "transport", None)
+            if transport is not None:
+                transport.close()
+
+    @classmethod
+    def ready(cls) -> bool:
+        """Check if the process can take traffic
+
+        Returns:
+            bool: the warm-up is disabled or built every client
+        """
+        return not cls.WARMUP or (cls.WARMED and not cls.ERRORS)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Get the state of each client
+
+        Returns:
+            dict: loaded, pending or the error of each client
+        """
+        states : dict[str, str] = {}
+        for name in cls.FACTORIES:
+            if name in cls.CLIENTS:
+                states[name] = "loaded"
+            else:
+                states[name] = cls.ERRORS.get(name, "pending")
+        return {"warmup": cls.WARMUP, "warmed": cls.WARMED, "clients": states}
@@ -0,0 +1,267 @@
+"""Module to record the metrics of the service in the Prometheus text format
+
+    Counters, gauges and histograms are kept in memory with a lock each, so
+    recording a value costs a dictionary lookup and an addition and can stay
+    on in production. The calls to the datastore and to the Google services
+    are timed as dependencies, and each of them is also reported in the
+    Server-Timing header of the request when METRICS_SERVER_TIMING is true.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+import os
+from typing import Callable, Iterator, Optional
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+def labels(names : tuple[str, ...], values : tuple) -> str:
+    if not names:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    """Class to represent a metric with its values by labels
+    """
+
+    KIND = "untyped"
+
+    def __init__(self, name : str, help : str, labelNames : tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.lock = Lock()
+        self.values : dict[tuple, float] = {}
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.KIND}"]
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + [f"{self.name}{labels(self.labelNames, key)} {value}" for key, value in values]
+
+
+class Counter(Metric):
+
+    KIND = "counter"
+
+    def inc(self, *labelValues, amount : float = 1) -> None:
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+
+class Gauge(Metric):
+
+    KIND = "gauge"
+
+    def inc(self, *labelValues, amount : float = 1) -> None:
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def dec(self, *labelValues, amount : float = 1) -> None:
+        self.inc(*labelValues, amount=-amount)
+
+    def set(self, *labelValues, value : float) -> None:
+        with self.lock:
+            self.values[labelValues] = value
+
+
+class Histogram(Metric):
+
+    KIND = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name : str, help : str, labelNames : tuple[str, ...] = (), buckets : tuple[float, ...] = BUCKETS):
+        super().__init__(name, help, labelNames)
+        self.buckets = buckets
+        # Counts by bucket (not cumulative), sum and count by labels
+        self.series : dict[tuple, list] = {}
+
+    def observe(self, *labelValues, value : float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelValues)
+            if series is None:
+                series = self.series[labelValues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        with self.lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self.series.items()]
+
+        lines = self.header()
+        names = self.labelNames + ("le",)
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{labels(names, (*key, bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{labels(self.labelNames, key)} {total}")
+            lines.append(f"{self.name}_count{labels(self.labelNames, key)} {count}")
+        return lines
+
+
+class Metrics:
+    """Class to hold the metrics of the service and render them
+
+    """
+    SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "false").lower() == "true"
+
+    REGISTRY : list[Metric] = []
+    # Functions called on each scrape that return (metric name, kind, help, label names, {labels: value})
+    COLLECTORS : list[Callable[[], list[tuple]]] = []
+    TIMINGS : ContextVar[Optional[list]] = ContextVar("timings", default=None)
+
+    @classmethod
+    def register(cls, metric : Metric) -> Metric:
+        cls.REGISTRY.append(metric)
+        return metric
+
+    def collect(collector : Callable[[], list[tuple]]) -> None:
+        """Register a function reporting values kept elsewhere, as the counters of the caches
+
+        Args:
+            collector (Callable[[], list[tuple]]): function returning (name, kind, help, label names, {labels: value})
+        """
+        Metrics.COLLECTORS.append(collector)
+
+    @classmethod
+    def observe(cls, dependency : str, seconds : float, error : bool = False) -> None:
+        """Record a call to a dependency
+
+        Args:
+            dependency (str): name of the dependency
+            seconds (float): duration of the call
+            error (bool): the call failed
+        """
+        DEPENDENCY_SECONDS.observe(dependency, value=seconds)
+        if error:
+            DEPENDENCY_ERRORS.inc(dependency)
+
+        timings = cls.TIMINGS.get()
+        if timings is not None:
+            timings.append((dependency, seconds))
+
+    @classmethod
+    @contextmanager
+    def timer(cls, dependency : str) -> Iterator[None]:
+        """Time the calls of a block to a dependency
+
+        Args:
+            dependency (str): name of the dependency
+        """
+        start = perf_counter()
+        error = False
+        DEPENDENCY_IN_FLIGHT.inc(dependency)
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            DEPENDENCY_IN_FLIGHT.dec(dependency)
+            cls.observe(dependency, perf_counter() - start, error)
+
+    @classmethod
+    def render(cls) -> str:
+        """Render every metric in the Prometheus text format
+
+        Returns:
+            str: exposition of the metrics
+        """
+        lines = []
+        for metric in list(cls.REGISTRY):
+            lines.extend(metric.render())
+
+        for collector in list(cls.COLLECTORS):
+            for name, kind, help, labelNames, values in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{labels(labelNames, key)} {value}" for key, value in values.items())
+
+        return "\n".join(lines) + "\n"
+
+    def serverTiming(timings : list[tuple[str, float]], total : float) -> str:
+        """Build the Server-Timing header of a request, adding up the calls to each dependency
+
+        Args:
+            timings (list[tuple[str, float]]): dependency and duration of each call
+            total (float): duration of the request
+
+        Returns:
+            str: value of the header
+        """
+        durations : dict[str, list] = {}
+        for dependency, seconds in timings:
+            duration = durations.setdefault(dependency, [0.0, 0])
+            duration[0] += seconds
+            duration[1] += 1
+
+        entries = [f'{dependency};dur={seconds * 1000:.1f};desc="{count} calls"' for dependency, (seconds, count) in durations.items()]
+        return ", ".join(entries + [f"total;dur={total * 1000:.1f}"])
+
+
+REQUEST_SECONDS = Metrics.register(Histogram("http_request_duration_seconds", "Duration of the HTTP requests", ("method", "route", "status")))
+REQUESTS_IN_FLIGHT = Metrics.register(Gauge("http_requests_in_flight", "HTTP requests being served"))
+REQUEST_ERRORS = Metrics.register(Counter("http_request_errors_total", "HTTP requests answered with a 5xx status or an exception", ("method", "route")))
+DEPENDENCY_SECONDS = Metrics.register(Histogram("dependency_duration_seconds", "Duration of the calls to the datastore and the external services", ("dependency",)))
+DEPENDENCY_IN_FLIGHT = Metrics.register(Gauge("dependency_in_flight", "Calls to the datastore and the external services in progress", ("dependency",)))
+DEPENDENCY_ERRORS = Metrics.register(Counter("dependency_errors_total", "Failed calls to the datastore and the external services", ("dependency",)))
+QUEUE_SECONDS = Metrics.register(Histogram("executor_queue_wait_seconds", "Time waited by the blocking calls for a worker", ("backend",)))
+ADMISSION_SECONDS = Metrics.register(Histogram("admission_queue_wait_seconds", "Time waited by the requests for a slot of their class of routes", ("class",)))
+ADMISSION_REJECTED = Metrics.register(Counter("admission_rejected_total", "Requests shed by rate (429), full queue or deadline (503)", ("class", "reason")))
+AUDIO_BYTES = Metrics.register(Counter("audio_bytes_total", "Bytes of audio synthesized or transcribed", ("direction",)))
+TRANSCRIPTION_JOBS = Metrics.register(Counter("transcription_jobs_total", "Background transcriptions ended, retried or cancelled", ("status",)))
+TRANSCRIPTION_SECONDS = Metrics.register(Histogram("transcription_job_seconds", "Time from the submission to the end of the background transcriptions", ("status",), (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)))
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each request by route template
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = perf_counter()
+        timings = [] if Metrics.SERVER_TIMING else None
+        token = Metrics.TIMINGS.set(timings)
+        status = 500
+        REQUESTS_IN_FLIGHT.inc()
+
+        async def wrapped(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if timings is not None:
+                    value = Metrics.serverTiming(timings, perf_counter() - start).encode("latin-1")
+                    message = {**message, "headers": [*message.get("headers", []), (b"server-timing", value)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped)
+        except BaseException:
+            status = 500
+            raise
+        finally:
+            Metrics.TIMINGS.reset(token)
+            REQUESTS_IN_FLIGHT.dec()
+            # The route is only known once the router matched it
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(scope["method"], route, status, value=perf_counter() - start)
+            if status >= 500:
+                REQUEST_ERRORS.inc(scope["method"], route)
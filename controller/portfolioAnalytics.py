@@ -0,0 +1,429 @@
+"""Module to score the debt risk of the whole portfolio over columnar arrays
+
+    The payment history of every user is parsed once and aggregated in batch
+    with NumPy into a column by metric and a row by user (payments, late
+    payments, days late, arrears streak, last payment). The metrics that
+    depend on the day (days past due, days since the last payment) and the
+    risk score are computed over the whole columns on each ranking, so a
+    ranking of the portfolio costs a few vectorized passes and a sort.
+
+    The writes of UserController mark the user as dirty and only the dirty
+    users are fetched and aggregated again before the next ranking, while
+    ANALYTICS_TTL_SECONDS bounds the staleness of the changes made by other
+    writers of the datastore with a full reload. A full reload runs in the
+    background while the rankings keep reading the current columns; only the
+    first load is waited for, and ANALYTICS_PRELOAD (on by default) does it at
+    startup.
+"""
+
+from fastapi import HTTPException
+
+import numpy as np
+
+import asyncio
+from contextlib import suppress
+import datetime
+import logging
+import os
+from threading import Lock
+from time import monotonic
+from typing import Optional
+from dotenv import load_dotenv
+
+from controller import UserController
+from controller.executor import Executor
+from model import AnalyticsQuery, PaymentUtils, User
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+EPOCH = datetime.date(1970, 1, 1)
+# Day of a missing date, below every real day so a maximum ignores it
+NONE = np.iinfo(np.int64).min
+
+
+def day(value : Optional[datetime.date]) -> int:
+    return NONE if value is None else (value - EPOCH).days
+
+
+def nullable(values : np.ndarray, missing : np.ndarray) -> list:
+    return [None if absent else value for value, absent in zip(values.tolist(), missing.tolist())]
+
+
+def aggregate(users : list[User]) -> dict[str, np.ndarray]:
+    """Aggregate the payment history of the users in batch
+
+    The payments of all the users are laid out contiguously, user after user,
+    sorted with lexsort and reduced by user with bincount and reduceat.
+
+    Args:
+        users (list[User]): users to aggregate
+
+    Returns:
+        dict[str, np.ndarray]: a column by metric, a row by user
+    """
+    n = len(users)
+    owners, amounts, paid, due, late = [], [], [], [], []
+    # Day of each raw date, the histories repeat the same values
+    days = {None: NONE}
+    first = PaymentUtils.first
+
+    def toDay(value) -> int:
+        try:
+            return days[value]
+        except KeyError:
+            result = days[value] = day(PaymentUtils.to_date(value))
+            return result
+        except TypeError:
+            return day(PaymentUtils.to_date(value))
+
+    # Same rules as PaymentUtils.parse, without building a Payment by entry
+    for row, user in enumerate(users):
+        for entry in user.paymentHistory:
+            if not isinstance(entry, dict):
+                continue
+            amount = entry["amount"] if "amount" in entry else first(entry, PaymentUtils.AMOUNT_KEYS)
+            if isinstance(amount, bool):
+                continue
+            try:
+                amount = float(amount)
+            except (TypeError, ValueError):
+                continue
+            flag = entry.get("late")
+            owners.append(row)
+            amounts.append(amount)
+            paid.append(toDay(entry["date"] if "date" in entry else first(entry, PaymentUtils.DATE_KEYS)))
+            due.append(toDay(entry["dueDate"] if "dueDate" in entry else first(entry, PaymentUtils.DUE_KEYS)))
+            late.append(int(flag) if isinstance(flag, bool) else -1)
+
+    owner = np.array(owners, np.int64)
+    counts = np.bincount(owner, minlength=n).astype(np.int64)
+    paidDay = np.array(paid, np.int64)
+    # Same order as the profile of the chat bot, so the arrears streak matches:
+    # by date when every payment of the user is dated, as listed otherwise
+    dated = np.bincount(owner, weights=paidDay == NONE, minlength=n) == 0
+    order = np.lexsort((np.where(dated[owner], paidDay, np.arange(len(owners))), owner))
+    owner = owner[order]
+    amount = np.array(amounts, np.float64)[order]
+    paidDay = paidDay[order]
+    dueDay = np.array(due, np.int64)[order]
+    flags = np.array(late, np.int64)[order]
+    isLate = np.where(flags >= 0, flags == 1, (paidDay != NONE) & (dueDay != NONE) & (paidDay > dueDay))
+
+    m = len(amounts)
+    offsets = np.zeros(n + 1, np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    dated = (paidDay != NONE) & (dueDay != NONE)
+    daysLate = np.where(dated, np.maximum(paidDay - dueDay, 0), 0)
+
+    columns = {
+        "id": np.array([user.id for user in users], np.int64),
+        "name": np.array([user.name for user in users], object),
+        "debt": np.array([user.debt for user in users], np.float64),
+        "maturity": np.array([day(PaymentUtils.to_date(user.debtMaturityDate)) for user in users], np.int64),
+        "state": np.array([user.state for user in users], bool),
+        "active": np.ones(n, bool),
+        "payments": counts,
+        # bincount returns integers when there are no payments at all
+        "totalPaid": np.bincount(owner, weights=amount, minlength=n).astype(np.float64),
+        "latePayments": np.bincount(owner, weights=isLate, minlength=n).astype(np.int64),
+        "duePayments": np.bincount(owner, weights=dated, minlength=n).astype(np.int64),
+        "daysLate": np.bincount(owner, weights=daysLate, minlength=n).astype(np.float64),
+        "maxDaysLate": np.zeros(n, np.int64),
+        "lastPayment": np.full(n, NONE, np.int64),
+        "arrearsStreak": np.zeros(n, np.int64)
+    }
+
+    filled = counts > 0
+    if m:
+        # Segments of the users with payments, reduceat needs them non empty
+        starts = offsets[:-1][filled]
+        ends = offsets[1:][filled] - 1
+        columns["maxDaysLate"][filled] = np.maximum.reduceat(daysLate, starts)
+        columns["lastPayment"][filled] = np.maximum.reduceat(paidDay, starts)
+        # The streak runs from the last payment on time to the last payment
+        onTime = np.where(isLate, -1, np.arange(m))
+        columns["arrearsStreak"][filled] = ends - np.maximum(np.maximum.reduceat(onTime, starts), starts - 1)
+
+    return columns
+
+
+class PortfolioAnalytics:
+    """Class to keep the aggregated payment behaviour of every user and rank them by risk
+
+    """
+    TTL_SECONDS = float(os.getenv("ANALYTICS_TTL_SECONDS", 900))
+    PRELOAD = os.getenv("ANALYTICS_PRELOAD", "true").lower() == "true"
+    DELINQUENT_DAYS = int(os.getenv("ANALYTICS_DELINQUENT_DAYS", 30))
+    DELINQUENT_STREAK = int(os.getenv("ANALYTICS_DELINQUENT_STREAK", 3))
+
+    # Logistic score: bias plus weight by factor, each factor scaled to [0, 1] by its cap
+    BIAS = -3.0
+    WEIGHTS = {"lateRatio": (3.0, 1), "daysPastDue": (3.0, 180), "arrearsStreak": (1.5, 6),
+               "daysSinceLastPayment": (1.0, 180), "averageDaysLate": (1.0, 90)}
+
+    LOCK = Lock()
+    REFRESH = asyncio.Lock()
+    RELOAD : Optional[asyncio.Task] = None
+    COLUMNS : Optional[dict[str, np.ndarray]] = None
+    SIZE = 0
+    ROWS : dict[int, int] = {}
+    DIRTY : set[int] = set()
+    LOADED_AT : Optional[float] = None
+
+    @classmethod
+    def load(cls, users : list[User]) -> None:
+        """Replace the columns with a full snapshot of the users
+
+        Args:
+            users (list[User]): every user of the datastore
+        """
+        columns = aggregate(users)
+        rows = {int(id): row for row, id in enumerate(columns["id"])}
+
+        with cls.LOCK:
+            cls.COLUMNS, cls.SIZE, cls.ROWS = columns, len(users), rows
+            cls.LOADED_AT = monotonic()
+
+    @classmethod
+    def update(cls, users : list[User], removed : list[int]) -> None:
+        """Aggregate again the users written since the last ranking
+
+        Args:
+            users (list[User]): created or updated users
+            removed (list[int]): ids of the deleted users
+        """
+        columns = aggregate(users)
+
+        with cls.LOCK:
+            for id in removed:
+                row = cls.ROWS.pop(id, None)
+                if row is not None:
+                    cls.COLUMNS["active"][row] = False
+
+            for index, user in enumerate(users):
+                row = cls.ROWS.get(user.id)
+                if row is None:
+                    row = cls.append()
+                    cls.ROWS[user.id] = row
+                for name, column in columns.items():
+                    cls.COLUMNS[name][row] = column[index]
+
+    @classmethod
+    def append(cls) -> int:
+        """Reserve a row, doubling the capacity of the columns when full
+
+        Returns:
+            int: index of the row
+        """
+        capacity = len(cls.COLUMNS["id"])
+        if cls.SIZE == capacity:
+            cls.COLUMNS = {name: np.resize(column, max(2 * capacity, 16)) for name, column in cls.COLUMNS.items()}
+        cls.SIZE += 1
+        return cls.SIZE - 1
+
+    def invalidate(id : int) -> None:
+        """Mark a user as dirty after a write
+
+        Args:
+            id (int): id of the user
+        """
+        PortfolioAnalytics.DIRTY.add(id)
+
+    @classmethod
+    async def reload(cls) -> None:
+        """Download and aggregate every user, replacing the columns at the end
+        """
+        # Writes made while downloading mark their user again
+        cls.DIRTY.clear()
+        try:
+            users = await UserController.getUsers()
+        except HTTPException as error:
+            if error.status_code != 404:
+                raise
+            users = []
+        await Executor.run("analytics", cls.load, users)
+
+    @classmethod
+    def reloading(cls) -> asyncio.Task:
+        """Get the full reload in flight, starting it if needed
+
+        Returns:
+            asyncio.Task: reload shared by the rankings
+        """
+        if cls.RELOAD is None or cls.RELOAD.done():
+            cls.RELOAD = asyncio.create_task(cls.reload())
+            cls.RELOAD.add_done_callback(cls.reloaded)
+        return cls.RELOAD
+
+    def reloaded(task : asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Analytics reload failed", exc_info=task.exception())
+
+    @classmethod
+    async def refresh(cls) -> None:
+        """Load the users on first use, reload them in the background when the
+        TTL expired, or aggregate the dirty ones
+        """
+        if cls.COLUMNS is None:
+            await asyncio.shield(cls.reloading())
+            return
+
+        if monotonic() - cls.LOADED_AT >= cls.TTL_SECONDS:
+            cls.reloading()
+
+        async with cls.REFRESH:
+            # The dirty users wait for the reload, its snapshot may predate them
+            if not cls.DIRTY or (cls.RELOAD is not None and not cls.RELOAD.done()):
+                return
+
+            ids, cls.DIRTY = list(cls.DIRTY), set()
+            results = await asyncio.gather(*(UserController.getUserById(id) for id in ids), return_exceptions=True)
+            users, removed = [], []
+            for id, result in zip(ids, results):
+                if isinstance(result, User):
+                    users.append(result)
+                elif isinstance(result, HTTPException) and result.status_code == 404:
+                    removed.append(id)
+                else:
+                    cls.DIRTY.update(ids)
+                    raise result
+            await Executor.run("analytics", cls.update, users, removed)
+
+    @classmethod
+    async def preload(cls) -> None:
+        """Load the users in the background at startup, a failure is retried by the first ranking
+        """
+        try:
+            await cls.refresh()
+        except Exception:
+            pass
+
+    @classmethod
+    async def stop(cls) -> None:
+        """Cancel the reload in flight
+        """
+        if cls.RELOAD is not None and not cls.RELOAD.done():
+            cls.RELOAD.cancel()
+            with suppress(asyncio.CancelledError):
+                await cls.RELOAD
+
+    @classmethod
+    def evaluate(cls, columns : dict[str, np.ndarray], today : int) -> dict[str, np.ndarray]:
+        """Compute the metrics that depend on the day and the risk score
+
+        Args:
+            columns (dict[str, np.ndarray]): aggregated columns
+            today (int): days since the epoch
+
+        Returns:
+            dict[str, np.ndarray]: a column by metric
+        """
+        debt = columns["debt"]
+        payments = columns["payments"]
+        owing = debt > 0
+
+        metrics = {
+            "daysToMaturity": columns["maturity"] - today,
+            "daysPastDue": np.where(owing, np.maximum(today - columns["maturity"], 0), 0),
+            "lateRatio": columns["latePayments"] / np.maximum(payments, 1),
+            "averageDaysLate": columns["daysLate"] / np.maximum(columns["duePayments"], 1),
+            "arrearsStreak": columns["arrearsStreak"],
+            # A debtor who never paid counts as the longest time without paying
+            "daysSinceLastPayment": np.where(columns["lastPayment"] == NONE, np.iinfo(np.int64).max, today - columns["lastPayment"])
+        }
+
+        z = np.full(len(debt), cls.BIAS)
+        for name, (weight, cap) in cls.WEIGHTS.items():
+            z += weight * np.minimum(metrics[name], cap) / cap
+
+        metrics["score"] = np.where(owing, 1 / (1 + np.exp(-z)), 0.0)
+        metrics["delinquent"] = owing & ((metrics["daysPastDue"] >= cls.DELINQUENT_DAYS) | (metrics["arrearsStreak"] >= cls.DELINQUENT_STREAK))
+        return metrics
+
+    @classmethod
+    def rank(cls, query : AnalyticsQuery, today : datetime.date) -> dict:
+        """Rank the users by risk score
+
+        Args:
+            query (AnalyticsQuery): filters, order and page
+            today (datetime.date): date of the metrics
+
+        Returns:
+            dict: date, number of matching users and the page of the ranking
+        """
+        with cls.LOCK:
+            columns = {name: column[:cls.SIZE] for name, column in cls.COLUMNS.items()}
+            metrics = cls.evaluate(columns, day(today))
+
+            mask = columns["active"].copy()
+            if query.minScore is not None:
+                mask &= metrics["score"] >= query.minScore
+            if query.delinquent is not None:
+                mask &= metrics["delinquent"] == query.delinquent
+            if query.state is not None:
+                mask &= columns["state"] == query.state
+
+            rows = np.flatnonzero(mask)
+            score = metrics["score"][rows]
+            order = np.argsort(-score if query.order == "desc" else score, kind="stable")
+            selected = rows[order[query.offset:query.offset + query.limit]]
+
+            payments = columns["payments"][selected]
+            values = {
+                "userId": columns["id"][selected].tolist(),
+                "name": columns["name"][selected].tolist(),
+                "state": columns["state"][selected].tolist(),
+                "debt": columns["debt"][selected].tolist(),
+                "daysToMaturity": metrics["daysToMaturity"][selected].tolist(),
+                "daysPastDue": metrics["daysPastDue"][selected].tolist(),
+                "payments": payments.tolist(),
+                "totalPaid": np.round(columns["totalPaid"][selected], 2).tolist(),
+                "latePayments": columns["latePayments"][selected].tolist(),
+                "onTimeRatio": nullable(np.round(1 - metrics["lateRatio"][selected], 4), payments == 0),
+                "averageDaysLate": nullable(np.round(metrics["averageDaysLate"][selected], 2), columns["duePayments"][selected] == 0),
+                "maxDaysLate": columns["maxDaysLate"][selected].tolist(),
+                "arrearsStreak": metrics["arrearsStreak"][selected].tolist(),
+                "daysSinceLastPayment": nullable(metrics["daysSinceLastPayment"][selected], columns["lastPayment"][selected] == NONE),
+                "delinquent": metrics["delinquent"][selected].tolist(),
+                "score": np.round(metrics["score"][selected], 4).tolist()
+            }
+
+        page = {"asOf": today.isoformat(), "total": len(rows), "offset": query.offset}
+        if query.layout == "columns":
+            return {**page, "columns": values}
+        return {**page, "items": [dict(zip(values, row)) for row in zip(*values.values())]}
+
+    @classmethod
+    async def ranking(cls, query : AnalyticsQuery) -> dict:
+        """Rank the users by risk score with the writes applied
+
+        Args:
+            query (AnalyticsQuery): filters, order and page
+
+        Returns:
+            dict: date, number of matching users and the page of the ranking
+        """
+        await cls.refresh()
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        return await Executor.run("analytics", cls.rank, query, today)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Get the size of the columns
+
+        Returns:
+            dict: users, dirty users and age of the last full load
+        """
+        with cls.LOCK:
+            return {
+                "users": len(cls.ROWS),
+                "dirty": len(cls.DIRTY),
+                "ageSeconds": None if cls.LOADED_AT is None else round(monotonic() - cls.LOADED_AT, 1)
+            }
+
+
+UserController.subscribe(PortfolioAnalytics.invalidate)
@@ -0,0 +1,93 @@
+"""Module to keep the financial profile of each client ready for the prompts
+
+    The profile aggregates the debt and the payment history of a user once per
+    change of the user, instead of sending the whole User (with its password,
+    document and ever growing paymentHistory) in every turn of the chat. The
+    writes of UserController invalidate it, and PROFILE_TTL_SECONDS bounds the
+    staleness of the changes made by other writers of the datastore.
+"""
+
+from cachetools import TTLCache
+
+import datetime
+import os
+from threading import Lock
+from time import monotonic
+from dotenv import load_dotenv
+
+from controller import UserController
+from model import FinancialProfile, PaymentUtils
+
+
+load_dotenv()
+
+
+class ProfileCache:
+    """Class to build and cache the financial profiles by user id
+
+    """
+    MAX_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 10000))
+    TTL_SECONDS = float(os.getenv("PROFILE_TTL_SECONDS", 300))
+
+    PROFILES = TTLCache(maxsize=MAX_SIZE, ttl=TTL_SECONDS, timer=monotonic)
+    # Writes of a user bump its generation so an in flight build can not cache a stale profile
+    GENERATIONS : dict[int, int] = {}
+    LOCK = Lock()
+    HITS = 0
+    MISSES = 0
+
+    @classmethod
+    async def get(cls, id : int) -> FinancialProfile:
+        """Get the profile of a user, building it on a miss
+
+        Args:
+            id (int): id of the user
+
+        Raises:
+            HTTPException: 404 User not found
+
+        Returns:
+            FinancialProfile: financial profile
+        """
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+
+        with cls.LOCK:
+            profile = cls.PROFILES.get(id)
+            generation = cls.GENERATIONS.get(id, 0)
+            # daysToMaturity changes with the day
+            if profile is not None and profile.asOf == today:
+                cls.HITS += 1
+                return profile
+            cls.MISSES += 1
+
+        profile = PaymentUtils.profile(await UserController.getUserById(id), today)
+
+        with cls.LOCK:
+            if cls.GENERATIONS.get(id, 0) == generation:
+                cls.PROFILES[id] = profile
+
+        return profile
+
+    @classmethod
+    def invalidate(cls, id : int) -> None:
+        """Forget the profile of a user after a write
+
+        Args:
+            id (int): id of the user
+        """
+        with cls.LOCK:
+            cls.GENERATIONS[id] = cls.GENERATIONS.get(id, 0) + 1
+            cls.PROFILES.pop(id, None)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Get the counters of the cache
+
+        Returns:
+            dict: hits, misses and size
+        """
+        with cls.LOCK:
+            return {"hits": cls.HITS, "misses": cls.MISSES, "items": len(cls.PROFILES)}
+
+
+UserController.subscribe(ProfileCache.invalidate)
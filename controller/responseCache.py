@@ -0,0 +1,129 @@
+"""Module to reuse the answers of the chat bot to recurring questions
+
+    An answer is keyed by the user, a hash of the financial profile sent with
+    the question and the question itself, exact or normalized (case, accents,
+    punctuation and spaces ignored) as CHAT_CACHE_MATCH says. A change of the
+    debt data changes the profile hash, and the writes of UserController drop
+    the answers of the user right away.
+"""
+
+from cachetools import TTLCache
+
+from hashlib import sha256
+from threading import Lock
+from time import monotonic
+import os
+import re
+import unicodedata
+from typing import Optional
+from dotenv import load_dotenv
+
+from controller import UserController
+from model import FinancialProfile
+
+
+load_dotenv()
+
+
+class ResponseCache:
+    """Class to store the answers by user, profile and question
+
+    """
+    MAX_SIZE = int(os.getenv("CHAT_CACHE_SIZE", 5000))
+    TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", 3600))
+    MATCH = os.getenv("CHAT_CACHE_MATCH", "normalized")
+
+    ANSWERS = TTLCache(maxsize=max(MAX_SIZE, 1), ttl=TTL_SECONDS, timer=monotonic)
+    LOCK = Lock()
+    HITS = 0
+    MISSES = 0
+
+    def enabled() -> bool:
+        return ResponseCache.MAX_SIZE > 0
+
+    def normalize(question : str) -> str:
+        """Normalize a question according to CHAT_CACHE_MATCH
+
+        Args:
+            question (str): question of the client
+
+        Returns:
+            str: question as it is matched
+        """
+        if ResponseCache.MATCH == "exact":
+            return question
+        question = unicodedata.normalize("NFKD", question.casefold())
+        question = "".join(char for char in question if not unicodedata.combining(char))
+        return " ".join(re.sub(r"[^\w\s]", " ", question).split())
+
+    def key(profile : FinancialProfile, question : str) -> tuple[int, str, str]:
+        """Get the key of a question
+
+        Args:
+            profile (FinancialProfile): profile sent with the question
+            question (str): question of the client
+
+        Returns:
+            tuple[int, str, str]: user id, profile hash and matched question
+        """
+        digest = sha256(profile.model_dump_json().encode()).hexdigest()
+        return (profile.userId, digest, ResponseCache.normalize(question))
+
+    @classmethod
+    def get(cls, key : tuple[int, str, str]) -> Optional[str]:
+        """Get the answer of a question
+
+        Args:
+            key (tuple[int, str, str]): key of the question
+
+        Returns:
+            Optional[str]: answer if cached
+        """
+        if not cls.enabled():
+            return None
+
+        with cls.LOCK:
+            answer = cls.ANSWERS.get(key)
+            if answer is None:
+                cls.MISSES += 1
+            else:
+                cls.HITS += 1
+            return answer
+
+    @classmethod
+    def put(cls, key : tuple[int, str, str], answer : str) -> None:
+        """Store the answer of a question
+
+        Args:
+            key (tuple[int, str, str]): key of the question
+            answer (str): answer of the model
+        """
+        if not cls.enabled() or not answer:
+            return
+
+        with cls.LOCK:
+            cls.ANSWERS[key] = answer
+
+    @classmethod
+    def invalidate(cls, id : int) -> None:
+        """Forget the answers of a user after a write
+
+        Args:
+            id (int): id of the user
+        """
+        with cls.LOCK:
+            for key in [key for key in cls.ANSWERS.keys() if key[0] == id]:
+                cls.ANSWERS.pop(key, None)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Get the counters of the cache
+
+        Returns:
+            dict: hits, misses, size and match policy
+        """
+        with cls.LOCK:
+            return {"hits": cls.HITS, "misses": cls.MISSES, "items": len(cls.ANSWERS), "match": cls.MATCH}
+
+
+UserController.subscribe(ResponseCache.invalidate)
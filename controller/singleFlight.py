@@ -0,0 +1,96 @@
+"""Module to share one upstream call between the concurrent callers of the same key
+
+    The first caller of a key starts the call as a task and the callers that
+    arrive while it is in flight await the same task, so a burst of identical
+    reads sends one request to the datastore or to the Google services. The
+    key is forgotten as soon as the call ends, nothing is cached, and forget
+    lets a write make the next callers start a new call instead of joining a
+    read that began before it.
+"""
+
+import asyncio
+from threading import Lock
+from typing import Awaitable, Callable, Hashable, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Class to represent a group of calls coalesced by key
+
+    """
+    GROUPS : list["SingleFlight"] = []
+
+    def __init__(self, name : str):
+        """Create a group
+
+        Args:
+            name (str): name of the group in the stats
+        """
+        self.name = name
+        self.calls : dict[Hashable, asyncio.Task] = {}
+        self.lock = Lock()
+        self.started = 0
+        self.shared = 0
+        SingleFlight.GROUPS.append(self)
+
+    async def do(self, key : Hashable, function : Callable[[], Awaitable[T]]) -> T:
+        """Run a call, or wait for the call of the same key already in flight
+
+        The call runs in its own task, so a caller that is cancelled (a client
+        that disconnects) does not cancel it for the others.
+
+        Args:
+            key (Hashable): key of the call
+            function (Callable[[], Awaitable[T]]): starts the call
+
+        Returns:
+            T: result of the call, shared by every caller of the key
+        """
+        with self.lock:
+            task = self.calls.get(key)
+            if task is None:
+                task = asyncio.ensure_future(function())
+                self.calls[key] = task
+                self.started += 1
+                task.add_done_callback(lambda done: self.done(key, done))
+            else:
+                self.shared += 1
+        return await asyncio.shield(task)
+
+    def __contains__(self, key : Hashable) -> bool:
+        return key in self.calls
+
+    def done(self, key : Hashable, task : asyncio.Task) -> None:
+        with self.lock:
+            if self.calls.get(key) is task:
+                del self.calls[key]
+        # Retrieve the error, it may have no caller left to raise it
+        if not task.cancelled():
+            task.exception()
+
+    def forget(self, key : Optional[Hashable] = None) -> None:
+        """Let the next callers start a new call, the callers in flight keep theirs
+
+        Args:
+            key (Optional[Hashable]): key to forget, every key if None
+        """
+        with self.lock:
+            if key is None:
+                self.calls.clear()
+            else:
+                self.calls.pop(key, None)
+
+    def stats(self) -> dict:
+        """Get the counters of the group
+
+        Returns:
+            dict: calls in flight, started and shared
+        """
+        with self.lock:
+            return {"inFlight": len(self.calls), "started": self.started, "shared": self.shared}
+
+    @classmethod
+    def all(cls) -> dict[str, dict]:
+        return {group.name: group.stats() for group in cls.GROUPS}
@@ -0,0 +1,52 @@
+"""Module to share the connections of the stores kept in SQLite
+
+    Each thread of the Executor that runs the queries keeps its own
+    connection. The databases run in WAL mode, so the reads do not wait for
+    the writes, with the commits synced at the checkpoints only.
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class SQLiteStore:
+    """Base class of the stores kept in a SQLite file
+
+    """
+    # Seconds to wait for the write lock held by another connection
+    TIMEOUT_SECONDS = 5.0
+    # Run by each new connection before the journal mode is set
+    PRAGMAS : tuple[str, ...] = ()
+
+    def __init__(self, path : str):
+        """Open a store, creating the directory of its file
+
+        Args:
+            path (str): path of the database
+        """
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def connection(self) -> sqlite3.Connection:
+        """Get the connection of the current thread
+
+        Returns:
+            sqlite3.Connection: connection
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=self.TIMEOUT_SECONDS)
+            for pragma in self.PRAGMAS:
+                connection.execute(pragma)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def now() -> str:
+        return datetime.now(timezone.utc).isoformat()
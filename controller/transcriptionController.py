@@ -0,0 +1,524 @@
+"""Module to transcribe the audios in the background
+
+    A submitted audio is stored as a job in a SQLite queue and answered with
+    its id at once; a pool of workers (TRANSCRIPTION_WORKERS) claims the jobs
+    in order and runs the recognition in its own executor, so a long audio
+    never holds a request open nor takes the threads of /audio/transcribe.
+
+    A worker holds a lease on its job and renews it while the recognition
+    runs. The job of a worker that crashed is claimed again once its lease
+    expires, by this or by any other process sharing the database. The name
+    of a long running recognition is stored with its job and polled up to
+    TRANSCRIPTION_OPERATION_TIMEOUT_SECONDS, so a retry or a takeover resumes
+    the operation instead of paying for the audio again. The
+    transient errors of Speech-to-Text are retried with exponential backoff
+    up to TRANSCRIPTION_RETRIES times. A job can be cancelled while it waits
+    or runs, its result is then discarded.
+
+    When the job ends, its state is posted to the callbackUrl of the request,
+    signed with an HMAC-SHA256 of the body in the X-Signature header. The
+    callbacks need their own secret (TRANSCRIPTION_WEBHOOK_SECRET) and are
+    disabled without it. A callback only goes to a public address, or to a
+    host of TRANSCRIPTION_CALLBACK_HOSTS when that list is set; the address
+    is checked again when the callback is sent.
+"""
+
+from fastapi import HTTPException
+from google.api_core import exceptions
+
+import asyncio
+import hashlib
+import hmac
+import httpx
+import ipaddress
+import logging
+import os
+import sqlite3
+from contextlib import suppress
+from datetime import datetime, timezone
+from random import randint
+from time import monotonic, time
+from typing import Optional
+from urllib.parse import urlsplit
+from uuid import uuid4
+from dotenv import load_dotenv
+
+from model import Message, TranscriptionRequest, TranscriptionJob
+from controller import AudioController
+from controller.executor import Executor
+from controller.metrics import TRANSCRIPTION_JOBS, TRANSCRIPTION_SECONDS
+from controller.sqliteStore import SQLiteStore
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptionStore(SQLiteStore):
+    """Class to persist the transcription jobs
+
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS transcription_jobs (
+            id TEXT PRIMARY KEY,
+            userId INTEGER NOT NULL,
+            audioPath TEXT NOT NULL,
+            callbackUrl TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            availableAt REAL NOT NULL,
+            leaseUntil REAL,
+            messageId INTEGER,
+            transcript TEXT,
+            error TEXT,
+            operation TEXT,
+            notified INTEGER NOT NULL DEFAULT 0,
+            createdAt TEXT NOT NULL,
+            updatedAt TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS transcription_jobs_queue ON transcription_jobs (status, availableAt);
+        CREATE INDEX IF NOT EXISTS transcription_jobs_lease ON transcription_jobs (status, leaseUntil);
+    """
+    FIELDS = ("id", "userId", "status", "attempts", "createdAt", "updatedAt", "messageId", "transcript", "error")
+    # Other processes may hold the write lock while they claim a job
+    TIMEOUT_SECONDS = 30
+
+    def __init__(self, path : str = None):
+        super().__init__(path or os.getenv("TRANSCRIPTION_SQLITE_PATH", "./data/transcriptions.sqlite3"))
+        connection = self.connection()
+        connection.executescript(TranscriptionStore.SCHEMA)
+        columns = [column for _, column, *_ in connection.execute("PRAGMA table_info(transcription_jobs)")]
+        if "operation" not in columns:
+            connection.execute("ALTER TABLE transcription_jobs ADD COLUMN operation TEXT")
+
+    def create(self, id : str, request : TranscriptionRequest) -> None:
+        now = TranscriptionStore.now()
+        self.connection().execute(
+            "INSERT INTO transcription_jobs (id, userId, audioPath, callbackUrl, availableAt, createdAt, updatedAt) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (id, request.userId, request.audioPath, request.callbackUrl, time(), now, now))
+
+    def claim(self, leaseSeconds : float) -> Optional[tuple[str, str, int, str, Optional[str]]]:
+        """Take the oldest job ready to run, or a running job whose lease expired
+
+        Args:
+            leaseSeconds (float): time the job is held without renewing the lease
+
+        Returns:
+            Optional[tuple[str, str, int, str, Optional[str]]]: id, audio path, attempts, creation time and operation of the job, None if the queue is empty
+        """
+        now = time()
+        return self.connection().execute(
+            """UPDATE transcription_jobs SET status = 'running', attempts = attempts + 1, leaseUntil = ?, updatedAt = ?
+               WHERE id = (SELECT id FROM transcription_jobs
+                           WHERE (status = 'queued' AND availableAt <= ?) OR (status = 'running' AND leaseUntil < ?)
+                           ORDER BY availableAt LIMIT 1)
+               RETURNING id, audioPath, attempts, createdAt, operation""",
+            (now + leaseSeconds, TranscriptionStore.now(), now, now)).fetchone()
+
+    def renew(self, id : str, leaseSeconds : float) -> None:
+        self.connection().execute("UPDATE transcription_jobs SET leaseUntil = ? WHERE id = ? AND status = 'running'", (time() + leaseSeconds, id))
+
+    def setOperation(self, id : str, operation : Optional[str]) -> None:
+        self.connection().execute("UPDATE transcription_jobs SET operation = ? WHERE id = ?", (operation, id))
+
+    def status(self, id : str) -> Optional[str]:
+        row = self.connection().execute("SELECT status FROM transcription_jobs WHERE id = ?", (id,)).fetchone()
+        return row[0] if row else None
+
+    def release(self, id : str) -> None:
+        # Interrupted by a shutdown, not a failure of the job
+        self.connection().execute(
+            "UPDATE transcription_jobs SET status = 'queued', attempts = attempts - 1, leaseUntil = NULL, availableAt = ? WHERE id = ? AND status = 'running'",
+            (time(), id))
+
+    def retry(self, id : str, delay : float, error : str) -> bool:
+        cursor = self.connection().execute(
+            "UPDATE transcription_jobs SET status = 'queued', leaseUntil = NULL, availableAt = ?, error = ?, updatedAt = ? WHERE id = ? AND status = 'running'",
+            (time() + delay, error, TranscriptionStore.now(), id))
+        return cursor.rowcount > 0
+
+    def finish(self, id : str, transcript : Optional[str], error : Optional[str]) -> bool:
+        """Store the result of a job, unless it was cancelled meanwhile
+
+        Args:
+            id (str): id of the job
+            transcript (Optional[str]): transcript, None if the job failed
+            error (Optional[str]): error of the job
+
+        Returns:
+            bool: the job was still running
+        """
+        cursor = self.connection().execute(
+            "UPDATE transcription_jobs SET status = ?, leaseUntil = NULL, messageId = ?, transcript = ?, error = ?, updatedAt = ? WHERE id = ? AND status = 'running'",
+            ("failed" if error else "done", None if error else randint(1, 99999), transcript, error, TranscriptionStore.now(), id))
+        return cursor.rowcount > 0
+
+    def cancel(self, id : str) -> bool:
+        cursor = self.connection().execute(
+            "UPDATE transcription_jobs SET status = 'cancelled', leaseUntil = NULL, updatedAt = ? WHERE id = ? AND status IN ('queued', 'running')",
+            (TranscriptionStore.now(), id))
+        return cursor.rowcount > 0
+
+    def job(self, id : str) -> Optional[TranscriptionJob]:
+        """Get a job with its transcript once done
+
+        Args:
+            id (str): id of the job
+
+        Returns:
+            Optional[TranscriptionJob]: job, None if it does not exist
+        """
+        row = self.connection().execute(f"SELECT {', '.join(TranscriptionStore.FIELDS)} FROM transcription_jobs WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        values = dict(zip(TranscriptionStore.FIELDS, row))
+        messageId, transcript = values.pop("messageId"), values.pop("transcript")
+        if values["status"] == "done":
+            values["message"] = Message(id=messageId, createdAt=values["updatedAt"], userId=values["userId"], message=transcript)
+        return TranscriptionJob(**values)
+
+    def callback(self, id : str) -> Optional[str]:
+        row = self.connection().execute("SELECT callbackUrl FROM transcription_jobs WHERE id = ?", (id,)).fetchone()
+        return row[0] if row else None
+
+    def setNotified(self, id : str) -> None:
+        self.connection().execute("UPDATE transcription_jobs SET notified = 1 WHERE id = ?", (id,))
+
+    def unnotified(self) -> list[str]:
+        # Jobs that ended right before a shutdown, their callback was never sent
+        rows = self.connection().execute(
+            "SELECT id FROM transcription_jobs WHERE status IN ('done', 'failed') AND callbackUrl IS NOT NULL AND notified = 0").fetchall()
+        return [id for (id,) in rows]
+
+    def queued(self) -> int:
+        return self.connection().execute("SELECT COUNT(*) FROM transcription_jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def counts(self) -> dict[str, int]:
+        return dict(self.connection().execute("SELECT status, COUNT(*) FROM transcription_jobs GROUP BY status").fetchall())
+
+    def purge(self, maxAgeSeconds : float) -> int:
+        cutoff = datetime.fromtimestamp(time() - maxAgeSeconds, timezone.utc).isoformat()
+        cursor = self.connection().execute(
+            "DELETE FROM transcription_jobs WHERE status IN ('done', 'failed', 'cancelled') AND updatedAt < ? AND (notified = 1 OR callbackUrl IS NULL)",
+            (cutoff,))
+        return cursor.rowcount
+
+
+class Controller:
+
+    WORKERS = int(os.getenv("TRANSCRIPTION_WORKERS", 4))
+    MAX_QUEUED = int(os.getenv("TRANSCRIPTION_MAX_QUEUED", 10000))
+    RETRIES = int(os.getenv("TRANSCRIPTION_RETRIES", 3))
+    RETRY_BACKOFF_SECONDS = float(os.getenv("TRANSCRIPTION_RETRY_BACKOFF_SECONDS", 5))
+    LEASE_SECONDS = float(os.getenv("TRANSCRIPTION_LEASE_SECONDS", 30))
+    # Long running recognitions of hours of audio take many minutes
+    OPERATION_TIMEOUT_SECONDS = float(os.getenv("TRANSCRIPTION_OPERATION_TIMEOUT_SECONDS", 4 * 3600))
+    OPERATION_POLL_SECONDS = float(os.getenv("TRANSCRIPTION_OPERATION_POLL_SECONDS", 5))
+    POLL_SECONDS = float(os.getenv("TRANSCRIPTION_POLL_SECONDS", 1))
+    RETENTION_SECONDS = float(os.getenv("TRANSCRIPTION_RETENTION_SECONDS", 7 * 24 * 3600))
+    WEBHOOK_SECRET = os.getenv("TRANSCRIPTION_WEBHOOK_SECRET", "")
+    WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("TRANSCRIPTION_WEBHOOK_TIMEOUT_SECONDS", 10))
+    WEBHOOK_RETRIES = int(os.getenv("TRANSCRIPTION_WEBHOOK_RETRIES", 3))
+    # Hosts allowed to receive the callbacks (and their subdomains), any public address when empty
+    CALLBACK_HOSTS = [host.strip().lower() for host in os.getenv("TRANSCRIPTION_CALLBACK_HOSTS", "").split(",") if host.strip()]
+    # Errors of Speech-to-Text worth another attempt, a full executor queue answers like a busy service.
+    # An operation past TRANSCRIPTION_OPERATION_TIMEOUT_SECONDS is not one of them
+    TRANSIENT = (exceptions.ResourceExhausted, exceptions.TooManyRequests, exceptions.ServiceUnavailable,
+                 exceptions.DeadlineExceeded, exceptions.InternalServerError, HTTPException)
+
+    STORE : Optional[TranscriptionStore] = None
+    WORKER_TASKS : list[asyncio.Task] = []
+    # Callbacks being delivered
+    NOTIFICATIONS : set[asyncio.Task] = set()
+    WAKEUP : Optional[asyncio.Event] = None
+    CLIENT : Optional[httpx.AsyncClient] = None
+    PURGED_AT = 0.0
+
+    Executor.configure("transcription", workers=WORKERS)
+
+    def store() -> TranscriptionStore:
+        if Controller.STORE is None:
+            Controller.STORE = TranscriptionStore()
+        return Controller.STORE
+
+    async def call(function, *args):
+        return await Executor.run("sqlite", function, *args)
+
+    async def submit(request : TranscriptionRequest) -> TranscriptionJob:
+        """Queue an audio to transcribe
+
+        Args:
+            request (TranscriptionRequest): audio, user and callback
+
+        Raises:
+            HTTPException: 400 Callbacks are disabled
+            HTTPException: 400 Callback url not allowed
+            HTTPException: 503 Too many transcriptions queued
+
+        Returns:
+            TranscriptionJob: queued job
+        """
+        if request.callbackUrl is not None:
+            if not Controller.WEBHOOK_SECRET:
+                raise HTTPException(status_code=400, detail="Callbacks are disabled")
+            if not await Controller.allowed(request.callbackUrl):
+                raise HTTPException(status_code=400, detail="Callback url not allowed")
+
+        store = Controller.store()
+        if await Controller.call(store.queued) >= Controller.MAX_QUEUED:
+            raise HTTPException(status_code=503, detail="Too many transcriptions queued", headers={"Retry-After": str(int(Controller.RETRY_BACKOFF_SECONDS * 6))})
+
+        id = uuid4().hex
+        await Controller.call(store.create, id, request)
+        if Controller.WAKEUP is not None:
+            Controller.WAKEUP.set()
+        return await Controller.call(store.job, id)
+
+    async def getJob(id : str) -> TranscriptionJob:
+        """Get the state of a job
+
+        Args:
+            id (str): id of the job
+
+        Raises:
+            HTTPException: 404 Job not found
+
+        Returns:
+            TranscriptionJob: job
+        """
+        job = await Controller.call(Controller.store().job, id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job
+
+    async def cancel(id : str) -> TranscriptionJob:
+        """Cancel a queued or running job
+
+        Args:
+            id (str): id of the job
+
+        Raises:
+            HTTPException: 404 Job not found
+            HTTPException: 409 Job already ended
+
+        Returns:
+            TranscriptionJob: cancelled job
+        """
+        if not await Controller.call(Controller.store().cancel, id):
+            job = await Controller.getJob(id)
+            raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+        TRANSCRIPTION_JOBS.inc("cancelled")
+        return await Controller.getJob(id)
+
+    async def heartbeat(id : str) -> None:
+        while True:
+            await asyncio.sleep(Controller.LEASE_SECONDS / 3)
+            with suppress(sqlite3.Error):
+                await Controller.call(Controller.store().renew, id, Controller.LEASE_SECONDS)
+
+    async def wait(id : str, name : str) -> Optional[str]:
+        """Poll a long running recognition until it ends or its job is cancelled
+
+        Args:
+            id (str): id of the job
+            name (str): name of the operation
+
+        Raises:
+            TimeoutError: if the operation lasts more than TRANSCRIPTION_OPERATION_TIMEOUT_SECONDS
+
+        Returns:
+            Optional[str]: transcript, None if the job was cancelled
+        """
+        operation = await Executor.run("transcription", AudioController.operation, name)
+        deadline = monotonic() + Controller.OPERATION_TIMEOUT_SECONDS
+        # The thread is only taken by each poll, not for the whole recognition
+        while not await Executor.run("transcription", operation.done):
+            if await Controller.call(Controller.store().status, id) == "cancelled":
+                with suppress(exceptions.GoogleAPIError):
+                    await Executor.run("transcription", operation.cancel)
+                return None
+            if monotonic() > deadline:
+                raise TimeoutError(f"Operation {name} still running")
+            await asyncio.sleep(Controller.OPERATION_POLL_SECONDS)
+        return AudioController.transcript(await Executor.run("transcription", operation.result))
+
+    async def process(id : str, audioPath : str, attempts : int, createdAt : str, operation : Optional[str] = None) -> None:
+        """Transcribe the audio of a claimed job and store the result
+
+        Args:
+            id (str): id of the job
+            audioPath (str): path of the audio
+            attempts (int): attempts so far, this one included
+            createdAt (str): submission time of the job
+            operation (Optional[str]): long running recognition started by a previous attempt
+        """
+        store = Controller.store()
+        heartbeat = asyncio.create_task(Controller.heartbeat(id))
+        transcript, error, retry = None, None, False
+        try:
+            if attempts > Controller.RETRIES + 1:
+                # The previous attempts were lost with their worker
+                error = "Too many attempts"
+            else:
+                if operation is None:
+                    transcript, operation = await Executor.run("transcription", AudioController.begin, audioPath)
+                    if operation is not None:
+                        await Controller.call(store.setOperation, id, operation)
+                if operation is not None:
+                    transcript = await Controller.wait(id, operation)
+        except exceptions.NotFound as e:
+            # The operation expired, the next attempt sends the audio again
+            await Controller.call(store.setOperation, id, None)
+            error, retry = f"{e}", attempts <= Controller.RETRIES
+        except Controller.TRANSIENT as e:
+            error, retry = f"{getattr(e, 'detail', e)}", attempts <= Controller.RETRIES
+        except Exception as e:
+            error = f"{e}" or type(e).__name__
+        finally:
+            heartbeat.cancel()
+
+        if retry:
+            if await Controller.call(store.retry, id, Controller.RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1), error):
+                TRANSCRIPTION_JOBS.inc("retried")
+            return
+
+        if await Controller.call(store.finish, id, transcript, error):
+            status = "failed" if error else "done"
+            TRANSCRIPTION_JOBS.inc(status)
+            TRANSCRIPTION_SECONDS.observe(status, value=max(datetime.now(timezone.utc).timestamp() - datetime.fromisoformat(createdAt).timestamp(), 0))
+            Controller.notify(id)
+
+    async def work() -> None:
+        """Claim and process jobs until the worker is cancelled
+        """
+        store = Controller.store()
+        while True:
+            job = None
+            try:
+                job = await Controller.call(store.claim, Controller.LEASE_SECONDS)
+                if job is None:
+                    Controller.WAKEUP.clear()
+                    # Woken by a submission, or polls for the retries and the jobs of other processes
+                    try:
+                        await asyncio.wait_for(Controller.WAKEUP.wait(), Controller.POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    await Controller.maintain()
+                    continue
+
+                await Controller.process(*job)
+            except asyncio.CancelledError:
+                if job is not None:
+                    await Controller.call(store.release, job[0])
+                raise
+            except Exception:
+                # A locked database or a full executor, the lease gives the job to another worker
+                logger.exception("Transcription worker failed")
+                await asyncio.sleep(Controller.POLL_SECONDS)
+
+    async def maintain() -> None:
+        if time() - Controller.PURGED_AT > 3600:
+            Controller.PURGED_AT = time()
+            await Controller.call(Controller.store().purge, Controller.RETENTION_SECONDS)
+
+    def client() -> httpx.AsyncClient:
+        if Controller.CLIENT is None or Controller.CLIENT.is_closed:
+            Controller.CLIENT = httpx.AsyncClient(timeout=Controller.WEBHOOK_TIMEOUT_SECONDS)
+        return Controller.CLIENT
+
+    async def allowed(url : str) -> bool:
+        """Check that a callback url points to an allowed host
+
+        Without TRANSCRIPTION_CALLBACK_HOSTS every address of the host must be
+        public, so a callback never reaches the loopback, the private network
+        or the metadata services of the cloud.
+
+        Args:
+            url (str): callback url
+
+        Returns:
+            bool: True if the callback can be sent
+        """
+        try:
+            parts = urlsplit(url)
+            host, port = parts.hostname, parts.port
+        except ValueError:
+            return False
+        if parts.scheme not in ("http", "https") or not host:
+            return False
+
+        host = host.lower()
+        if Controller.CALLBACK_HOSTS:
+            return any(host == allowed or host.endswith(f".{allowed}") for allowed in Controller.CALLBACK_HOSTS)
+
+        try:
+            addresses = await asyncio.get_running_loop().getaddrinfo(host, port or (443 if parts.scheme == "https" else 80))
+        except OSError:
+            return False
+        return bool(addresses) and all(ipaddress.ip_address(address[4][0].split("%")[0]).is_global for address in addresses)
+
+    def notify(id : str) -> None:
+        task = asyncio.create_task(Controller.deliver(id))
+        Controller.NOTIFICATIONS.add(task)
+        task.add_done_callback(Controller.NOTIFICATIONS.discard)
+
+    async def deliver(id : str) -> None:
+        """Post the state of an ended job to its callback url
+
+        Args:
+            id (str): id of the job
+        """
+        store = Controller.store()
+        url = await Controller.call(store.callback, id)
+        if url is None:
+            return
+
+        # Disabled since the submission, or the host now resolves to an address not allowed
+        if not Controller.WEBHOOK_SECRET or not await Controller.allowed(url):
+            logger.warning("Callback of the transcription job %s not sent", id)
+            await Controller.call(store.setNotified, id)
+            return
+
+        body = (await Controller.call(store.job, id)).model_dump_json().encode()
+        signature = hmac.new(Controller.WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        headers = {"Content-Type": "application/json", "X-Job-Id": id, "X-Signature": f"sha256={signature}"}
+
+        for attempt in range(Controller.WEBHOOK_RETRIES + 1):
+            try:
+                response = await Controller.client().post(url, content=body, headers=headers)
+                if response.status_code < 500 and response.status_code != 429:
+                    break
+            except httpx.HTTPError:
+                pass
+            if attempt < Controller.WEBHOOK_RETRIES:
+                await asyncio.sleep(Controller.RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+        # Delivered or given up, it is not sent again after a restart
+        await Controller.call(store.setNotified, id)
+
+    async def start() -> None:
+        """Start the workers and send the callbacks interrupted by a shutdown
+        """
+        if Controller.WORKER_TASKS:
+            return
+        Controller.WAKEUP = asyncio.Event()
+        Controller.WORKER_TASKS = [asyncio.create_task(Controller.work()) for _ in range(Controller.WORKERS)]
+        for id in await Controller.call(Controller.store().unnotified):
+            Controller.notify(id)
+
+    async def stop() -> None:
+        """Stop the workers, their jobs go back to the queue for the next start
+        """
+        tasks = Controller.WORKER_TASKS + list(Controller.NOTIFICATIONS)
+        Controller.WORKER_TASKS = []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if Controller.CLIENT is not None:
+            await Controller.CLIENT.aclose()
+            Controller.CLIENT = None
+
+    async def stats() -> dict:
+        return {"workers": sum(not task.done() for task in Controller.WORKER_TASKS), "notifying": len(Controller.NOTIFICATIONS),
+                "jobs": await Controller.call(Controller.store().counts)}
@@ -14,14 +14,13 @@
 
 from fastapi import HTTPException
 
-import requests
-import json
-from datetime import datetime
 import os
-from typing import Optional
+from typing import Callable, Optional
 from dotenv import load_dotenv
 
-from model import User , UserUtils
+from model import User, UserQuery
+from controller.userRepository import Repository
+from controller.singleFlight import SingleFlight
 
 
 load_dotenv()
@@ -32,11 +31,36 @@ class Controller:
     """Class to control the data flow between the model and the view
     
     """
-    URL_DB_ENDPOINT = os.getenv("DB_ENDPOINT")
-    ENDPOINT_USER =  URL_DB_ENDPOINT + os.getenv("DB_USER_ENDPOINT")
+    REPOSITORY : Repository = Repository.fromConfig(os.getenv("USER_REPOSITORY", "rest"))
+    
+    FIELDS = [field for field in User.model_fields if field != "password"]
+    
+    LISTENERS : list[Callable[[int], None]] = []
+    
+    # Concurrent identical reads share one call to the repository
+    READS = SingleFlight("users")
+
+    def subscribe(listener : Callable[[int], None]) -> None:
+        """Register a function called with the id of every created, updated or deleted user
+
+        Args:
+            listener (Callable[[int], None]): function to invalidate data derived from a user
+        """
+        Controller.LISTENERS.append(listener)
+
+    def notify(id : int) -> None:
+        """Call the listeners after a write of a user
+
+        Args:
+            id (int): id of the user
+        """
+        # A read in flight may have started before the write, the next callers must not join it
+        Controller.READS.forget()
+        for listener in Controller.LISTENERS:
+            listener(id)
 
-    def getUsers() -> list[User]:
-        """Get all users from the endpoint
+    async def getUsers() -> list[User]:
+        """Get all users from the repository
 
         Raises:
             HTTPException: 404 Users not found
@@ -45,19 +69,30 @@ class Controller:
         Returns:
             list[User]: list of users
         """
-        response = requests.get(Controller.ENDPOINT_USER)
-        
-        if response.status_code == 404:
-            raise HTTPException(status_code=404, detail="Users not found")
-        
-        elif response.status_code == 500:
-            raise HTTPException(status_code=500, detail="Internal error")
+        return list(await Controller.READS.do("all", Controller.REPOSITORY.all))
+
+    async def searchUsers(query : UserQuery) -> tuple[list[str], Optional[int]]:
+        """Get a page of users filtered and projected by the repository
+
+        Args:
+            query (UserQuery): filters, page and fields
+
+        Raises:
+            HTTPException: 400 Unknown fields
+
+        Returns:
+            tuple[list[str], Optional[int]]: a JSON object by user, and the cursor of the next page if any
+        """
+        fields = [field.strip() for field in query.fields.split(",") if field.strip()] if query.fields else Controller.FIELDS
+        unknown = [field for field in fields if field not in Controller.FIELDS]
         
-        users = response.json()
+        if unknown or not fields:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
         
-        return [UserUtils.from_json(user) for user in users]
+        key = ("search", query.model_dump_json(), tuple(fields))
+        return await Controller.READS.do(key, lambda: Controller.REPOSITORY.search(query, fields))
 
-    def getUserById(id : int) -> User:
+    async def getUserById(id : int) -> User:
         """Get a user by id
 
         Args:
@@ -71,20 +106,9 @@ class Controller:
         Returns:
             User: user
         """
-        response = requests.get(Controller.ENDPOINT_USER + f"/{id}")
-        
-        if response.status_code == 404:
-            raise HTTPException(status_code=404, detail="User not found")
-        elif response.status_code == 500:
-            raise HTTPException(status_code=500, detail="Internal error")
-        elif response.status_code == 400:
-            raise HTTPException(status_code=400, detail="Bad request")
+        return await Controller.READS.do(("id", id), lambda: Controller.REPOSITORY.get(id))
         
-        user = response.json()
-        
-        return UserUtils.from_json(user)
-        
-    def postUser(user : User) -> User:
+    async def postUser(user : User) -> User:
         """Post a user
 
         Args:
@@ -98,24 +122,14 @@ class Controller:
         Returns:
             User: user
         """       
-        try:
-            json_ = json.loads(UserUtils.to_json(user = user))
-            
-        except Exception:
-            raise HTTPException(status_code=500, detail="Internal error")
+        user = await Controller.REPOSITORY.create(user)
+        
+        if user is not None:
+            Controller.notify(user.id)
         
-        response = requests.post(Controller.ENDPOINT_USER, json=json_)
-
-        if response.status_code == 500:
-            raise HTTPException(status_code=500, detail="Internal error")
-        elif response.status_code == 400:
-            raise HTTPException(status_code=400, detail="Bad request")
-        elif response.status_code == 409:
-            raise HTTPException(status_code=409, detail="User already exists")
-        elif response.status_code == 201:
-            return UserUtils.from_json(response.json())
+        return user
     
-    def putUser(user : User) -> User:
+    async def putUser(user : User) -> User:
         """Put a user
 
         Args:
@@ -129,24 +143,15 @@ class Controller:
         Returns:
             User: user
         """
-        try:
-            json = json.loads(UserUtils.to_json(user = user))
-        except Exception:
-            raise HTTPException(status_code=500, detail="Internal error")
+        user = await Controller.REPOSITORY.update(user)
         
-        response = requests.put(Controller.ENDPOINT_USER + f"/{user.id}", json=json)
-
-        if response.status_code == 500:
-            raise HTTPException(status_code=500, detail="Internal error")
-        elif response.status_code == 400:
-            raise HTTPException(status_code=400, detail="Bad request")
-        elif response.status_code == 404:
-            raise HTTPException(status_code=404, detail="User not found")
-        elif response.status_code == 200:
-            return user
+        if user is not None:
+            Controller.notify(user.id)
         
+        return user
         
-    def deleteUser(id : int) -> None:
+        
+    async def deleteUser(id : int) -> None:
         """Delete a user
 
         Args:
@@ -158,49 +163,30 @@ class Controller:
             HTTPException: 404 User not found
             HTTPException: 204 No content
         """
-        response = requests.delete(Controller.ENDPOINT_USER + f"/{id}")
-
-        if response.status_code == 500:
-            raise HTTPException(status_code=500, detail="Internal error")
-        elif response.status_code == 400:
-            raise HTTPException(status_code=400, detail="Bad request")
-        elif response.status_code == 404:
-            raise HTTPException(status_code=404, detail="User not found")
-        elif response.status_code == 200 or response.status_code == 204:
-            return HTTPException(status_code=204, detail="No content")
+        await Controller.REPOSITORY.delete(id)
+        
+        Controller.notify(id)
+        
+        return HTTPException(status_code=204, detail="No content")
     
-    def getUserByEmail(email : str) -> Optional[User]:
+    async def getUserByEmail(email : str) -> Optional[User]:
         """get user by email
 
         Args:
-            endpoint_users (str): endpoint to filter users by email
             email (str): email of the user
 
         Returns:
-            list[data.User]: list of users
+            Optional[User]: user if found
         """
-        users = Controller.getUsers()
-
-        list_ = list(filter(lambda  user: user.email == email, users))
-
-        user : Optional[User] = None if len(list_) <= 0 else list_[0] 
+        return await Controller.READS.do(("email", email), lambda: Controller.REPOSITORY.findByEmail(email))
         
-        return user if user is not None else None
-        
-    def getUserByUserName(userName : str) -> Optional[User]:
-        """Filter users by user name
+    async def getUserByUserName(userName : str) -> Optional[User]:
+        """Get user by user name
 
         Args:
-            endpoint_users (str): endpoint to filter users by user name
             userName (str): user name of the user
 
         Returns:
-            list[data.User]: list of users
+            Optional[User]: user if found
         """
-        users = Controller.getUsers()
-
-        list_ = list(filter(lambda  user: user.userName == userName, users))
-
-        user : Optional[User] = None if len(list_) <= 0 else list_[0] 
-        
-        return user if user is not None else None
\ No newline at end of file
+        return await Controller.READS.do(("userName", userName), lambda: Controller.REPOSITORY.findByUserName(userName))
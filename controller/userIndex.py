@@ -0,0 +1,127 @@
+"""Module to keep an in-process identity index of the users
+
+    The index maps id, email and userName to the same User object so a login
+    resolves a user in O(1) instead of downloading and scanning the whole
+    user collection. Reads by id do not trust it, see RestRepository.get.
+"""
+
+from threading import RLock
+from time import monotonic
+import os
+from typing import Optional, Iterable
+from dotenv import load_dotenv
+
+from model import User
+
+
+load_dotenv()
+
+
+class UserIndex:
+    """Class to index the users by id, email and userName
+
+    """
+    TTL_SECONDS = float(os.getenv("USER_INDEX_TTL_SECONDS", 300))
+    MIN_REFRESH_SECONDS = float(os.getenv("USER_INDEX_MIN_REFRESH_SECONDS", 5))
+
+    LOCK = RLock()
+    BY_ID : dict[int, User] = {}
+    BY_EMAIL : dict[str, User] = {}
+    BY_USER_NAME : dict[str, User] = {}
+    LOADED_AT : Optional[float] = None
+
+    @classmethod
+    def load(cls, users : Iterable[User]) -> None:
+        """Replace the index content with a full snapshot of the users
+
+        Args:
+            users (Iterable[User]): every user of the datastore
+        """
+        byId, byEmail, byUserName = {}, {}, {}
+
+        for user in users:
+            byId[user.id] = user
+            byEmail.setdefault(user.email, user)
+            byUserName.setdefault(user.userName, user)
+
+        with cls.LOCK:
+            cls.BY_ID, cls.BY_EMAIL, cls.BY_USER_NAME = byId, byEmail, byUserName
+            cls.LOADED_AT = monotonic()
+
+    @classmethod
+    def age(cls) -> float:
+        """Seconds since the last full load, infinite if never loaded
+
+        Returns:
+            float: age of the index
+        """
+        return float("inf") if cls.LOADED_AT is None else monotonic() - cls.LOADED_AT
+
+    @classmethod
+    def isFresh(cls) -> bool:
+        """Check if the index can be trusted without a reload
+
+        Returns:
+            bool: True if the last load is younger than the TTL
+        """
+        return cls.age() < cls.TTL_SECONDS
+
+    @classmethod
+    def canRefresh(cls) -> bool:
+        """Check if a reload on a lookup miss is allowed
+
+        A miss may come from a user created by another process, but an unknown
+        login must not trigger a full download on every attempt.
+
+        Returns:
+            bool: True if the last load is older than the minimum refresh interval
+        """
+        return cls.age() >= cls.MIN_REFRESH_SECONDS
+
+    @classmethod
+    def getById(cls, id : int) -> Optional[User]:
+        return cls.BY_ID.get(id)
+
+    @classmethod
+    def getByEmail(cls, email : str) -> Optional[User]:
+        return cls.BY_EMAIL.get(email)
+
+    @classmethod
+    def getByUserName(cls, userName : str) -> Optional[User]:
+        return cls.BY_USER_NAME.get(userName)
+
+    @classmethod
+    def put(cls, user : User) -> None:
+        """Insert or replace a user in the index
+
+        Args:
+            user (User): user to index
+        """
+        with cls.LOCK:
+            cls.remove(user.id)
+            cls.BY_ID[user.id] = user
+            cls.BY_EMAIL[user.email] = user
+            cls.BY_USER_NAME[user.userName] = user
+
+    @classmethod
+    def remove(cls, id : int) -> None:
+        """Remove a user from the index
+
+        Args:
+            id (int): id of the user
+        """
+        with cls.LOCK:
+            user = cls.BY_ID.pop(id, None)
+            if user is None:
+                return
+            if cls.BY_EMAIL.get(user.email) is user:
+                del cls.BY_EMAIL[user.email]
+            if cls.BY_USER_NAME.get(user.userName) is user:
+                del cls.BY_USER_NAME[user.userName]
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """Force a full reload on the next lookup
+        """
+        with cls.LOCK:
+            cls.LOADED_AT = None
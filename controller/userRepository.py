@@ -0,0 +1,578 @@
+"""Module to store the users behind a common repository interface
+
+    RestRepository talks with the remote datastore (DB_ENDPOINT), SQLiteRepository
+    keeps the users in an embedded database and CachedRepository reads through a
+    local SQLite copy of the remote datastore. USER_REPOSITORY selects one of
+    rest, sqlite or cached.
+"""
+
+from fastapi import HTTPException
+
+from abc import ABC, abstractmethod
+import heapq
+import os
+import sqlite3
+from time import monotonic
+from typing import Optional
+from dotenv import load_dotenv
+
+from model import User, UserUtils, UserQuery
+from controller.userIndex import UserIndex
+from controller.dbClient import DBClient
+from controller.executor import Executor
+from controller.singleFlight import SingleFlight
+from controller.sqliteStore import SQLiteStore
+
+
+load_dotenv()
+
+
+class Repository(ABC):
+    """Class to define the operations of a user repository
+    """
+
+    @abstractmethod
+    async def all(self) -> list[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get(self, id : int) -> User:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create(self, user : User) -> User:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update(self, user : User) -> User:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, id : int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def findByEmail(self, email : str) -> Optional[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def findByUserName(self, userName : str) -> Optional[User]:
+        raise NotImplementedError
+
+    async def snapshot(self) -> list[User]:
+        return await self.all()
+
+    async def search(self, query : UserQuery, fields : list[str]) -> tuple[list[str], Optional[int]]:
+        """Get a page of users that pass the filters of a query
+
+        Args:
+            query (UserQuery): filters and page
+            fields (list[str]): fields to return
+
+        Returns:
+            tuple[list[str], Optional[int]]: a JSON object by user, and the cursor of the next page if any
+        """
+        users = heapq.nsmallest(query.offset + query.limit + 1,
+                                (user for user in await self.snapshot() if query.matches(user)),
+                                key=lambda user: user.id)
+        page = users[query.offset:query.offset + query.limit]
+        include = set(fields)
+        lines = [user.model_dump_json(include=include) for user in page]
+        return lines, page[-1].id if len(users) > query.offset + query.limit else None
+
+    def fromConfig(kind : str) -> "Repository":
+        """Create the repository of a kind
+
+        Args:
+            kind (str): rest, sqlite or cached
+
+        Raises:
+            ValueError: if the kind is unknown
+
+        Returns:
+            Repository: repository
+        """
+        if kind == "rest":
+            return RestRepository()
+        elif kind == "sqlite":
+            return SQLiteRepository()
+        elif kind == "cached":
+            return CachedRepository(RestRepository(), SQLiteRepository())
+        raise ValueError(f"Unknown user repository {kind}")
+
+
+class RestRepository(Repository):
+    """Class to store the users in the remote datastore
+
+    Lookups by email and userName go through the in-process UserIndex. Reads
+    by id always reach the datastore, so a user changed or deleted by another
+    process is not served from the index; the callers cache them for as
+    short as they need (AUTH_PRINCIPAL_TTL_SECONDS).
+    """
+
+    HEADERS = {"Content-Type": "application/json"}
+    # Concurrent lookups on a stale index share one full download
+    RELOADS = SingleFlight("userIndex")
+
+    def __init__(self):
+        self.endpoint = os.getenv("DB_ENDPOINT") + os.getenv("DB_USER_ENDPOINT")
+
+    async def all(self) -> list[User]:
+        """Get all users from the endpoint
+
+        Raises:
+            HTTPException: 404 Users not found
+            HTTPException: 500 Internal error
+            HTTPException: 502 Unexpected response of the datastore
+
+        Returns:
+            list[User]: list of users
+        """
+        response = await DBClient.get(self.endpoint)
+
+        if response.status_code == 404:
+            raise HTTPException(status_code=404, detail="Users not found")
+
+        elif response.status_code == 500:
+            raise HTTPException(status_code=500, detail="Internal error")
+
+        elif response.status_code != 200:
+            raise HTTPException(status_code=502, detail="Unexpected response of the datastore")
+
+        users = UserUtils.list_from_bytes(response.content)
+
+        UserIndex.load(users)
+
+        return users
+
+    async def get(self, id : int) -> User:
+        """Get a user by id
+
+        Args:
+            id (int): id of the user
+
+        Raises:
+            HTTPException: 404 User not found
+            HTTPException: 500 Internal error
+            HTTPException: 400 Bad request
+            HTTPException: 502 Unexpected response of the datastore
+
+        Returns:
+            User: user
+        """
+        response = await DBClient.get(self.endpoint + f"/{id}")
+
+        if response.status_code == 404:
+            raise HTTPException(status_code=404, detail="User not found")
+        elif response.status_code == 500:
+            raise HTTPException(status_code=500, detail="Internal error")
+        elif response.status_code == 400:
+            raise HTTPException(status_code=400, detail="Bad request")
+        elif response.status_code != 200:
+            raise HTTPException(status_code=502, detail="Unexpected response of the datastore")
+
+        user = UserUtils.from_bytes(response.content)
+
+        UserIndex.put(user)
+
+        return user
+
+    async def create(self, user : User) -> User:
+        """Post a user
+
+        Args:
+            user (User): user to post
+
+        Raises:
+            HTTPException: 500 Internal error
+            HTTPException: 400 Bad request
+            HTTPException: 409 User already exists
+            HTTPException: 502 Unexpected response of the datastore
+
+        Returns:
+            User: user
+        """
+        response = await DBClient.post(self.endpoint, content=UserUtils.to_bytes(user), headers=self.HEADERS)
+
+        if response.status_code == 500:
+            raise HTTPException(status_code=500, detail="Internal error")
+        elif response.status_code == 400:
+            raise HTTPException(status_code=400, detail="Bad request")
+        elif response.status_code == 409:
+            raise HTTPException(status_code=409, detail="User already exists")
+        elif response.status_code == 201:
+            user = UserUtils.from_bytes(response.content)
+            UserIndex.put(user)
+            return user
+
+        raise HTTPException(status_code=502, detail="Unexpected response of the datastore")
+
+    async def update(self, user : User) -> User:
+        """Put a user
+
+        Args:
+            user (User): user to put
+
+        Raises:
+            HTTPException: 500 Internal error
+            HTTPException: 400 Bad request
+            HTTPException: 404 User not found
+            HTTPException: 502 Unexpected response of the datastore
+
+        Returns:
+            User: user
+        """
+        response = await DBClient.put(self.endpoint + f"/{user.id}", content=UserUtils.to_bytes(user), headers=self.HEADERS)
+
+        if response.status_code == 500:
+            raise HTTPException(status_code=500, detail="Internal error")
+        elif response.status_code == 400:
+            raise HTTPException(status_code=400, detail="Bad request")
+        elif response.status_code == 404:
+            raise HTTPException(status_code=404, detail="User not found")
+        elif response.status_code == 200:
+            UserIndex.put(user)
+            return user
+
+        raise HTTPException(status_code=502, detail="Unexpected response of the datastore")
+
+    async def delete(self, id : int) -> None:
+        """Delete a user
+
+        Args:
+            id (int): id of the user
+
+        Raises:
+            HTTPException: 500 Internal error
+            HTTPException: 400 Bad request
+            HTTPException: 404 User not found
+            HTTPException: 502 Unexpected response of the datastore
+        """
+        response = await DBClient.delete(self.endpoint + f"/{id}")
+
+        if response.status_code == 500:
+            raise HTTPException(status_code=500, detail="Internal error")
+        elif response.status_code == 400:
+            raise HTTPException(status_code=400, detail="Bad request")
+        elif response.status_code == 404:
+            raise HTTPException(status_code=404, detail="User not found")
+        elif response.status_code in (200, 204):
+            UserIndex.remove(id)
+            return
+
+        raise HTTPException(status_code=502, detail="Unexpected response of the datastore")
+
+    async def reload(self) -> list[User]:
+        """Reload the identity index, joining the reload already in flight
+
+        Returns:
+            list[User]: users
+        """
+        return await RestRepository.RELOADS.do("all", self.all)
+
+    async def lookup(self, find) -> Optional[User]:
+        """Resolve a user through the identity index
+
+        The index is loaded with a full download when it is older than
+        USER_INDEX_TTL_SECONDS, and reloaded once on a miss when it is older
+        than USER_INDEX_MIN_REFRESH_SECONDS.
+
+        Args:
+            find (Callable[[], Optional[User]]): lookup on the index
+
+        Returns:
+            Optional[User]: user if found
+        """
+        if not UserIndex.isFresh():
+            await self.reload()
+            return find()
+
+        user = find()
+
+        if user is None and UserIndex.canRefresh():
+            await self.reload()
+            user = find()
+
+        return user
+
+    async def findByEmail(self, email : str) -> Optional[User]:
+        return await self.lookup(lambda: UserIndex.getByEmail(email))
+
+    async def findByUserName(self, userName : str) -> Optional[User]:
+        return await self.lookup(lambda: UserIndex.getByUserName(userName))
+
+    async def snapshot(self) -> list[User]:
+        """Get every user, from the identity index while it is fresh
+
+        Returns:
+            list[User]: users
+        """
+        if UserIndex.isFresh():
+            return list(UserIndex.BY_ID.values())
+        return await self.reload()
+
+
+class SQLiteRepository(SQLiteStore, Repository):
+    """Class to store the users in an embedded SQLite database
+
+    Each thread of the sqlite backend of the Executor keeps its own connection;
+    the database runs in WAL mode so reads do not wait for writes.
+    """
+
+    BACKEND = "sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            email TEXT NOT NULL,
+            userName TEXT NOT NULL,
+            documentID INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_email ON users (email);
+        CREATE INDEX IF NOT EXISTS users_userName ON users (userName);
+        CREATE INDEX IF NOT EXISTS users_documentID ON users (documentID);
+    """
+    # Columns computed from the JSON document to filter without decoding it
+    GENERATED = {
+        "state": "INTEGER GENERATED ALWAYS AS (json_extract(data, '$.state')) VIRTUAL",
+        "debt": "REAL GENERATED ALWAYS AS (json_extract(data, '$.debt')) VIRTUAL",
+        "debtMaturityDate": "TEXT GENERATED ALWAYS AS (datetime(json_extract(data, '$.debtMaturityDate'))) VIRTUAL"
+    }
+
+    def __init__(self, path : str = None):
+        super().__init__(path or os.getenv("USER_SQLITE_PATH", "./data/users.sqlite3"))
+        self.migrate()
+
+    def migrate(self) -> None:
+        """Create the table, the generated columns and their indexes
+        """
+        connection = self.connection()
+        connection.executescript(SQLiteRepository.SCHEMA)
+        columns = {row[1] for row in connection.execute("PRAGMA table_xinfo(users)")}
+
+        for name, definition in SQLiteRepository.GENERATED.items():
+            if name not in columns:
+                connection.execute(f"ALTER TABLE users ADD COLUMN {name} {definition}")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS users_{name} ON users ({name})")
+
+    def row(user : User) -> tuple:
+        return (user.id, user.email, user.userName, user.documentID, user.model_dump_json())
+
+    def query(self, sql : str, parameters : tuple = ()) -> list[User]:
+        rows = self.connection().execute(sql, parameters).fetchall()
+        return [User.model_validate_json(data) for (data,) in rows]
+
+    def first(self, sql : str, parameters : tuple = ()) -> Optional[User]:
+        users = self.query(sql + " LIMIT 1", parameters)
+        return users[0] if users else None
+
+    def write(self, sql : str, parameters : tuple = ()) -> int:
+        return self.connection().execute(sql, parameters).rowcount
+
+    def replace(self, users : list[User]) -> None:
+        """Replace every user in one transaction
+
+        Args:
+            users (list[User]): users to store
+        """
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute("DELETE FROM users")
+            connection.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)", [SQLiteRepository.row(user) for user in users])
+
+    async def run(self, function, *args):
+        return await Executor.run(SQLiteRepository.BACKEND, function, *args)
+
+    async def all(self) -> list[User]:
+        return await self.run(self.query, "SELECT data FROM users ORDER BY id")
+
+    async def get(self, id : int) -> User:
+        """Get a user by id
+
+        Args:
+            id (int): id of the user
+
+        Raises:
+            HTTPException: 404 User not found
+
+        Returns:
+            User: user
+        """
+        user = await self.run(self.first, "SELECT data FROM users WHERE id = ?", (id,))
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return user
+
+    async def create(self, user : User) -> User:
+        """Insert a user
+
+        Args:
+            user (User): user to insert
+
+        Raises:
+            HTTPException: 409 User already exists
+
+        Returns:
+            User: user
+        """
+        try:
+            await self.run(self.write, "INSERT INTO users VALUES (?, ?, ?, ?, ?)", SQLiteRepository.row(user))
+        except sqlite3.IntegrityError:
+            raise HTTPException(status_code=409, detail="User already exists")
+        return user
+
+    async def update(self, user : User) -> User:
+        """Update a user
+
+        Args:
+            user (User): user to update
+
+        Raises:
+            HTTPException: 404 User not found
+
+        Returns:
+            User: user
+        """
+        id, email, userName, documentID, data = SQLiteRepository.row(user)
+        count = await self.run(self.write, "UPDATE users SET email = ?, userName = ?, documentID = ?, data = ? WHERE id = ?",
+                               (email, userName, documentID, data, id))
+        if count == 0:
+            raise HTTPException(status_code=404, detail="User not found")
+        return user
+
+    async def delete(self, id : int) -> None:
+        """Delete a user
+
+        Args:
+            id (int): id of the user
+
+        Raises:
+            HTTPException: 404 User not found
+        """
+        count = await self.run(self.write, "DELETE FROM users WHERE id = ?", (id,))
+        if count == 0:
+            raise HTTPException(status_code=404, detail="User not found")
+
+    async def save(self, user : User) -> None:
+        await self.run(self.write, "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)", SQLiteRepository.row(user))
+
+    async def discard(self, id : int) -> None:
+        await self.run(self.write, "DELETE FROM users WHERE id = ?", (id,))
+
+    def select(self, query : UserQuery, fields : list[str]) -> tuple[list[str], Optional[int]]:
+        """Get a page of users, filtering and projecting in SQLite
+
+        Args:
+            query (UserQuery): filters and page
+            fields (list[str]): fields to return
+
+        Returns:
+            tuple[list[str], Optional[int]]: a JSON object by user, and the cursor of the next page if any
+        """
+        conditions, parameters = [], []
+        filters = [
+            ("id > ?", query.cursor),
+            ("state = ?", None if query.state is None else int(query.state)),
+            ("debt >= ?", query.minDebt),
+            ("debt <= ?", query.maxDebt),
+            ("debtMaturityDate >= ?", None if query.maturityFrom is None else f"{UserQuery.utc(query.maturityFrom):%Y-%m-%d %H:%M:%S}"),
+            ("debtMaturityDate <= ?", None if query.maturityTo is None else f"{UserQuery.utc(query.maturityTo):%Y-%m-%d %H:%M:%S}")
+        ]
+        for condition, value in filters:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        projection = ", ".join(f"'{field}', data -> '$.{field}'" for field in fields)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection().execute(
+            f"SELECT id, json_object({projection}) FROM users {where} ORDER BY id LIMIT ? OFFSET ?",
+            (*parameters, query.limit + 1, query.offset)
+        ).fetchall()
+
+        page = rows[:query.limit]
+        return [line for _, line in page], page[-1][0] if len(rows) > query.limit else None
+
+    async def search(self, query : UserQuery, fields : list[str]) -> tuple[list[str], Optional[int]]:
+        return await self.run(self.select, query, fields)
+
+    async def findByEmail(self, email : str) -> Optional[User]:
+        return await self.run(self.first, "SELECT data FROM users WHERE email = ? ORDER BY id", (email,))
+
+    async def findByUserName(self, userName : str) -> Optional[User]:
+        return await self.run(self.first, "SELECT data FROM users WHERE userName = ? ORDER BY id", (userName,))
+
+
+class CachedRepository(Repository):
+    """Class to read the users through a local copy of a remote repository
+
+    Writes go to the remote repository first and then to the local copy; reads
+    are answered by the local copy and fall back to the remote one on a miss.
+    The whole copy is reloaded when older than USER_INDEX_TTL_SECONDS.
+    """
+
+    # Concurrent reads on a stale copy share one full download
+    RELOADS = SingleFlight("userCopy")
+
+    def __init__(self, remote : RestRepository, local : SQLiteRepository):
+        self.remote = remote
+        self.local = local
+        self.loadedAt = None
+
+    async def all(self) -> list[User]:
+        users = await self.remote.all()
+        await self.local.run(self.local.replace, users)
+        self.loadedAt = monotonic()
+        return users
+
+    async def refresh(self) -> None:
+        if self.loadedAt is None or monotonic() - self.loadedAt >= UserIndex.TTL_SECONDS:
+            await CachedRepository.RELOADS.do("all", self.all)
+
+    async def get(self, id : int) -> User:
+        await self.refresh()
+        try:
+            return await self.local.get(id)
+        except HTTPException as e:
+            if e.status_code != 404:
+                raise
+        user = await self.remote.get(id)
+        await self.local.save(user)
+        return user
+
+    async def create(self, user : User) -> User:
+        user = await self.remote.create(user)
+        await self.local.save(user)
+        return user
+
+    async def update(self, user : User) -> User:
+        user = await self.remote.update(user)
+        await self.local.save(user)
+        return user
+
+    async def delete(self, id : int) -> None:
+        await self.remote.delete(id)
+        await self.local.discard(id)
+
+    async def findByEmail(self, email : str) -> Optional[User]:
+        await self.refresh()
+        user = await self.local.findByEmail(email)
+        if user is None:
+            user = await self.remote.findByEmail(email)
+            if user is not None:
+                await self.local.save(user)
+        return user
+
+    async def findByUserName(self, userName : str) -> Optional[User]:
+        await self.refresh()
+        user = await self.local.findByUserName(userName)
+        if user is None:
+            user = await self.remote.findByUserName(userName)
+            if user is not None:
+                await self.local.save(user)
+        return user
+
+    async def search(self, query : UserQuery, fields : list[str]) -> tuple[list[str], Optional[int]]:
+        await self.refresh()
+        return await self.local.search(query, fields)
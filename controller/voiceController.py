@@ -0,0 +1,103 @@
+"""Module to answer a voice message in a single turn
+
+    The turn chains the transcription, the answer of the chat bot and the
+    synthesis on the server, overlapping them: the financial profile is
+    fetched while the audio is transcribed, and each sentence of the answer is
+    synthesized as soon as the model completes it.
+"""
+
+from fastapi import HTTPException
+
+import asyncio
+import os
+import re
+from datetime import datetime
+from random import randint
+from typing import Iterator
+from dotenv import load_dotenv
+
+from controller import AudioController, ChatBotController
+from controller.profileCache import ProfileCache
+from model import Audio, Message, MessageBot, VoiceTurn
+
+
+load_dotenv()
+
+
+class Controller:
+
+    MIN_SENTENCE_CHARS = int(os.getenv("VOICE_MIN_SENTENCE_CHARS", 40))
+    SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+    def sentences(buffer : str) -> Iterator[str]:
+        """Split the completed sentences of a partial answer
+
+        Short sentences are joined with the next one so each synthesis carries
+        at least VOICE_MIN_SENTENCE_CHARS characters.
+
+        Args:
+            buffer (str): answer received so far
+
+        Yields:
+            str: each completed sentence, the incomplete rest is the last item
+        """
+        pending = ""
+        parts = Controller.SENTENCE_END.split(buffer)
+
+        for part in parts[:-1]:
+            pending = f"{pending} {part.strip()}".strip()
+            if len(pending) >= Controller.MIN_SENTENCE_CHARS:
+                yield pending
+                pending = ""
+
+        yield f"{pending} {parts[-1]}".strip() if pending else parts[-1]
+
+    async def turn(audio : Audio) -> VoiceTurn:
+        """Transcribe a voice message, answer it and synthesize the answer
+
+        Args:
+            audio (Audio): voice message of the client
+
+        Raises:
+            HTTPException: 400 if nothing was understood in the audio
+            HTTPException: 404 if the user does not exist
+
+        Returns:
+            VoiceTurn: message, answer and the audios of the answer in order
+        """
+        profile = asyncio.create_task(ProfileCache.get(audio.userId))
+        syntheses : list[asyncio.Task] = []
+
+        def synthesize(text : str) -> None:
+            message = Message(id=randint(1,99999), createdAt=datetime.now(), userId=audio.userId, message=text)
+            syntheses.append(asyncio.create_task(AudioController.getAudio(message)))
+
+        try:
+            message = await AudioController.getMessage(audio)
+            # Waiting here surfaces a missing user before the model is called
+            await profile
+
+            if not message.message.strip():
+                raise HTTPException(status_code=400, detail="Empty transcript")
+
+            buffer = ""
+            response = None
+
+            async for chunk in ChatBotController.streamResponse(message):
+                if isinstance(chunk, MessageBot):
+                    response = chunk
+                    continue
+                *completed, buffer = Controller.sentences(buffer + chunk)
+                for sentence in completed:
+                    synthesize(sentence)
+
+            if buffer.strip():
+                synthesize(buffer.strip())
+
+            audios = list(await asyncio.gather(*syntheses))
+        except BaseException:
+            for task in [profile, *syntheses]:
+                task.cancel()
+            raise
+
+        return VoiceTurn(userId=audio.userId, createdAt=datetime.now(), message=message, response=response, audios=audios)
@@ -1,18 +1,110 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 
-from routers import userRouter, usersRouter, authRouter, audioRouter, chatRouter
+import asyncio
+from contextlib import asynccontextmanager, suppress
 
-app = FastAPI()
+from routers import userRouter, usersRouter, authRouter, audioRouter, chatRouter, voiceRouter
+from controller import CampaignController, TranscriptionController
+from controller.dbClient import DBClient
+from controller.executor import Executor
+from controller.googleClients import GoogleClients
+from controller.audioCache import AudioCache
+from controller.audioStore import AudioStore
+from controller.conversationLog import ConversationLog
+from controller.profileCache import ProfileCache
+from controller.portfolioAnalytics import PortfolioAnalytics
+from controller.responseCache import ResponseCache
+from controller.admission import Admission, AdmissionMiddleware
+from controller.metrics import Metrics, MetricsMiddleware
+from controller.singleFlight import SingleFlight
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The clients and the analytics are loaded in the background so the worker starts serving at once
+    tasks = [asyncio.create_task(AudioStore.collect())]
+    if GoogleClients.WARMUP:
+        tasks.append(asyncio.create_task(GoogleClients.warmup()))
+    if PortfolioAnalytics.PRELOAD:
+        tasks.append(asyncio.create_task(PortfolioAnalytics.preload()))
+    await CampaignController.resume()
+    await TranscriptionController.start()
+    app.state.serving = True
+    yield
+    app.state.serving = False
+    await CampaignController.stop()
+    await TranscriptionController.stop()
+    await ConversationLog.stop()
+    await PortfolioAnalytics.stop()
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await DBClient.close()
+    GoogleClients.close()
+    Executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+# The last middleware added runs first, so the shed requests are also measured
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(userRouter)
 app.include_router(usersRouter)
 app.include_router(authRouter)
 app.include_router(audioRouter)
 app.include_router(chatRouter)
+app.include_router(voiceRouter)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
 @app.get("/")
 async def root():
-    return {"status": "Ok"}
\ No newline at end of file
+    return {"status": "Ok"}
+
+
+def collect() -> list[tuple]:
+    caches = {"audio": AudioCache.stats(), "profile": ProfileCache.stats(), "response": ResponseCache.stats()}
+    executors = Executor.stats()
+    flights = SingleFlight.all()
+    gates = Admission.stats()
+    conversations = ConversationLog.stats()
+    return [
+        ("cache_hits_total", "counter", "Hits of the caches", ("cache",), {(name,): stats["hits"] for name, stats in caches.items()}),
+        ("cache_misses_total", "counter", "Misses of the caches", ("cache",), {(name,): stats["misses"] for name, stats in caches.items()}),
+        ("cache_hit_ratio", "gauge", "Hits over lookups of the caches", ("cache",),
+         {(name,): stats["hits"] / max(stats["hits"] + stats["misses"], 1) for name, stats in caches.items()}),
+        ("cache_items", "gauge", "Entries of the caches", ("cache",), {(name,): stats["items"] for name, stats in caches.items()}),
+        ("executor_queued", "gauge", "Blocking calls waiting for a worker", ("backend",), {(name,): stats["queued"] for name, stats in executors.items()}),
+        ("executor_running", "gauge", "Blocking calls running", ("backend",), {(name,): stats["running"] for name, stats in executors.items()}),
+        ("executor_rejected_total", "counter", "Blocking calls rejected by a full queue", ("backend",), {(name,): stats["rejected"] for name, stats in executors.items()}),
+        ("admission_active", "gauge", "Requests in progress by class of routes", ("class",), {(name,): stats["active"] for name, stats in gates.items()}),
+        ("admission_queued", "gauge", "Requests waiting for a slot by class of routes", ("class",), {(name,): stats["queued"] for name, stats in gates.items()}),
+        ("conversation_turns_buffered", "gauge", "Chat bot turns waiting to be written to the conversation log", (), {(): conversations["buffered"]}),
+        ("conversation_turns_written_total", "counter", "Chat bot turns written to the conversation log", (), {(): conversations["written"]}),
+        ("conversation_turns_dropped_total", "counter", "Chat bot turns lost by a full buffer of the conversation log", (), {(): conversations["dropped"]}),
+        ("singleflight_calls_total", "counter", "Upstream calls started by the coalescing groups", ("group",), {(name,): stats["started"] for name, stats in flights.items()}),
+        ("singleflight_shared_total", "counter", "Callers served by a call of the same key already in flight", ("group",), {(name,): stats["shared"] for name, stats in flights.items()})
+    ]
+
+
+Metrics.collect(collect)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(Metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/ready")
+async def ready():
+    ready = getattr(app.state, "serving", False) and GoogleClients.ready()
+    return JSONResponse({"ready": ready, **GoogleClients.stats()}, status_code=200 if ready else 503)
+
+
+@app.get("/status")
+async def status():
+    return {"executors": Executor.stats(), "audioCache": AudioCache.stats(), "audioStore": AudioStore.stats(), "profileCache": ProfileCache.stats(), "responseCache": ResponseCache.stats(), "googleClients": GoogleClients.stats(), "analytics": PortfolioAnalytics.stats(), "singleFlight": SingleFlight.all(), "admission": Admission.stats(), "transcriptions": await TranscriptionController.stats(), "conversations": ConversationLog.stats()}
@@ -1,2 +1,2 @@
-from model.models import User, Audio, Message, MessageBot
-from model.utils import UserUtils
\ No newline at end of file
+from model.models import User, Audio, Message, MessageBot, UserQuery, AnalyticsQuery, FinancialProfile, VoiceTurn, Campaign, CampaignItem, CampaignItemResult, CampaignJob, TranscriptionRequest, TranscriptionJob, HistoryQuery, ConversationTurn
+from model.utils import UserUtils, PaymentUtils
\ No newline at end of file
@@ -2,8 +2,21 @@
 """
 
 import datetime
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, BeforeValidator, Field, ValidationInfo
+from typing import Annotated, Any, Literal, Optional
+
+def isoDatetime(value : Any, info : ValidationInfo) -> Any:
+    """Take only ISO 8601 strings for the datetimes of json documents, numbers
+    are not read as unix timestamps
+
+    Raises:
+        ValueError: If the value of a json document is not a string
+    """
+    if info.mode == "json" and not isinstance(value, str):
+        raise ValueError("datetime must be an ISO 8601 string")
+    return value
+
+IsoDatetime = Annotated[datetime.datetime, BeforeValidator(isoDatetime)]
 
 # Data class
 
@@ -21,12 +34,12 @@ class User(UserP):
     """Class to represent a user in the system
     """
     
-    createdAt : datetime.datetime
-    birthdate : datetime.datetime
+    createdAt : IsoDatetime
+    birthdate : IsoDatetime
     documentID : int
     password : str
     debt : float
-    debtMaturityDate : datetime.datetime
+    debtMaturityDate : IsoDatetime
     state : bool
     paymentHistory : list
     
@@ -63,6 +76,7 @@ class Audio(BaseModel):
     userId : int
     message : str
     audioPath : str
+    url : Optional[str] = Field(default=None, description="Path to download the audio, with Range support")
 
     class Config:
         """Config class to allow the use of datetime objects
@@ -130,4 +144,189 @@ class MessageBot(BaseModel):
                 "userId ": 6,
                 "response": "Hello, how are you? I am a bot"
             }
-        }
\ No newline at end of file
+        }
+
+class UserQuery(BaseModel):
+    """Class to represent a page of users with its filters and fields
+    """
+
+    cursor : Optional[int] = Field(default=None, description="Return the users with an id greater than the cursor")
+    offset : int = Field(default=0, ge=0)
+    limit : int = Field(default=100, ge=1, le=1000)
+    state : Optional[bool] = None
+    minDebt : Optional[float] = None
+    maxDebt : Optional[float] = None
+    maturityFrom : Optional[datetime.datetime] = None
+    maturityTo : Optional[datetime.datetime] = None
+    fields : Optional[str] = Field(default=None, description="Comma separated fields to return")
+
+    def utc(value : datetime.datetime) -> datetime.datetime:
+        """Convert a datetime to a naive UTC datetime
+
+        Args:
+            value (datetime.datetime): naive (taken as UTC) or aware datetime
+
+        Returns:
+            datetime.datetime: naive UTC datetime
+        """
+        if value.tzinfo is None:
+            return value
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    def matches(self, user : User) -> bool:
+        """Check if a user passes the filters
+
+        Args:
+            user (User): user to check
+
+        Returns:
+            bool: True if the user passes every filter
+        """
+        maturity = UserQuery.utc(user.debtMaturityDate)
+        return ((self.cursor is None or user.id > self.cursor)
+            and (self.state is None or user.state == self.state)
+            and (self.minDebt is None or user.debt >= self.minDebt)
+            and (self.maxDebt is None or user.debt <= self.maxDebt)
+            and (self.maturityFrom is None or maturity >= UserQuery.utc(self.maturityFrom))
+            and (self.maturityTo is None or maturity <= UserQuery.utc(self.maturityTo)))
+
+class AnalyticsQuery(BaseModel):
+    """Class to represent a page of the risk ranking of the users
+    """
+
+    offset : int = Field(default=0, ge=0)
+    limit : int = Field(default=100, ge=1, le=100000)
+    order : Literal["desc", "asc"] = Field(default="desc", description="Order by risk score")
+    minScore : Optional[float] = Field(default=None, ge=0, le=1)
+    delinquent : Optional[bool] = None
+    state : Optional[bool] = None
+    layout : Literal["rows", "columns"] = Field(default="rows", description="columns returns a list by metric, faster for large pages")
+
+class FinancialProfile(BaseModel):
+    """Class to represent the compact financial context of a client for the chat bot
+    """
+
+    userId : int
+    name : str
+    state : bool
+    debt : float
+    debtMaturityDate : datetime.date
+    daysToMaturity : int
+    payments : int
+    totalPaid : float
+    averagePayment : Optional[float] = None
+    lastPaymentAmount : Optional[float] = None
+    lastPaymentDate : Optional[datetime.date] = None
+    latePayments : int = 0
+    arrearsStreak : int = Field(default=0, description="Consecutive late payments up to the last one")
+    longestArrearsStreak : int = 0
+    asOf : datetime.date
+
+class VoiceTurn(BaseModel):
+    """Class to represent a voice turn: the transcribed message, the answer and its audio by sentence
+    """
+
+    userId : int
+    createdAt : datetime.datetime
+    message : Message
+    response : MessageBot
+    audios : list[Audio]
+
+class CampaignItem(BaseModel):
+    """Class to represent a reminder of a campaign
+    """
+
+    userId : int
+    template : str = Field(description="Text with {field} placeholders of the financial profile of the user")
+
+class Campaign(BaseModel):
+    """Class to represent the reminders of a campaign to pre-render
+    """
+
+    items : list[CampaignItem] = Field(min_length=1, max_length=100000)
+
+    class Config:
+
+        schema_extra = {
+            "example": {
+                "items": [{"userId": 59, "template": "Hola {name}, tu deuda de {debt} vence en {daysToMaturity} días."}]
+            }
+        }
+
+class CampaignItemResult(BaseModel):
+    """Class to represent the result of a reminder of a campaign
+    """
+
+    index : int
+    userId : int
+    status : str = Field(description="pending, done or failed")
+    text : Optional[str] = None
+    audioPath : Optional[str] = None
+    url : Optional[str] = None
+    error : Optional[str] = None
+
+class CampaignJob(BaseModel):
+    """Class to represent the progress of a campaign
+    """
+
+    id : str
+    status : str = Field(description="pending, running, done or failed")
+    createdAt : datetime.datetime
+    updatedAt : datetime.datetime
+    total : int
+    pending : int
+    done : int
+    failed : int
+
+class TranscriptionRequest(BaseModel):
+    """Class to represent an audio to transcribe in the background
+    """
+
+    userId : int
+    audioPath : str
+    callbackUrl : Optional[str] = Field(default=None, pattern=r"^https?://", description="Url that receives the job by POST when it ends")
+
+    class Config:
+
+        schema_extra = {
+            "example": {
+                "userId": 93,
+                "audioPath": "./audios/93.wav",
+                "callbackUrl": "https://example.com/transcriptions"
+            }
+        }
+
+class TranscriptionJob(BaseModel):
+    """Class to represent the state of a background transcription
+    """
+
+    id : str
+    userId : int
+    status : str = Field(description="queued, running, done, failed or cancelled")
+    attempts : int
+    createdAt : datetime.datetime
+    updatedAt : datetime.datetime
+    message : Optional[Message] = Field(default=None, description="Transcript once done")
+    error : Optional[str] = None
+
+class HistoryQuery(BaseModel):
+    """Class to represent a page of the conversation of a user with the chat bot
+    """
+
+    userId : int
+    cursor : Optional[int] = Field(default=None, description="Return the turns with an id lower than the cursor")
+    limit : int = Field(default=50, ge=1, le=1000)
+    since : Optional[datetime.datetime] = None
+    until : Optional[datetime.datetime] = None
+
+class ConversationTurn(BaseModel):
+    """Class to represent a question of a user and the answer of the chat bot
+    """
+
+    id : int
+    userId : int
+    createdAt : datetime.datetime
+    messageId : int
+    message : str
+    responseId : int
+    response : str
@@ -1,60 +1,244 @@
-from model import User
+from model import User, FinancialProfile
 from fastapi import HTTPException
+from pydantic import TypeAdapter, ValidationError
 import datetime
-import json
+from functools import lru_cache
+from typing import Any, NamedTuple, Optional
 
 class UserUtils:
-    
+
+    ADAPTER = TypeAdapter(User)
+    LIST_ADAPTER = TypeAdapter(list[User])
+
     @classmethod
     def to_json(self, user : User) -> str:
         """Method to convert the object to a json string
 
         Args:
             user (User): user object
-        
+
         Raises:
             HTTPException: 500 If the user object is not valid
 
         Returns:
             str: json string
         """
-        
+
+        try:
+            json_ = user.model_dump_json()
+        except Exception:
+            raise HTTPException(status_code=500, detail=f"Internal error")
+        return json_
+
+    @classmethod
+    def to_bytes(cls, user : User) -> bytes:
+        """Method to convert the object to a json document ready to send
+
+        Args:
+            user (User): user object
+
+        Raises:
+            HTTPException: 500 If the user object is not valid
+
+        Returns:
+            bytes: json document
+        """
+
         try:
-            json_ = json.dumps(user.__dict__, default=str)
+            json_ = cls.ADAPTER.dump_json(user)
         except Exception:
             raise HTTPException(status_code=500, detail=f"Internal error")
-        #print(json_)
         return json_
-    
+
     @classmethod
     def from_json(cls, data : dict):
         """Method to create a user from a json string
 
         Args:
             data (dict): json string
-            
+
         Raises:
             HTTPException: 500 If the json string is not valid
 
         Returns:
             User: user object
         """
-        
+
         try:
-            user = User(id = data["id"], 
-                   createdAt = datetime.datetime.fromisoformat(data["createdAt"][:-1]), 
-                   name = data["name"], 
-                   userName = data["userName"],
-                   birthdate = datetime.date.fromisoformat(data["birthdate"][:10]), 
-                   documentID = data["documentID"], 
-                   email = data["email"], 
-                   phone = data["phone"], 
-                   password = data["password"],
-                   debt = data["debt"], 
-                   debtMaturityDate = datetime.date.fromisoformat(data["debtMaturityDate"][:10]), 
-                   state = data["state"], 
-                   paymentHistory = data["paymentHistory"]
-                   )
-        except Exception:
+            user = cls.ADAPTER.validate_python(data)
+        except ValidationError:
             raise HTTPException(status_code=500, detail=f"Internal error")
-        return user
\ No newline at end of file
+        return user
+
+    @classmethod
+    def from_bytes(cls, data : bytes) -> User:
+        """Method to create a user from a json document, without decoding it to python first
+
+        Args:
+            data (bytes): json document
+
+        Raises:
+            HTTPException: 500 If the json document is not valid
+
+        Returns:
+            User: user object
+        """
+
+        try:
+            user = cls.ADAPTER.validate_json(data)
+        except ValidationError:
+            raise HTTPException(status_code=500, detail=f"Internal error")
+        return user
+
+    @classmethod
+    def list_from_bytes(cls, data : bytes) -> list[User]:
+        """Method to create the users of a json array document
+
+        Args:
+            data (bytes): json array document
+
+        Raises:
+            HTTPException: 500 If the json document is not valid
+
+        Returns:
+            list[User]: user objects
+        """
+
+        try:
+            users = cls.LIST_ADAPTER.validate_json(data)
+        except ValidationError:
+            raise HTTPException(status_code=500, detail=f"Internal error")
+        return users
+
+
+class Payment(NamedTuple):
+    amount : float
+    date : Optional[datetime.date]
+    late : bool
+    due : Optional[datetime.date] = None
+
+
+class PaymentUtils:
+
+    AMOUNT_KEYS = ("amount", "value", "paid")
+    DATE_KEYS = ("date", "paymentDate", "paidAt", "createdAt")
+    DUE_KEYS = ("dueDate", "due")
+
+    @staticmethod
+    def to_date(value : Any) -> Optional[datetime.date]:
+        """Method to read a date of the datastore, in UTC if it has an offset
+
+        Args:
+            value (Any): datetime, date or ISO 8601 string
+
+        Returns:
+            Optional[datetime.date]: date, None if it can not be read
+        """
+
+        if isinstance(value, str):
+            return PaymentUtils.from_iso(value)
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(datetime.timezone.utc)
+            return value.date()
+        if isinstance(value, datetime.date):
+            return value
+        return None
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def from_iso(value : str) -> Optional[datetime.date]:
+        """Method to read an ISO 8601 date, cached as the histories repeat the same dates
+
+        Args:
+            value (str): ISO 8601 date or datetime
+
+        Returns:
+            Optional[datetime.date]: date in UTC, None if it can not be read
+        """
+
+        try:
+            return PaymentUtils.to_date(datetime.datetime.fromisoformat(value.strip().replace("Z", "+00:00")))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def first(entry : dict, keys : tuple[str, ...]) -> Any:
+        for key in keys:
+            if key in entry:
+                return entry[key]
+        return None
+
+    @classmethod
+    def parse(cls, entry : Any) -> Optional[Payment]:
+        """Method to read an entry of the payment history, ignoring the malformed ones
+
+        Args:
+            entry (Any): entry with an amount and optionally date, dueDate and late
+
+        Returns:
+            Optional[Payment]: payment, None if the entry has no amount
+        """
+
+        if not isinstance(entry, dict):
+            return None
+
+        amount = cls.first(entry, cls.AMOUNT_KEYS)
+        if isinstance(amount, bool):
+            return None
+        try:
+            amount = float(amount)
+        except (TypeError, ValueError):
+            return None
+
+        date = cls.to_date(cls.first(entry, cls.DATE_KEYS))
+        due = cls.to_date(cls.first(entry, cls.DUE_KEYS))
+        late = entry.get("late")
+        if not isinstance(late, bool):
+            late = date is not None and due is not None and date > due
+
+        return Payment(amount, date, late, due)
+
+    @classmethod
+    def profile(cls, user : User, today : Optional[datetime.date] = None) -> FinancialProfile:
+        """Method to aggregate the debt and payment history of a user
+
+        Args:
+            user (User): user object
+            today (Optional[datetime.date]): date of the profile, today in UTC by default
+
+        Returns:
+            FinancialProfile: compact financial context
+        """
+
+        today = today or datetime.datetime.now(datetime.timezone.utc).date()
+        payments = [payment for payment in map(cls.parse, user.paymentHistory) if payment is not None]
+
+        # The history is appended in order, sort it only when every payment is dated
+        if all(payment.date is not None for payment in payments):
+            payments.sort(key=lambda payment: payment.date)
+
+        streak = longest = 0
+        for payment in payments:
+            streak = streak + 1 if payment.late else 0
+            longest = max(longest, streak)
+
+        total = sum(payment.amount for payment in payments)
+        last = payments[-1] if payments else None
+        maturity = cls.to_date(user.debtMaturityDate)
+
+        return FinancialProfile(userId = user.id,
+                                name = user.name,
+                                state = user.state,
+                                debt = user.debt,
+                                debtMaturityDate = maturity,
+                                daysToMaturity = (maturity - today).days,
+                                payments = len(payments),
+                                totalPaid = round(total, 2),
+                                averagePayment = round(total / len(payments), 2) if payments else None,
+                                lastPaymentAmount = last.amount if last else None,
+                                lastPaymentDate = last.date if last else None,
+                                latePayments = sum(payment.late for payment in payments),
+                                arrearsStreak = streak,
+                                longestArrearsStreak = longest,
+                                asOf = today)
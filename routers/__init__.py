@@ -2,4 +2,5 @@ from routers.user import router as userRouter
 from routers.users import router as usersRouter
 from routers.audio import router as audioRouter
 from routers.auth import router as authRouter
-from routers.chatbot import router as chatRouter
\ No newline at end of file
+from routers.chatbot import router as chatRouter
+from routers.voice import router as voiceRouter
\ No newline at end of file
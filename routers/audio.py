@@ -1,14 +1,125 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, StreamingResponse
 
-from model import Message, Audio
-from controller import AudioController
+import json
+import subprocess
+from typing import Literal, Optional
+
+from model import Message, Audio, Campaign, CampaignJob, CampaignItemResult, TranscriptionRequest, TranscriptionJob
+from controller import AudioController, CampaignController, TranscriptionController
+from controller.admission import Admission, Rejected
+from controller.audioStore import AudioStore
+from controller.executor import Executor
 
 router = APIRouter(prefix="/audio", tags=["audio"])
 
+class DuplexStreamingResponse(StreamingResponse):
+    """Streaming response that leaves the request body to the handler
+
+    StreamingResponse listens for the disconnect of the client while it
+    streams, which consumes the body that the handler is still reading.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
 @router.post("/")
 async def getAudio(message: Message):
-    return AudioController.getAudio(message)
+    return await AudioController.getAudio(message)
+
+@router.get("/files/{name}")
+async def getFile(name: str, format: Optional[Literal["mp3", "opus"]] = None):
+    # Every audio, synthesized or not, is named by its content id in the audio store
+    path = AudioStore.find(name)
+
+    if path is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+
+    if format is not None:
+        if not AudioStore.transcodable():
+            raise HTTPException(status_code=406, detail="Format not available")
+        try:
+            path = await Executor.run("transcode", AudioStore.transcode, path, format)
+        except subprocess.CalledProcessError:
+            raise HTTPException(status_code=500, detail="Transcoding failed")
+
+    # The content never changes for a name, FileResponse answers the Range requests
+    return FileResponse(path, media_type=AudioStore.contentType(path), headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@router.post("/campaigns", response_model = CampaignJob, status_code=202)
+async def createCampaign(campaign: Campaign):
+    return await CampaignController.create(campaign)
+
+@router.get("/campaigns/{id}", response_model = CampaignJob)
+async def getCampaign(id: str):
+    return await CampaignController.getJob(id)
+
+@router.get("/campaigns/{id}/items", response_model = list[CampaignItemResult])
+async def getCampaignItems(id: str, offset: int = Query(default=0, ge=0), limit: int = Query(default=100, ge=1, le=1000)):
+    return await CampaignController.getItems(id, offset, limit)
 
 @router.post("/transcribe")
 async def getMessage(audio: Audio):
-    return AudioController.getMessage(audio)
\ No newline at end of file
+    return await AudioController.getMessage(audio)
+
+@router.post("/jobs", response_model = TranscriptionJob, status_code=202)
+async def createJob(request: TranscriptionRequest):
+    return await TranscriptionController.submit(request)
+
+@router.get("/jobs/{id}", response_model = TranscriptionJob)
+async def getJob(id: str):
+    return await TranscriptionController.getJob(id)
+
+@router.delete("/jobs/{id}", response_model = TranscriptionJob)
+async def cancelJob(id: str):
+    return await TranscriptionController.cancel(id)
+
+@router.post("/transcribe/stream")
+async def streamMessage(request: Request, userId: int, sampleRate: int = AudioController.SAMPLE_RATE_HERTZ):
+    async def lines():
+        async for item in AudioController.streamMessage(request.stream(), userId, sampleRate):
+            if isinstance(item, Message):
+                yield json.dumps({"type": "done", "message": item.model_dump(mode="json")}) + "\n"
+            else:
+                yield json.dumps(item) + "\n"
+
+    return DuplexStreamingResponse(lines(), media_type="application/x-ndjson")
+
+@router.websocket("/transcribe/ws")
+async def streamMessageSocket(websocket: WebSocket, userId: int, sampleRate: int = AudioController.SAMPLE_RATE_HERTZ):
+    await websocket.accept()
+
+    async def chunks():
+        while True:
+            data = await websocket.receive()
+            if data["type"] == "websocket.disconnect" or data.get("text") == "end":
+                return
+            if data.get("bytes"):
+                yield data["bytes"]
+
+    try:
+        # The slot is taken with the first audio frame, an idle socket holds none
+        stream = chunks()
+        first = await anext(stream, None)
+        if first is None:
+            return
+
+        async def audio():
+            yield first
+            async for chunk in stream:
+                yield chunk
+
+        async with Admission.slot("speech"):
+            async for item in AudioController.streamMessage(audio(), userId, sampleRate):
+                if isinstance(item, Message):
+                    await websocket.send_json({"type": "done", "message": item.model_dump(mode="json")})
+                else:
+                    await websocket.send_json(item)
+        await websocket.close()
+    except Rejected as rejection:
+        await websocket.send_json({"type": "error", "status": rejection.status, "detail": rejection.detail})
+        await websocket.close(code=1013)
+    except WebSocketDisconnect:
+        pass
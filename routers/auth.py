@@ -10,7 +10,7 @@ router = APIRouter(prefix="/login", tags=["login"])
 
 @router.post("/")
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    return AuthController.authentication(form_data)
+    return await AuthController.authentication(form_data)
 
 
 @router.get("/users/me")
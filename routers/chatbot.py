@@ -1,12 +1,66 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+import json
+from typing import Annotated
 
 from controller import ChatBotController
-from model import Message
+from controller.admission import Admission, Rejected
+from controller.conversationLog import ConversationLog
+from model import Message, MessageBot, HistoryQuery, ConversationTurn
 
 router = APIRouter(prefix="/chatbot", tags=["chatbot"])
 
 @router.post("/talk")
 async def talk(message: Message):
-    return ChatBotController.getResponse(message)
+    return await ChatBotController.getResponse(message)
+
+@router.get("/history", response_model = list[ConversationTurn])
+async def history(query: Annotated[HistoryQuery, Query()], response: Response):
+    turns, cursor = await ConversationLog.history(query)
+    if cursor is not None:
+        response.headers["X-Next-Cursor"] = str(cursor)
+    return turns
+
+def event(name: str, data: str) -> str:
+    return f"event: {name}\ndata: {data}\n\n"
+
+@router.post("/talk/stream")
+async def talkStream(message: Message):
+    stream = ChatBotController.streamResponse(message)
+    # Wait for the first chunk so a missing user still fails with its status code
+    first = await anext(stream)
+
+    async def events():
+        chunk = first
+        while True:
+            if isinstance(chunk, MessageBot):
+                yield event("done", chunk.model_dump_json())
+                return
+            yield event("delta", json.dumps({"text": chunk}))
+            chunk = await anext(stream)
 
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
+@router.websocket("/ws")
+async def talkSocket(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        while True:
+            try:
+                message = Message.model_validate(await websocket.receive_json())
+                # A slot of the model for each message, not for the whole connection
+                async with Admission.slot("model"):
+                    async for chunk in ChatBotController.streamResponse(message):
+                        if isinstance(chunk, MessageBot):
+                            await websocket.send_json({"type": "done", "message": chunk.model_dump(mode="json")})
+                        else:
+                            await websocket.send_json({"type": "delta", "text": chunk})
+            except Rejected as rejection:
+                await websocket.send_json({"type": "error", "status": rejection.status, "detail": rejection.detail})
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+            except ValueError as e:
+                await websocket.send_json({"type": "error", "status": 422, "detail": f"{e}"})
+    except WebSocketDisconnect:
+        pass
@@ -1,8 +1,25 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from typing import Annotated
+
 from controller import UserController
+from controller.portfolioAnalytics import PortfolioAnalytics
+from model import UserQuery, AnalyticsQuery
 
 router = APIRouter(prefix="/users", tags=["Users"])
 
+async def ndjson(lines: list[str], batch: int = 256):
+    for start in range(0, len(lines), batch):
+        yield "".join(f"{line}\n" for line in lines[start:start + batch])
+
 @router.get("/")
-async def getUsers():
-    return UserController.getUsers()
\ No newline at end of file
+async def getUsers(query: Annotated[UserQuery, Query()]):
+    lines, cursor = await UserController.searchUsers(query)
+    headers = {} if cursor is None else {"X-Next-Cursor": str(cursor)}
+    return StreamingResponse(ndjson(lines), media_type="application/x-ndjson", headers=headers)
+
+@router.get("/analytics")
+async def getAnalytics(query: Annotated[AnalyticsQuery, Query()]):
+    # Already JSON types, returned as is to skip the encoding of every item
+    return JSONResponse(await PortfolioAnalytics.ranking(query))
@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+
+from model import Audio, VoiceTurn
+from controller import VoiceController
+
+router = APIRouter(prefix="/voice", tags=["voice"])
+
+@router.post("/turn", response_model = VoiceTurn)
+async def turn(audio: Audio):
+    return await VoiceController.turn(audio)
@@ -0,0 +1,15 @@
+import os
+import sys
+
+# Settings read when the controllers are imported
+for name, value in {
+    "SECRET": "test",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "BCRYPT_ROUNDS": "4",
+    "DB_ENDPOINT": "http://127.0.0.1:8765",
+    "DB_USER_ENDPOINT": "/users"
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
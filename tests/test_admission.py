@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.testclient import TestClient
+
+from controller import admission
+from controller.admission import Admission, AdmissionMiddleware, Gate, Rejected
+
+
+async def settle():
+    # A waiter resumes a few loop iterations after its future is set
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def gate(concurrency=1, maxQueue=2, deadline=1.0, rate=0.0, burst=1) -> Gate:
+    return Gate("test", concurrency, maxQueue, deadline, rate, burst)
+
+
+def test_queued_requests_get_the_slot_in_order():
+    async def scenario():
+        g = gate()
+        await g.acquire()
+        order = []
+
+        async def wait(name):
+            await g.acquire()
+            order.append(name)
+
+        waiters = [asyncio.create_task(wait(name)) for name in ("first", "second")]
+        await asyncio.sleep(0)
+        assert g.stats()["queued"] == 2
+
+        g.release()
+        await settle()
+        assert order == ["first"]
+        assert g.active == 1
+
+        g.release()
+        await asyncio.gather(*waiters)
+        assert order == ["first", "second"]
+
+        g.release()
+        assert g.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_is_shed():
+    async def scenario():
+        g = gate(maxQueue=1)
+        await g.acquire()
+        waiter = asyncio.create_task(g.acquire())
+        await asyncio.sleep(0)
+
+        with pytest.raises(Rejected) as error:
+            await g.acquire()
+        assert (error.value.status, error.value.reason) == (503, "queue")
+
+        g.release()
+        await waiter
+        g.release()
+        assert g.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_deadline_leaves_the_queue():
+    async def scenario():
+        g = gate(deadline=0.05)
+        await g.acquire()
+
+        with pytest.raises(Rejected) as error:
+            await g.acquire()
+        assert (error.value.status, error.value.reason) == (503, "deadline")
+        assert g.stats()["queued"] == 0
+
+        g.release()
+        assert g.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_keep_a_slot():
+    async def scenario():
+        g = gate()
+        await g.acquire()
+        waiter = asyncio.create_task(g.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        g.release()
+        assert g.active == 0
+        assert g.stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_bucket_refills_at_the_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(admission, "monotonic", lambda: now[0])
+    g = gate(rate=2.0, burst=2)
+
+    g.take("a")
+    g.take("a")
+    with pytest.raises(Rejected) as error:
+        g.take("a")
+    assert (error.value.status, error.value.reason) == (429, "rate")
+    assert error.value.retryAfter == pytest.approx(0.5)
+
+    # Other users have their own bucket
+    g.take("b")
+
+    now[0] += 0.5
+    g.take("a")
+    with pytest.raises(Rejected):
+        g.take("a")
+
+
+def test_idle_websockets_hold_no_slot(monkeypatch):
+    monkeypatch.setattr(Admission, "ENABLED", True)
+    monkeypatch.setattr(Admission, "GATES", {"model": gate(concurrency=1, maxQueue=0, deadline=0.1, rate=0.0)})
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware)
+
+    @app.websocket("/chatbot/ws")
+    async def socket(websocket: WebSocket):
+        await websocket.accept()
+        try:
+            while True:
+                await websocket.receive_text()
+                async with Admission.slot("model"):
+                    await websocket.send_text("ok")
+        except WebSocketDisconnect:
+            pass
+
+    @app.post("/chatbot/talk")
+    async def talk():
+        return {"ok": True}
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/chatbot/ws") as first, client.websocket_connect("/chatbot/ws") as second:
+            assert Admission.GATES["model"].active == 0
+            assert client.post("/chatbot/talk").status_code == 200
+            first.send_text("hola")
+            assert first.receive_text() == "ok"
+            second.send_text("hola")
+            assert second.receive_text() == "ok"
+        assert Admission.GATES["model"].active == 0
@@ -0,0 +1,49 @@
+import os
+import time
+
+import pytest
+
+from controller.audioCache import AudioCache
+from controller.audioStore import AudioStore
+
+
+WAV = b"RIFF\x24\x00\x00\x00WAVEfmt " + bytes(32)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(AudioStore, "DIRECTORY", str(tmp_path / "store"))
+    monkeypatch.setattr(AudioCache, "DIRECTORY", str(tmp_path / "cache"))
+    monkeypatch.setattr(AudioCache, "MAX_ITEMS", 2)
+    monkeypatch.setattr(AudioCache, "INDEX", None)
+    yield AudioCache
+
+
+def test_cached_audios_live_in_the_audio_store(cache):
+    key = cache.key("hola", "voice", "es-US", 1, "LINEAR16")
+    id, path = cache.store(key, WAV)
+
+    assert path == AudioStore.find(id)
+    assert cache.lookup(key) == (id, path)
+
+    cache.INDEX = None
+    assert cache.lookup(key) == (id, path)
+
+
+def test_an_audio_removed_by_the_store_is_a_miss(cache):
+    key = cache.key("hola", "voice", "es-US", 1, "LINEAR16")
+    cache.store(key, WAV)
+
+    AudioStore.gc(now=time.time() + AudioStore.MAX_AGE_SECONDS + 1)
+
+    assert cache.lookup(key) is None
+    assert not os.path.exists(cache.path(key))
+
+
+def test_the_least_recently_used_keys_are_forgotten(cache):
+    keys = [cache.key(text, "voice", "es-US", 1, "LINEAR16") for text in ("a", "b", "c")]
+    ids = [cache.store(key, WAV + text.encode())[0] for key, text in zip(keys, "abc")]
+
+    assert cache.lookup(keys[0]) is None
+    assert [cache.lookup(key)[0] for key in keys[1:]] == ids[1:]
+    assert all(AudioStore.find(id) for id in ids)
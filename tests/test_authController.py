@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+import pytest
+from cachetools import TLRUCache, TTLCache
+from jose import jwt
+from time import monotonic, time
+
+from controller import AuthController, UserController
+from controller.authController import Generations
+from model import User, UserUtils
+
+
+def user(id : int, name : str) -> User:
+    return UserUtils.from_bytes(json.dumps({
+        "id": id, "name": name, "userName": f"user{id}", "email": f"user{id}@example.com", "phone": None,
+        "createdAt": "2024-01-01T00:00:00Z", "birthdate": "1990-05-01T00:00:00Z", "documentID": id,
+        "password": "secret", "debt": 100.0, "debtMaturityDate": "2024-02-01T00:00:00Z",
+        "state": True, "paymentHistory": []
+    }).encode())
+
+
+@pytest.fixture
+def auth(monkeypatch):
+    monkeypatch.setattr(AuthController, "TOKENS", TLRUCache(maxsize=100, ttu=lambda key, entry, now: now + entry[0]["exp"] - time(), timer=monotonic))
+    monkeypatch.setattr(AuthController, "PRINCIPALS", TTLCache(maxsize=100, ttl=30, timer=monotonic))
+    monkeypatch.setattr(AuthController, "GENERATIONS", Generations(maxsize=2, ttl=60))
+    yield AuthController
+
+
+def test_a_write_stops_serving_the_cached_principal(auth, monkeypatch):
+    users = {1: user(1, "Before")}
+
+    async def getUserById(id):
+        return users[id]
+
+    monkeypatch.setattr(UserController, "getUserById", getUserById)
+    token = jwt.encode({"sub": "1", "userName": "user1", "exp": time() + 60}, key=auth.SECRET, algorithm=auth.ALGORITHM)
+
+    assert asyncio.run(auth.authUser(token)).name == "Before"
+
+    users[1] = user(1, "After")
+    auth.invalidateUser(1)
+
+    assert asyncio.run(auth.authUser(token)).name == "After"
+
+
+def test_the_generations_evicted_for_room_raise_the_floor(auth):
+    cached = auth.GENERATIONS.of("1")
+
+    for id in range(1, 4):
+        auth.invalidateUser(id)
+
+    assert "1" not in auth.GENERATIONS
+    assert auth.GENERATIONS.of("1") != cached
+    assert len(auth.GENERATIONS) == 2
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from controller import CampaignController
+
+
+@pytest.fixture
+def pacing(monkeypatch):
+    monkeypatch.setattr(CampaignController, "NEXT_REQUEST_AT", 0.0)
+    yield CampaignController
+
+
+def test_the_syntheses_are_paced_under_the_quota(pacing, monkeypatch):
+    monkeypatch.setattr(pacing, "REQUESTS_PER_MINUTE", 60)
+
+    async def scenario():
+        await pacing.pace()
+        await asyncio.wait_for(pacing.pace(), 0.1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("requestsPerMinute", [0, -1])
+def test_no_quota_leaves_the_syntheses_unthrottled(pacing, monkeypatch, requestsPerMinute):
+    monkeypatch.setattr(pacing, "REQUESTS_PER_MINUTE", requestsPerMinute)
+
+    async def scenario():
+        for _ in range(100):
+            await pacing.pace()
+
+    asyncio.run(asyncio.wait_for(scenario(), 1))
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+from controller.executor import Executor
+from controller.metrics import DEPENDENCY_ERRORS, DEPENDENCY_SECONDS
+
+
+def calls(name : str) -> int:
+    series = DEPENDENCY_SECONDS.series.get((name,))
+    return series[2] if series else 0
+
+
+def test_a_stream_is_observed_once():
+    async def scenario():
+        return [item async for item in Executor.iterate("test-stream", iter(range(5)))]
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
+    assert calls("test-stream") == 1
+
+
+def test_a_failed_stream_is_observed_once_as_an_error():
+    def chunks():
+        yield 1
+        raise ValueError("stream broken")
+
+    async def scenario():
+        async for _ in Executor.iterate("test-broken", chunks()):
+            pass
+
+    with pytest.raises(ValueError):
+        asyncio.run(scenario())
+    assert calls("test-broken") == 1
+    assert DEPENDENCY_ERRORS.values.get(("test-broken",)) == 1
@@ -0,0 +1,71 @@
+import asyncio
+from time import monotonic
+
+import pytest
+
+from controller import UserController
+from controller.portfolioAnalytics import PortfolioAnalytics, aggregate
+from model import AnalyticsQuery, PaymentUtils, User
+
+
+def user(id : int, debt : float = 100.0, history : list = None) -> User:
+    return User(id=id, name=f"User {id}", userName=f"user{id}", email=f"user{id}@example.com", phone=None,
+                createdAt="2024-01-01T00:00:00Z", birthdate="1990-05-01T00:00:00Z", documentID=id, password="secret",
+                debt=debt, debtMaturityDate="2024-02-01T00:00:00Z", state=True, paymentHistory=history or [])
+
+
+@pytest.fixture
+def analytics(monkeypatch):
+    monkeypatch.setattr(PortfolioAnalytics, "COLUMNS", None)
+    monkeypatch.setattr(PortfolioAnalytics, "ROWS", {})
+    monkeypatch.setattr(PortfolioAnalytics, "DIRTY", set())
+    monkeypatch.setattr(PortfolioAnalytics, "RELOAD", None)
+    monkeypatch.setattr(PortfolioAnalytics, "REFRESH", asyncio.Lock())
+    yield PortfolioAnalytics
+
+
+def test_aggregate_matches_the_profile_of_each_user():
+    users = [
+        user(1, history=[{"amount": 10, "date": "2024-03-01", "dueDate": "2024-02-01"},
+                         {"value": "5", "paymentDate": "2024-01-20T10:00:00-05:00", "due": "2024-01-10"},
+                         {"amount": 7, "date": "2024-04-01", "dueDate": "2024-04-05"},
+                         {"amount": 3, "date": "2024-05-09", "dueDate": "2024-05-01"}]),
+        user(2, history=[{"amount": 4, "late": True}, {"amount": 6, "date": "2024-01-01", "late": False}, "junk", {"amount": True}]),
+        user(3)
+    ]
+    columns = aggregate(users)
+
+    for row, item in enumerate(users):
+        profile = PaymentUtils.profile(item)
+        assert columns["payments"][row] == profile.payments
+        assert columns["totalPaid"][row] == pytest.approx(profile.totalPaid)
+        assert columns["latePayments"][row] == profile.latePayments
+        assert columns["arrearsStreak"][row] == profile.arrearsStreak
+
+
+def test_a_stale_ranking_reloads_in_the_background(analytics, monkeypatch):
+    snapshots = [[user(1, debt=10.0)], [user(1, debt=20.0)]]
+    release = asyncio.Event()
+
+    async def getUsers():
+        if analytics.COLUMNS is not None:
+            await release.wait()
+        return snapshots.pop(0)
+
+    monkeypatch.setattr(UserController, "getUsers", getUsers)
+    query = AnalyticsQuery()
+
+    async def scenario():
+        first = await analytics.ranking(query)
+        analytics.LOADED_AT = monotonic() - analytics.TTL_SECONDS
+        stale = await asyncio.wait_for(analytics.ranking(query), 1)
+        release.set()
+        await analytics.RELOAD
+        fresh = await analytics.ranking(query)
+        return first, stale, fresh
+
+    first, stale, fresh = asyncio.run(scenario())
+
+    assert first["items"][0]["debt"] == 10.0
+    assert stale["items"][0]["debt"] == 10.0
+    assert fresh["items"][0]["debt"] == 20.0
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from controller import TranscriptionController
+from model import TranscriptionRequest
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1:8000/hook",
+    "http://10.0.0.5/hook",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/hook",
+    "http://[::ffff:127.0.0.1]/hook",
+    "ftp://8.8.8.8/hook",
+    "http:///hook"
+])
+def test_callbacks_to_internal_hosts_are_not_allowed(url):
+    assert not asyncio.run(TranscriptionController.allowed(url))
+
+
+def test_callbacks_to_public_addresses_are_allowed():
+    assert asyncio.run(TranscriptionController.allowed("https://8.8.8.8/hook"))
+
+
+def test_the_allowed_hosts_replace_the_address_check(monkeypatch):
+    monkeypatch.setattr(TranscriptionController, "CALLBACK_HOSTS", ["hooks.example.com", "127.0.0.1"])
+
+    assert asyncio.run(TranscriptionController.allowed("https://api.hooks.example.com/done"))
+    assert asyncio.run(TranscriptionController.allowed("http://127.0.0.1:8000/hook"))
+    assert not asyncio.run(TranscriptionController.allowed("https://8.8.8.8/hook"))
+    assert not asyncio.run(TranscriptionController.allowed("https://evilhooks.example.com/done"))
+
+
+def test_callbacks_are_disabled_without_a_webhook_secret(monkeypatch):
+    monkeypatch.setattr(TranscriptionController, "WEBHOOK_SECRET", "")
+    request = TranscriptionRequest(userId=1, audioPath="audio.wav", callbackUrl="https://8.8.8.8/hook")
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(TranscriptionController.submit(request))
+    assert error.value.status_code == 400
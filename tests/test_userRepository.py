@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from controller.dbClient import DBClient
+from controller.userIndex import UserIndex
+from controller.userRepository import RestRepository
+from model import UserUtils
+
+
+def user(id : int) -> dict:
+    return {
+        "id": id, "name": f"User {id}", "userName": f"user{id}", "email": f"user{id}@example.com", "phone": None,
+        "createdAt": "2024-01-01T00:00:00Z", "birthdate": "1990-05-01T00:00:00Z", "documentID": id,
+        "password": "secret", "debt": 100.0, "debtMaturityDate": "2024-02-01T00:00:00Z",
+        "state": True, "paymentHistory": []
+    }
+
+
+@pytest.fixture
+def datastore(monkeypatch):
+    calls = {"all": 0, "id": 0}
+    users = [user(id) for id in range(1, 41)]
+
+    async def get(url, **kwargs):
+        await asyncio.sleep(0.01)
+        if url.endswith("/users"):
+            calls["all"] += 1
+            return httpx.Response(200, content=json.dumps(users).encode())
+        calls["id"] += 1
+        return httpx.Response(200, content=json.dumps(users[int(url.rsplit("/", 1)[1]) - 1]).encode())
+
+    monkeypatch.setattr(DBClient, "get", get)
+    UserIndex.invalidate()
+    yield calls
+    UserIndex.invalidate()
+
+
+def test_concurrent_lookups_on_a_cold_index_download_once(datastore):
+    repository = RestRepository()
+
+    async def scenario():
+        return await asyncio.gather(*(repository.findByEmail(f"user{id}@example.com") for id in range(1, 41)))
+
+    found = asyncio.run(scenario())
+
+    assert [user.id for user in found] == list(range(1, 41))
+    assert datastore["all"] == 1
+
+
+def test_concurrent_misses_download_once(datastore):
+    repository = RestRepository()
+
+    async def scenario():
+        await repository.findByEmail("user1@example.com")
+        UserIndex.LOADED_AT -= UserIndex.MIN_REFRESH_SECONDS
+        return await asyncio.gather(*(repository.findByEmail(f"unknown{id}@example.com") for id in range(20)))
+
+    assert asyncio.run(scenario()) == [None] * 20
+    assert datastore["all"] == 2
+
+
+def test_reads_by_id_reach_the_datastore(datastore):
+    repository = RestRepository()
+
+    async def scenario():
+        await repository.findByEmail("user1@example.com")
+        return await repository.get(1)
+
+    assert asyncio.run(scenario()).id == 1
+    assert datastore["id"] == 1
+
+
+@pytest.mark.parametrize("status", [502, 503, 504])
+def test_unexpected_statuses_of_the_datastore_are_rejected(monkeypatch, status):
+    async def answer(url, **kwargs):
+        return httpx.Response(status, content=b"<html>Bad gateway</html>")
+
+    monkeypatch.setattr(DBClient, "get", answer)
+    monkeypatch.setattr(DBClient, "delete", answer)
+    repository = RestRepository()
+    UserIndex.load([UserUtils.from_bytes(json.dumps(user(1)).encode())])
+
+    for call in (repository.all, lambda: repository.get(1), lambda: repository.delete(1)):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(call())
+        assert error.value.status_code == 502
+
+    assert UserIndex.BY_ID.get(1) is not None
+    UserIndex.invalidate()
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from model import User, UserUtils
+
+
+def document(**fields) -> bytes:
+    user = {
+        "id": 1, "name": "Ana", "userName": "ana", "email": "ana@example.com", "phone": None,
+        "createdAt": "2024-01-01T00:00:00Z", "birthdate": "1990-05-01T00:00:00Z", "documentID": 123,
+        "password": "secret", "debt": 100, "debtMaturityDate": "2024-02-01T00:00:00Z",
+        "state": True, "paymentHistory": []
+    }
+    user.update(fields)
+    return json.dumps(user).encode()
+
+
+def test_users_of_the_datastore_are_read_in_lax_mode():
+    user = UserUtils.from_bytes(document(documentID="123", debt="100.5"))
+
+    assert user.documentID == 123
+    assert user.debt == 100.5
+    assert user.createdAt.tzinfo is not None
+
+
+def test_numeric_datetimes_of_the_datastore_are_rejected():
+    with pytest.raises(HTTPException) as error:
+        UserUtils.from_bytes(document(createdAt=1700000000))
+    assert error.value.status_code == 500
+
+    with pytest.raises(HTTPException):
+        UserUtils.list_from_bytes(b"[" + document(debtMaturityDate=1.7e9) + b"]")
+
+
+def test_request_bodies_keep_iso_strings():
+    user = User.model_validate(json.loads(document()))
+
+    assert UserUtils.from_bytes(UserUtils.to_bytes(user)) == user